@@ -1,161 +1,244 @@
-import json
 from datetime import datetime
-from pathlib import Path
+import os
+import asyncio
 import logging
+from storage import create_storage, month_key, dream_event, error_event, PartialBatchError
+from quota import QuotaTracker
+from livefeed import ChangeFeed
+import metrics
 
 logger = logging.getLogger(__name__)
 
 class DreamAnalytics:
-    def __init__(self):
-        self.analytics_dir = Path("analytics")
-        self.analytics_dir.mkdir(exist_ok=True)
-        self.daily_file = self.analytics_dir / f"dream_analytics_{datetime.now().strftime('%Y_%m')}.json"
-        self._ensure_file_exists()
-
-    def _ensure_file_exists(self):
-        """Create analytics file if it doesn't exist"""
-        if not self.daily_file.exists():
-            initial_data = {
-                "total_dreams": 0,
-                "voice_messages": 0,
-                "text_messages": 0,
-                "errors": 0,
-                "tokens_used": 0,
-                "common_themes": {},
-                "user_interactions": {},
-                "daily_stats": {}
-            }
-            self._save_data(initial_data)
-
-    def _load_data(self):
-        """Load analytics data from file"""
-        try:
-            with open(self.daily_file, 'r', encoding='utf-8') as f:
-                return json.load(f)
-        except Exception as e:
-            logger.error(f"Error loading analytics data: {e}")
-            return None
-
-    def _save_data(self, data):
-        """Save analytics data to file"""
-        try:
-            with open(self.daily_file, 'w', encoding='utf-8') as f:
-                json.dump(data, f, ensure_ascii=False, indent=2)
-        except Exception as e:
-            logger.error(f"Error saving analytics data: {e}")
+    """Usage statistics and monthly quotas.
+
+    Once ``start()`` is called, dreams and errors are queued and written by a
+    background task in batches, so logging from a handler is a list append.
+    Without a running writer every event is written immediately. Themes of
+    the dream texts are extracted per batch by the writer, and the texts are
+    dropped once counted. Every written batch is also summed into counter
+    deltas on the change feed that live dashboards follow.
+    """
+
+    def __init__(self, storage=None, flush_interval: float = None, batch_size: int = None,
+                 themes=None, feed: ChangeFeed = None):
+        self.storage = storage or create_storage()
+        self.storage.ensure_month(month_key(datetime.now()))
+        # Counters are read on first use, or restored from a warm-state snapshot
+        self.quota = QuotaTracker(self.storage)
+
+        self.flush_interval = flush_interval or float(os.getenv('ANALYTICS_FLUSH_INTERVAL', '1.0'))
+        self.batch_size = batch_size or int(os.getenv('ANALYTICS_BATCH_SIZE', '200'))
+        self._pending = []  # Events waiting to be written
+        self._month = None  # Month the writer last wrote in, for rotation
+        # A ThemeExtractor, built by the writer on its first batch unless one is given
+        self.themes = themes
+        self.themes_enabled = themes is not None or os.getenv('THEMES_ENABLED', '1') == '1'
+        if feed is None and os.getenv('LIVE_FEED_ENABLED', '1') == '1':
+            feed = ChangeFeed()
+        self.feed = feed
+        self._wakeup = None
+        self._task = None
+
+    async def load_quota(self, user_id: int):
+        """Make sure a user's quota counters are in memory, reading storage in a thread, off the event loop"""
+        if self.quota.needs_lookup(user_id):
+            await asyncio.to_thread(self.quota.load_user, user_id)
 
     def get_user_monthly_usage(self, user_id: int) -> dict:
         """Get user's usage statistics for current month"""
-        data = self._load_data()
-        if not data or str(user_id) not in data['user_interactions']:
-            return {"total_dreams": 0, "voice_messages": 0, "text_messages": 0}
-        
-        user_data = data['user_interactions'][str(user_id)]
-        return {
-            "total_dreams": user_data.get('total_dreams', 0),
-            "voice_messages": user_data.get('voice_messages', 0),
-            "text_messages": user_data.get('text_messages', 0)
-        }
+        return self.quota.usage(user_id)
 
     def check_monthly_limit(self, user_id: int, message_type: str) -> bool:
         """Check if user has reached monthly limit"""
-        usage = self.get_user_monthly_usage(user_id)
-        
-        # Monthly limit of 20 messages (combined voice and text)
-        monthly_limit = 20
-        
-        return usage["total_dreams"] < monthly_limit
-
-    def log_dream_interpretation(self, user_id: int, message_type: str, dream_text: str, tokens_used: int):
-        """Log a dream interpretation interaction"""
-        data = self._load_data()
-        if not data:
-            return
+        return self.quota.has_quota(user_id)
+
+    def reserve_slot(self, user_id: int) -> bool:
+        """Reserve one of the user's monthly interpretations before calling GPT"""
+        return self.quota.reserve(user_id)
+
+    def release_slot(self, user_id: int):
+        """Release a reserved interpretation that was not delivered"""
+        self.quota.release(user_id)
 
-        today = datetime.now().strftime('%Y-%m-%d')
-        
-        # Update total counts
-        data['total_dreams'] += 1
-        data[f'{message_type}_messages'] += 1
-        data['tokens_used'] += tokens_used
-
-        # Update user statistics
-        if str(user_id) not in data['user_interactions']:
-            data['user_interactions'][str(user_id)] = {
-                'total_dreams': 0,
-                'voice_messages': 0,
-                'text_messages': 0,
-                'first_interaction': today,
-                'last_interaction': today
-            }
-        
-        user_data = data['user_interactions'][str(user_id)]
-        user_data['total_dreams'] += 1
-        user_data[f'{message_type}_messages'] = user_data.get(f'{message_type}_messages', 0) + 1
-        user_data['last_interaction'] = today
-
-        # Update daily statistics
-        if today not in data['daily_stats']:
-            data['daily_stats'][today] = {
-                'total_dreams': 0,
-                'voice_messages': 0,
-                'text_messages': 0,
-                'tokens_used': 0
-            }
-        
-        data['daily_stats'][today]['total_dreams'] += 1
-        data['daily_stats'][today][f'{message_type}_messages'] += 1
-        data['daily_stats'][today]['tokens_used'] += tokens_used
-
-        self._save_data(data)
+    def get_remaining_dreams(self, user_id: int) -> int:
+        """Get the number of interpretations left this month"""
+        return self.quota.remaining(user_id)
+
+    def log_dream_interpretation(self, user_id: int, message_type: str, dream_text: str, tokens_used: int,
+                                 prompt_tokens: int = 0, completion_tokens: int = 0):
+        """Log a dream interpretation interaction"""
+        self.quota.record(user_id, message_type)
+        try:
+            event = dream_event(user_id, message_type, tokens_used, datetime.now(),
+                                prompt_tokens=prompt_tokens, completion_tokens=completion_tokens)
+            if self.themes_enabled:
+                event['text'] = dream_text
+            self._submit(event)
+        except Exception as e:
+            logger.error(f"Error logging dream interpretation: {e}")
 
     def log_error(self, error_type: str, error_message: str):
         """Log an error occurrence"""
-        data = self._load_data()
-        if not data:
+        metrics.ERRORS.inc(type=error_type)
+        self._submit(error_event(error_type, error_message, datetime.now()))
+
+    def _submit(self, event: dict):
+        self._pending.append(event)
+        if self._task is None:
+            self.flush()
+        elif len(self._pending) >= self.batch_size:
+            self._wakeup.set()
+
+    def _rotate(self):
+        """Start the new month's partition and compress the previous ones"""
+        month = month_key(datetime.now())
+        if month != self._month:
+            self.storage.ensure_month(month)
+            try:
+                self.storage.compress_cold_months(month)
+            except Exception as e:
+                logger.error(f"Error compressing old analytics: {e}")
+            self._month = month
+
+    def _tag_themes(self, batch: list):
+        """Replace the dream texts in a batch with their themes"""
+        events = [event for event in batch if 'text' in event]
+        if not events:
+            return
+        try:
+            if self.themes is None:
+                # Only processes that write dreams pay for numpy, the lexicon and the hashed vectors
+                from themes import ThemeExtractor
+                self.themes = ThemeExtractor()
+            with metrics.span('theme_extraction'):
+                themes = self.themes.extract_batch([event['text'] for event in events])
+        except Exception as e:
+            logger.error(f"Error extracting dream themes: {e}")
+            themes = [[] for _ in events]
+        for event, event_themes in zip(events, themes):
+            del event['text']
+            event['themes'] = event_themes
+
+    def _write_batch(self, batch: list):
+        self._tag_themes(batch)
+        self._rotate()
+        with metrics.span('analytics_write'):
+            versions = self.storage.apply_batch(batch)
+        if self.feed is not None:
+            # The batch is stored; a failed append only costs live dashboards a delta
+            try:
+                self.feed.append(batch, versions)
+            except Exception as e:
+                logger.error(f"Error appending to the live change feed: {e}")
+
+    def flush(self):
+        """Write all queued events now"""
+        batch, self._pending = self._pending, []
+        if not batch:
             return
+        try:
+            self._write_batch(batch)
+        except PartialBatchError as e:
+            logger.error(f"Error saving analytics events: {e}")
+            # Requeue only what was not stored, so a retry never counts an event twice
+            self._pending = e.remaining + self._pending
+        except Exception as e:
+            logger.error(f"Error saving analytics events: {e}")
+            self._pending = batch + self._pending
 
-        data['errors'] += 1
-        
-        today = datetime.now().strftime('%Y-%m-%d')
-        if today not in data['daily_stats']:
-            data['daily_stats'][today] = {
-                'total_dreams': 0,
-                'voice_messages': 0,
-                'text_messages': 0,
-                'tokens_used': 0,
-                'errors': 0
-            }
-        
-        if 'errors' not in data['daily_stats'][today]:
-            data['daily_stats'][today]['errors'] = 0
-            
-        data['daily_stats'][today]['errors'] += 1
-
-        self._save_data(data)
-
-    def get_monthly_stats(self):
-        """Get current month's statistics"""
-        data = self._load_data()
-        if not data:
-            return None
-
-        return {
-            'total_dreams': data['total_dreams'],
-            'voice_messages': data['voice_messages'],
-            'text_messages': data['text_messages'],
-            'total_users': len(data['user_interactions']),
-            'tokens_used': data['tokens_used'],
-            'errors': data['errors']
-        }
+    async def _flush_async(self):
+        batch, self._pending = self._pending, []
+        if not batch:
+            return
+        try:
+            await asyncio.to_thread(self._write_batch, batch)
+        except PartialBatchError as e:
+            logger.error(f"Error saving analytics events: {e}")
+            # Requeue only what was not stored, so a retry never counts an event twice
+            self._pending = e.remaining + self._pending
+        except Exception as e:
+            logger.error(f"Error saving analytics events: {e}")
+            self._pending = batch + self._pending
+
+    async def _writer(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self._flush_async()
+
+    def start(self):
+        """Start the background writer task"""
+        if self._task is None:
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._writer())
+
+    async def stop(self):
+        """Stop the background writer and flush what is left"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+            self._wakeup = None
+        await self._flush_async()
+
+    def get_monthly_stats(self, month: str = None):
+        """Get a month's statistics, current month by default"""
+        with metrics.span('analytics_read'):
+            return self.storage.get_monthly(month or month_key(datetime.now()))
 
     def get_daily_stats(self, date: str = None):
         """Get statistics for a specific date"""
         if not date:
             date = datetime.now().strftime('%Y-%m-%d')
 
-        data = self._load_data()
-        if not data or date not in data['daily_stats']:
-            return None
-
-        return data['daily_stats'][date] 
\ No newline at end of file
+        with metrics.span('analytics_read'):
+            return self.storage.get_daily(date)
+
+    def get_daily_stats_range(self, dates: list) -> dict:
+        """Get statistics for several dates at once"""
+        with metrics.span('analytics_read'):
+            return self.storage.get_daily_range(dates)
+
+    def get_top_themes(self, month: str = None, limit: int = 10) -> list:
+        """Get a month's most common dream themes as ``[(theme, count), ...]``"""
+        with metrics.span('analytics_read'):
+            themes = self.storage.get_themes(month or month_key(datetime.now()))
+        return sorted(themes.items(), key=lambda item: (-item[1], item[0]))[:limit]
+
+    def has_partial_themes(self, month: str = None) -> bool:
+        """Whether a month's theme counts include days backfilled from the truncated dream history"""
+        with metrics.span('analytics_read'):
+            return self.storage.has_partial_themes(month or month_key(datetime.now()))
+
+    def iter_daily_stats(self, start_date: str, end_date: str):
+        """Iterate over (date, stats) between two dates, opening only the months needed"""
+        return self.storage.iter_daily(start_date, end_date)
+
+    def iter_user_monthly(self, start_month: str, end_month: str):
+        """Iterate over (month, user_id, usage) between two months"""
+        return self.storage.iter_user_monthly(start_month, end_month)
+
+    @property
+    def stores_events(self) -> bool:
+        """Whether individual events are kept, not only the counters (SQLite backend)"""
+        return hasattr(self.storage, 'iter_events')
+
+    def iter_events(self, start_date: str, end_date: str):
+        """Iterate over stored events between two dates, oldest first"""
+        return self.storage.iter_events(start_date, end_date)
+
+    def write_versions(self, months: list) -> dict:
+        """Get each month's write version, to tell which live deltas a snapshot already includes"""
+        with metrics.span('analytics_read'):
+            return self.storage.write_versions(months)
+
+    def change_token(self, months: list = None):
+        """Get a value that changes whenever the stored statistics change"""
+        return self.storage.change_token(months or [month_key(datetime.now())])
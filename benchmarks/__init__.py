@@ -0,0 +1 @@
+"""Load tests and microbenchmarks for the dream bot, run against local fakes."""
@@ -0,0 +1,129 @@
+"""Microbenchmarks of DreamAnalytics against generated analytics files.
+
+Example:
+    python -m benchmarks.bench_analytics --sizes 1000 100000 1000000 --backends json sqlite
+"""
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+from datetime import datetime
+from pathlib import Path
+from analytics import DreamAnalytics
+from storage import JSONStorage, SQLiteStorage, month_key
+from benchmarks.report import summarize, print_table, save_report, load_report, compare_reports, print_comparison
+
+
+def generate_month(path: Path, users: int, now: datetime, seed: int = 1):
+    """Write a monthly analytics file with ``users`` users and a daily series up to today"""
+    rng = random.Random(seed)
+    today = now.strftime('%Y-%m-%d')
+    data = {
+        "total_dreams": 0,
+        "voice_messages": 0,
+        "text_messages": 0,
+        "errors": 0,
+        "tokens_used": 0,
+        "common_themes": {},
+        "user_interactions": {},
+        "daily_stats": {}
+    }
+    for user_id in range(1, users + 1):
+        voice = rng.randint(0, 10)
+        text = rng.randint(0, 9)
+        data['user_interactions'][str(user_id)] = {
+            'total_dreams': voice + text,
+            'voice_messages': voice,
+            'text_messages': text,
+            'first_interaction': now.strftime('%Y-%m-01'),
+            'last_interaction': today
+        }
+        data['total_dreams'] += voice + text
+        data['voice_messages'] += voice
+        data['text_messages'] += text
+    data['tokens_used'] = data['total_dreams'] * 1300
+    for day in range(1, now.day + 1):
+        date = now.strftime(f'%Y-%m-{day:02d}')
+        data['daily_stats'][date] = {
+            'total_dreams': data['total_dreams'] // now.day,
+            'voice_messages': data['voice_messages'] // now.day,
+            'text_messages': data['text_messages'] // now.day,
+            'tokens_used': data['tokens_used'] // now.day,
+            'errors': rng.randint(0, 5)
+        }
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, indent=2)
+
+
+def time_calls(function, repeat: int) -> list:
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - started)
+    return timings
+
+
+def bench_backend(backend: str, users: int, repeat: int, workdir: Path) -> dict:
+    now = datetime.now()
+    analytics_dir = workdir / f"{backend}_{users}"
+    generate_month(analytics_dir / f"dream_analytics_{month_key(now).replace('-', '_')}.json", users, now)
+
+    if backend == 'sqlite':
+        storage = SQLiteStorage(analytics_dir / 'dream_analytics.db')
+        storage.import_json_files(analytics_dir)
+    else:
+        storage = JSONStorage(analytics_dir)
+
+    results = {}
+    started = time.perf_counter()
+    analytics = DreamAnalytics(storage)
+    results['init (warm load)'] = [time.perf_counter() - started]
+
+    rng = random.Random(2)
+    results['get_user_monthly_usage'] = time_calls(
+        lambda: analytics.get_user_monthly_usage(rng.randint(1, users)), repeat
+    )
+    results['check_monthly_limit'] = time_calls(
+        lambda: analytics.check_monthly_limit(rng.randint(1, users), 'text'), repeat
+    )
+    results['get_monthly_stats'] = time_calls(analytics.get_monthly_stats, repeat)
+    results['get_daily_stats'] = time_calls(analytics.get_daily_stats, repeat)
+    results['log_dream_interpretation'] = time_calls(
+        lambda: analytics.log_dream_interpretation(rng.randint(1, users), 'voice', 'сон', 1200), repeat
+    )
+    results['log_error'] = time_calls(lambda: analytics.log_error('benchmark', 'error'), repeat)
+    return {name: summarize(values) for name, values in results.items()}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark DreamAnalytics hot paths")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--backends', nargs='+', default=['json', 'sqlite'], choices=['json', 'sqlite'])
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--workdir', default=None)
+    parser.add_argument('--output', default=None, help="write the JSON report here")
+    parser.add_argument('--baseline', default=None, help="compare against a previous JSON report")
+    parser.add_argument('--tolerance', type=float, default=1.5)
+    args = parser.parse_args(argv)
+
+    workdir = Path(args.workdir or tempfile.mkdtemp(prefix='dream_analytics_bench_'))
+    report = {}
+    for backend in args.backends:
+        for users in args.sizes:
+            section = f"{backend}/{users}_users"
+            report[section] = bench_backend(backend, users, args.repeat, workdir)
+            print_table(section, report[section])
+
+    if args.output:
+        save_report(report, args.output)
+    if args.baseline:
+        if print_comparison(compare_reports(report, load_report(args.baseline), tolerance=args.tolerance)):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
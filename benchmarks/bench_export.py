@@ -0,0 +1,110 @@
+"""Throughput and memory of the streaming analytics export.
+
+Example:
+    python -m benchmarks.bench_export --users 200000 --months 12
+"""
+import sys
+import time
+import random
+import argparse
+import tempfile
+import tracemalloc
+from datetime import datetime
+from pathlib import Path
+from analytics import DreamAnalytics
+from export import export
+from storage import SQLiteStorage, JSONStorage, dream_event, error_event
+from benchmarks.report import save_report, load_report, compare_reports, print_comparison
+
+
+def fill(storage, users: int, months: int, rng: random.Random, batch_size: int = 20000):
+    """Give every user one dream in each month, plus an error per thousand dreams"""
+    batch = []
+    for month in range(1, months + 1):
+        for user_id in range(users):
+            when = datetime(2025, month, rng.randint(1, 28), rng.randint(0, 23))
+            batch.append(dream_event(user_id, rng.choice(('text', 'voice')), rng.randint(500, 1500), when,
+                                     prompt_tokens=400, completion_tokens=300))
+            if user_id % 1000 == 0:
+                batch.append(error_event('timeout', 'OpenAI timed out', when))
+            if len(batch) >= batch_size:
+                storage.apply_batch(batch)
+                batch = []
+    if batch:
+        storage.apply_batch(batch)
+
+
+def consume(analytics, dataset: str, fmt: str, start_date: str, end_date: str):
+    size = chunks = 0
+    for chunk in export(analytics, dataset, fmt, start_date, end_date):
+        size += len(chunk)
+        chunks += 1
+    return size, chunks
+
+
+def measure(analytics, dataset: str, fmt: str, start_date: str, end_date: str) -> dict:
+    """Time a whole export, then run it again under tracemalloc for its peak memory"""
+    started = time.perf_counter()
+    size, chunks = consume(analytics, dataset, fmt, start_date, end_date)
+    elapsed = time.perf_counter() - started
+    tracemalloc.start()
+    consume(analytics, dataset, fmt, start_date, end_date)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {'seconds': round(elapsed, 3), 'mb': round(size / 1024 / 1024, 1),
+            'mb_per_second': round(size / 1024 / 1024 / elapsed, 1), 'chunks': chunks,
+            'peak_memory_mb': round(peak / 1024 / 1024, 2)}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the streaming analytics export")
+    parser.add_argument('--users', type=int, default=200000)
+    parser.add_argument('--months', type=int, default=12)
+    parser.add_argument('--backend', choices=('sqlite', 'json'), default='sqlite')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--workdir', default=None)
+    parser.add_argument('--output', default=None, help="write the JSON report here")
+    parser.add_argument('--baseline', default=None, help="compare against a previous JSON report")
+    parser.add_argument('--tolerance', type=float, default=1.5)
+    args = parser.parse_args(argv)
+
+    rng = random.Random(args.seed)
+    workdir = Path(args.workdir or tempfile.mkdtemp(prefix='dream_export_bench_'))
+    if args.backend == 'sqlite':
+        storage = SQLiteStorage(workdir / 'dream_analytics.db')
+    else:
+        workdir.mkdir(parents=True, exist_ok=True)
+        storage = JSONStorage(workdir / 'analytics')
+    started = time.perf_counter()
+    fill(storage, args.users, args.months, rng)
+    print(f"Stored {args.users * args.months} dreams in {time.perf_counter() - started:.1f}s")
+
+    analytics = DreamAnalytics(storage=storage, themes=None, feed=None)
+    start_date, end_date = '2025-01-01', f"2025-{args.months:02d}-28"
+    datasets = ['daily', 'users'] + (['events'] if analytics.stores_events else [])
+
+    section = f"export/{args.backend}_{args.users}_users_{args.months}_months"
+    report = {section: {}}
+    print(f"\n{section}")
+    print(f"{'export':<16} {'seconds':>8} {'MB':>8} {'MB/s':>8} {'chunks':>8} {'peak MB':>8}")
+    for dataset in datasets:
+        for fmt in ('csv', 'ndjson'):
+            result = report[section][f"{dataset}.{fmt}"] = measure(analytics, dataset, fmt, start_date, end_date)
+            print(f"{dataset + '.' + fmt:<16} {result['seconds']:>8} {result['mb']:>8} {result['mb_per_second']:>8} "
+                  f"{result['chunks']:>8} {result['peak_memory_mb']:>8}")
+
+    if args.output:
+        save_report(report, args.output)
+    if args.baseline:
+        baseline = load_report(args.baseline)
+        regressed = False
+        # Both slower exports and exports that hold more in memory are regressions
+        for metric in ('seconds', 'peak_memory_mb'):
+            rows = compare_reports(report, baseline, metric=metric, tolerance=args.tolerance)
+            regressed = print_comparison(rows, metric=metric) or regressed
+        if regressed:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
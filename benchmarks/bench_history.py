@@ -0,0 +1,149 @@
+"""Memory and latency of the in-memory dream history with many users.
+
+Example:
+    python -m benchmarks.bench_history --users 1000000 --budget-mb 256
+"""
+import sys
+import time
+import random
+import argparse
+import tempfile
+import tracemalloc
+from datetime import datetime
+from pathlib import Path
+from history import DreamHistory
+from benchmarks.load_test import DREAM_TEMPLATES
+from benchmarks.bench_analytics import time_calls
+from benchmarks.report import summarize, print_table, save_report, load_report, compare_reports, print_comparison
+
+INTERPRETATION_SENTENCES = [
+    "Этот сон может отражать желание перемен и поиск нового направления в жизни.",
+    "Вода часто символизирует эмоции, и её состояние во сне говорит о твоём внутреннем настрое.",
+    "Погоня нередко связана с тем, от чего человек пытается уйти в реальности.",
+    "Дом во сне обычно олицетворяет тебя самого, а его комнаты — разные стороны личности.",
+    "Маяк может означать ориентир, который помогает не сбиться с пути в трудный период.",
+    "Выпадающие зубы часто связывают с тревогой о том, как тебя воспринимают окружающие.",
+    "Экзамен во сне нередко отражает ощущение, что тебя оценивают или проверяют.",
+    "Полёт обычно символизирует свободу и стремление подняться над обстоятельствами.",
+    "Тень может олицетворять непризнанные чувства, которые просят внимания.",
+    "Пустые комнаты иногда говорят о потребности заполнить жизнь чем-то важным.",
+    "Возможно, подсознание подсказывает, что пора довериться своей интуиции.",
+    "Этот образ может напоминать о том, что у тебя больше сил, чем кажется.",
+]
+
+
+def generate_dream(rng: random.Random):
+    dream = rng.choice(DREAM_TEMPLATES).format(n=rng.randint(1, 10 ** 6))
+    interpretation = " ".join(rng.sample(INTERPRETATION_SENTENCES, 9))
+    return dream, interpretation
+
+
+def fresh(text: str) -> str:
+    """A private copy of a string, as a real user's text would be"""
+    return text.encode('utf-8').decode('utf-8')
+
+
+def legacy_bytes_per_user(dreams: list, sample: int) -> float:
+    """Measure the former layout: a dict of lists of dicts with datetimes and plain strings"""
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    user_dreams = {}
+    for user_id in range(sample):
+        user_dreams[user_id] = [
+            {'dream': fresh(dream), 'interpretation': fresh(interpretation), 'timestamp': datetime.now(),
+             'id': dream_id}
+            for dream_id, (dream, interpretation) in enumerate(dreams[user_id % len(dreams)], 1)
+        ]
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    del user_dreams
+    return used / sample
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the dream history working set")
+    parser.add_argument('--users', type=int, default=1000000)
+    parser.add_argument('--dreams', type=int, default=1, help="dreams stored per user")
+    parser.add_argument('--budget-mb', type=float, default=256)
+    parser.add_argument('--repeat', type=int, default=2000)
+    parser.add_argument('--sample', type=int, default=10000, help="users measured with tracemalloc")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--workdir', default=None)
+    parser.add_argument('--output', default=None, help="write the JSON report here")
+    parser.add_argument('--baseline', default=None, help="compare against a previous JSON report")
+    parser.add_argument('--tolerance', type=float, default=1.5)
+    args = parser.parse_args(argv)
+
+    rng = random.Random(args.seed)
+    workdir = Path(args.workdir or tempfile.mkdtemp(prefix='dream_history_bench_'))
+    # A pool of generated texts; real texts are strings anyway, and sharing keeps generation fast
+    pool = [[generate_dream(rng) for _ in range(args.dreams)] for _ in range(1000)]
+
+    # Bytes per user of the compact layout, measured exactly on a sample with no eviction
+    sample_history = DreamHistory(workdir / 'sample.db', memory_budget=2 ** 40, batch_size=10 ** 9)
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    for user_id in range(args.sample):
+        for dream, interpretation in pool[user_id % len(pool)]:
+            sample_history.add(user_id, fresh(dream), fresh(interpretation))
+    sample_history._pending.clear()
+    compact = (tracemalloc.get_traced_memory()[0] - before) / args.sample
+    tracemalloc.stop()
+    accounted = sample_history.memory / args.sample
+    legacy = legacy_bytes_per_user(pool, args.sample)
+
+    history = DreamHistory(workdir / 'history.db', memory_budget=int(args.budget_mb * 1024 * 1024),
+                           batch_size=10 ** 9)
+    results = {}
+    started = time.perf_counter()
+    for user_id in range(args.users):
+        for dream, interpretation in pool[user_id % len(pool)]:
+            history.add(user_id, dream, interpretation)
+        if user_id % 10000 == 9999:
+            history.flush()
+    history.flush()
+    results['add (all users)'] = [time.perf_counter() - started]
+
+    recent = list(history._users)[-args.repeat:]
+    results['get_dreams (in memory)'] = time_calls(lambda: history.get_dreams(rng.choice(recent)), args.repeat)
+    loads = history.loads
+    # The oldest users were evicted first; loading them reads SQLite (the bot does this in a thread)
+    results['load_user (reload)'] = time_calls(
+        lambda: history._load_user(rng.randrange(args.users // 2)), args.repeat
+    )
+    results['add (existing user)'] = time_calls(
+        lambda: history.add(rng.randrange(args.users), *pool[0][0]), args.repeat
+    )
+
+    section = f"history/{args.users}_users_{args.dreams}_dreams"
+    report = {section: {name: summarize(values) for name, values in results.items()}}
+    stats = history.stats()
+    report[section]['memory'] = {
+        'bytes_per_user_compact': round(compact),
+        'bytes_per_user_accounted': round(accounted),
+        'bytes_per_user_legacy': round(legacy),
+        'working_set_users': stats['users'],
+        'working_set_mb': round(stats['memory_bytes'] / 1024 / 1024, 1),
+        'evictions': stats['evictions'],
+        'reloads': history.loads - loads
+    }
+    print_table(section, {name: summary for name, summary in report[section].items() if name != 'memory'})
+    memory = report[section]['memory']
+    print(
+        f"\nBytes per user: {memory['bytes_per_user_compact']} compact "
+        f"({memory['bytes_per_user_accounted']} accounted), {memory['bytes_per_user_legacy']} before"
+    )
+    print(
+        f"Working set: {memory['working_set_users']} users in {memory['working_set_mb']} MB, "
+        f"{memory['evictions']} evictions, {memory['reloads']} reloads"
+    )
+
+    if args.output:
+        save_report(report, args.output)
+    if args.baseline:
+        if print_comparison(compare_reports(report, load_report(args.baseline), tolerance=args.tolerance)):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
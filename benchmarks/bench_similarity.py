@@ -0,0 +1,81 @@
+"""Microbenchmarks of the per-user dream similarity index.
+
+Example:
+    python -m benchmarks.bench_similarity --users 10000 --dreams 5
+"""
+import sys
+import time
+import random
+import argparse
+from datetime import datetime
+from similarity import SimilarityIndex
+from benchmarks.load_test import DREAM_TEMPLATES
+from benchmarks.bench_analytics import time_calls
+from benchmarks.report import summarize, print_table, save_report, load_report, compare_reports, print_comparison
+
+QUESTIONS = [
+    "Почему во сне появилась вода?",
+    "Что значит маяк?",
+    "А что символизирует пустой дом?",
+    "Можешь объяснить, почему за мной гналась тень?",
+]
+
+
+def generate_dreams(rng: random.Random, count: int) -> list:
+    return [
+        {
+            'id': dream_id,
+            'dream': rng.choice(DREAM_TEMPLATES).format(n=rng.randint(1, 100)),
+            'interpretation': "Возможно, этот сон говорит о переменах. " * 20,
+            'timestamp': datetime.now()
+        }
+        for dream_id in range(1, count + 1)
+    ]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark follow-up detection and context selection")
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--dreams', type=int, default=5, help="stored dreams per user")
+    parser.add_argument('--repeat', type=int, default=2000)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', default=None, help="write the JSON report here")
+    parser.add_argument('--baseline', default=None, help="compare against a previous JSON report")
+    parser.add_argument('--tolerance', type=float, default=1.5)
+    args = parser.parse_args(argv)
+
+    rng = random.Random(args.seed)
+    index = SimilarityIndex(max_users=args.users)
+    histories = {user_id: generate_dreams(rng, args.dreams) for user_id in range(args.users)}
+
+    started = time.perf_counter()
+    for user_id, dreams in histories.items():
+        index.scores(user_id, QUESTIONS[0], dreams)
+    results = {'build (all users)': [time.perf_counter() - started]}
+
+    def pick():
+        user_id = rng.randrange(args.users)
+        return user_id, rng.choice(QUESTIONS), histories[user_id]
+
+    results['is_follow_up'] = time_calls(lambda: index.is_follow_up(*pick()), args.repeat)
+    results['select_context'] = time_calls(lambda: index.select_context(*pick()), args.repeat)
+
+    def similar():
+        user_id = rng.randrange(args.users)
+        return index.similar(user_id, histories[user_id][0], histories[user_id])
+
+    results['similar'] = time_calls(similar, args.repeat)
+
+    section = f"similarity/{args.users}_users_{args.dreams}_dreams"
+    report = {section: {name: summarize(values) for name, values in results.items()}}
+    print_table(section, report[section])
+
+    if args.output:
+        save_report(report, args.output)
+    if args.baseline:
+        if print_comparison(compare_reports(report, load_report(args.baseline), tolerance=args.tolerance)):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
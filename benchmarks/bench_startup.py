@@ -0,0 +1,148 @@
+"""Time from process start to the first served update, with and without a warm-state snapshot.
+
+Every run is a fresh Python process that imports the bot, builds the
+Application against the local fakes and handles one dream from an existing
+user. A cold run starts without a snapshot; the warm run after it restores
+the snapshot the cold run wrote on shutdown.
+
+``import`` covers what every process importing the bot pays, including the
+webhook front process and the workers' spawn bootstrap. It is now mostly the
+``telegram`` package (about 200 ms of the ~300 ms measured with 100k users
+and SQLite): any ``telegram`` import, even ``telegram.error``, runs the
+package ``__init__`` and with it the httpx request backend, and the handlers
+and the outbox need those types. ``telegram.ext``, numpy (through the
+similarity index) and the stores are imported by ``init_state()`` and
+``build_application()``, so their ~140 ms shows up in ``build`` instead.
+
+Example:
+    python -m benchmarks.bench_startup --users 100000 --runs 5
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+import subprocess
+from datetime import datetime
+from pathlib import Path
+from benchmarks.report import summarize, print_table, save_report, load_report, compare_reports, print_comparison
+
+# The bot processes run this module too, so everything that imports the bot's dependencies
+# (the harness, the fakes, storage) is imported where it is used, never at module level
+PHASES = ('import', 'build', 'post_init', 'first_update', 'process_to_first_update')
+
+
+def fill(users: int, rng: random.Random):
+    """Give every user this month's usage and a stored dream, as a long-running bot would have"""
+    from storage import create_storage, dream_event
+    from history import DreamHistory
+    from benchmarks.load_test import DREAM_TEMPLATES
+
+    storage = create_storage()
+    now = datetime.now()
+    for start in range(0, users, 20000):
+        storage.apply_batch([dream_event(user_id, rng.choice(('text', 'voice')), 800, now)
+                             for user_id in range(start, min(users, start + 20000))])
+    history = DreamHistory(batch_size=10 ** 9)
+    for user_id in range(users):
+        history.add(user_id, rng.choice(DREAM_TEMPLATES).format(n=user_id), "Этот сон может отражать желание перемен.")
+        if user_id % 10000 == 9999:
+            history.flush()
+    history.flush()
+
+
+async def serve_first_update(text: str) -> dict:
+    timings = {}
+    started = time.perf_counter()
+    import bot  # noqa: F401 - imported first so the harness does not pre-load what the bot needs
+    timings['import'] = time.perf_counter() - started
+
+    from benchmarks.harness import BotHarness
+    from benchmarks.fakes import FakeOpenAI
+
+    started = time.perf_counter()
+    harness = BotHarness(FakeOpenAI(latency=0.0, jitter=0.0))
+    timings['build'] = time.perf_counter() - started
+    started = time.perf_counter()
+    await harness.start()
+    timings['post_init'] = time.perf_counter() - started
+    started = time.perf_counter()
+    await harness.process(harness.updates.text(1, text))
+    timings['first_update'] = time.perf_counter() - started
+    served_at = time.time()
+    await harness.stop()
+    return timings, served_at
+
+
+def child(process_started: float, text: str):
+    timings, served_at = asyncio.run(serve_first_update(text))
+    timings['process_to_first_update'] = served_at - process_started
+    print(json.dumps(timings))
+
+
+def run_once(text: str) -> dict:
+    started = time.time()
+    result = subprocess.run(
+        [sys.executable, '-m', 'benchmarks.bench_startup', '--child', str(started), text],
+        capture_output=True, text=True, check=True
+    )
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the bot's cold and warm startup")
+    parser.add_argument('--users', type=int, default=100000)
+    parser.add_argument('--runs', type=int, default=5, help="cold and warm runs each")
+    parser.add_argument('--backend', choices=('sqlite', 'json'), default='json')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--workdir', default=None)
+    parser.add_argument('--output', default=None, help="write the JSON report here")
+    parser.add_argument('--baseline', default=None, help="compare against a previous JSON report")
+    parser.add_argument('--tolerance', type=float, default=1.5)
+    parser.add_argument('--child', nargs=2, metavar=('STARTED', 'TEXT'), help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.child:
+        child(float(args.child[0]), args.child[1])
+        return
+
+    from benchmarks.harness import configure_environment
+    from benchmarks.load_test import DREAM_TEMPLATES
+
+    rng = random.Random(args.seed)
+    workdir = Path(args.workdir or tempfile.mkdtemp(prefix='dream_startup_bench_'))
+    # Inherited by the bot processes
+    configure_environment(workdir, {'ANALYTICS_BACKEND': args.backend, 'THEMES_ENABLED': '0'})
+    snapshot_path = Path(os.environ['WARM_SNAPSHOT_PATH'])
+    started = time.perf_counter()
+    fill(args.users, rng)
+    print(f"Stored {args.users} users in {time.perf_counter() - started:.1f}s")
+
+    results = {f"{state} {phase}": [] for state in ('cold', 'warm') for phase in PHASES}
+    for run in range(args.runs):
+        # A new text each run, so the first dream is never answered from the interpretation cache
+        for state in ('cold', 'warm'):
+            if state == 'cold' and snapshot_path.exists():
+                snapshot_path.unlink()
+            timings = run_once(rng.choice(DREAM_TEMPLATES).format(n=f"{run}-{state}"))
+            for phase, seconds in timings.items():
+                results[f"{state} {phase}"].append(seconds)
+
+    section = f"startup/{args.backend}_{args.users}_users"
+    report = {section: {name: summarize(values) for name, values in results.items()}}
+    print_table(section, report[section])
+    if snapshot_path.exists():
+        print(f"\nSnapshot: {snapshot_path.stat().st_size / 1024 / 1024:.1f} MB")
+
+    if args.output:
+        save_report(report, args.output)
+    if args.baseline:
+        if print_comparison(compare_reports(report, load_report(args.baseline), tolerance=args.tolerance)):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
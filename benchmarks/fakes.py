@@ -0,0 +1,232 @@
+"""Local stand-ins for the Telegram Bot API and OpenAI used by the benchmarks."""
+import json
+import time
+import random
+import asyncio
+import itertools
+from types import SimpleNamespace
+from telegram import Update
+from telegram.request import BaseRequest
+
+BOT_USER = {"id": 1000000001, "is_bot": True, "first_name": "Dreamy", "username": "dreamy_bot"}
+
+# A tiny valid-looking OGG header padded to a typical voice note size
+FAKE_VOICE_BYTES = b"OggS" + b"\x00" * 24 * 1024
+
+
+class FakeTelegramRequest(BaseRequest):
+    """Answers Bot API calls locally with a configurable latency.
+
+    Every call is counted by method name, so benchmarks can report how many
+    round trips a scenario costs. With ``flood_limit`` set, a chat that gets
+    more messages than that within a second is answered like Telegram's flood
+    control (429 with ``retry_after``); those answers are counted as 'flood'.
+    """
+
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, flood_limit: int = None):
+        self.latency = latency
+        self.jitter = jitter
+        self.flood_limit = flood_limit
+        self.calls = {}
+        self._message_ids = itertools.count(1)
+        self._recent = {}  # Format: {chat_id: [send times within the last second]}
+
+    def _flooded(self, chat_id) -> bool:
+        now = time.monotonic()
+        recent = [sent for sent in self._recent.get(chat_id, []) if now - sent < 1.0]
+        if len(recent) >= self.flood_limit:
+            self._recent[chat_id] = recent
+            return True
+        recent.append(now)
+        self._recent[chat_id] = recent
+        return False
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def _message(self, data: dict) -> dict:
+        chat_id = int(data.get('chat_id', 1))
+        return {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": BOT_USER,
+            "text": data.get('text', '')
+        }
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None,
+                         connect_timeout=None, pool_timeout=None):
+        if self.latency or self.jitter:
+            await asyncio.sleep(self.latency + random.random() * self.jitter)
+
+        if '/file/bot' in url:
+            self.calls['download'] = self.calls.get('download', 0) + 1
+            return 200, FAKE_VOICE_BYTES
+
+        endpoint = url.rsplit('/', 1)[-1]
+        self.calls[endpoint] = self.calls.get(endpoint, 0) + 1
+        data = request_data.parameters if request_data else {}
+
+        if self.flood_limit and endpoint in ('sendMessage', 'editMessageText') and self._flooded(data.get('chat_id')):
+            self.calls['flood'] = self.calls.get('flood', 0) + 1
+            return 429, json.dumps({
+                "ok": False, "error_code": 429, "description": "Too Many Requests: retry after 1",
+                "parameters": {"retry_after": 1}
+            }).encode('utf-8')
+
+        if endpoint == 'getMe':
+            result = BOT_USER
+        elif endpoint in ('sendMessage', 'editMessageText'):
+            result = self._message(data)
+        elif endpoint == 'getFile':
+            result = {
+                "file_id": data.get('file_id', 'voice'),
+                "file_unique_id": "voice",
+                "file_size": len(FAKE_VOICE_BYTES),
+                "file_path": "voice/file.ogg"
+            }
+        else:
+            result = True
+        return 200, json.dumps({"ok": True, "result": result}).encode('utf-8')
+
+
+class _FakeStream:
+    def __init__(self, client, tokens: int, usage=None):
+        self.client = client
+        self.remaining = tokens
+        self.started = False
+        self.usage = usage  # Sent as a last chunk without choices, when the caller asked for it
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if not self.started:
+            self.started = True
+            await asyncio.sleep(self.client._first_token_latency())
+        if self.remaining <= 0:
+            if self.usage is None:
+                raise StopAsyncIteration
+            usage, self.usage = self.usage, None
+            return SimpleNamespace(choices=[], usage=usage)
+        self.remaining -= 1
+        if self.client.token_delay:
+            await asyncio.sleep(self.client.token_delay)
+        delta = SimpleNamespace(content="сон ")
+        return SimpleNamespace(choices=[SimpleNamespace(delta=delta)])
+
+
+class _FakeCompletions:
+    def __init__(self, client):
+        self.client = client
+
+    async def create(self, stream=False, max_tokens=600, **kwargs):
+        self.client.chat_calls += 1
+        tokens = min(max_tokens, self.client.completion_tokens)
+        prompt_tokens = sum(len(m['content']) for m in kwargs.get('messages', [])) // 3
+        usage = SimpleNamespace(prompt_tokens=prompt_tokens, completion_tokens=tokens, total_tokens=prompt_tokens + tokens)
+        if stream:
+            stream_options = kwargs.get('extra_body', {}).get('stream_options', {})
+            return _FakeStream(self.client, tokens, usage if stream_options.get('include_usage') else None)
+        await asyncio.sleep(self.client._first_token_latency() + tokens * self.client.token_delay)
+        return SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(content="сон " * tokens))],
+            usage=usage
+        )
+
+
+class _FakeTranscriptions:
+    def __init__(self, client):
+        self.client = client
+
+    async def create(self, model=None, file=None, **kwargs):
+        self.client.transcription_calls += 1
+        await asyncio.sleep(self.client.transcribe_latency)
+        transcript = self.client.transcript
+        return SimpleNamespace(text=transcript() if callable(transcript) else transcript)
+
+
+class FakeOpenAI:
+    """Stand-in for ``openai.AsyncOpenAI`` with configurable latency.
+
+    ``transcript`` is the text of every transcription, or a function returning the next one.
+    """
+
+    def __init__(self, latency: float = 0.5, jitter: float = 0.2, completion_tokens: int = 200,
+                 token_delay: float = 0.0, transcribe_latency: float = 0.3,
+                 transcript: str = "Мне снилось, что я летаю над морем"):
+        self.latency = latency
+        self.jitter = jitter
+        self.completion_tokens = completion_tokens
+        self.token_delay = token_delay
+        self.transcribe_latency = transcribe_latency
+        self.transcript = transcript
+        self.chat_calls = 0
+        self.transcription_calls = 0
+        self.chat = SimpleNamespace(completions=_FakeCompletions(self))
+        self.audio = SimpleNamespace(transcriptions=_FakeTranscriptions(self))
+
+    def _first_token_latency(self) -> float:
+        return self.latency + random.random() * self.jitter
+
+
+class UpdateFactory:
+    """Builds synthetic Telegram updates"""
+
+    def __init__(self, bot):
+        self.bot = bot
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self._file_ids = itertools.count(1)
+
+    def _user(self, user_id: int) -> dict:
+        return {"id": user_id, "is_bot": False, "first_name": f"User{user_id}", "language_code": "ru"}
+
+    def _message(self, user_id: int, **fields) -> dict:
+        message = {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": self._user(user_id)
+        }
+        message.update(fields)
+        return message
+
+    def _update(self, **fields) -> Update:
+        data = {"update_id": next(self._update_ids)}
+        data.update(fields)
+        return Update.de_json(data, self.bot)
+
+    def text(self, user_id: int, text: str) -> Update:
+        return self._update(message=self._message(user_id, text=text))
+
+    def command(self, user_id: int, command: str) -> Update:
+        text = f"/{command}"
+        entities = [{"type": "bot_command", "offset": 0, "length": len(text)}]
+        return self._update(message=self._message(user_id, text=text, entities=entities))
+
+    def voice(self, user_id: int, duration: int = 20) -> Update:
+        # Every voice note is a new file; a shared id would make the scheduler drop them as duplicates
+        file_number = next(self._file_ids)
+        voice = {
+            "file_id": f"voice-{user_id}-{file_number}",
+            "file_unique_id": f"voice-{user_id}-{file_number}",
+            "duration": duration,
+            "mime_type": "audio/ogg",
+            "file_size": len(FAKE_VOICE_BYTES)
+        }
+        return self._update(message=self._message(user_id, voice=voice))
+
+    def callback(self, user_id: int, data: str) -> Update:
+        message = self._message(user_id, text="menu")
+        message["from"] = BOT_USER
+        return self._update(callback_query={
+            "id": str(next(self._update_ids)),
+            "from": self._user(user_id),
+            "chat_instance": str(user_id),
+            "message": message,
+            "data": data
+        })
@@ -0,0 +1,89 @@
+"""Builds the real bot Application wired to local fakes for benchmarks."""
+import os
+import time
+import importlib
+from pathlib import Path
+from benchmarks.fakes import FakeTelegramRequest, FakeOpenAI, UpdateFactory
+from scheduler import rejected_job
+
+
+class TimedStorage:
+    """Wraps an analytics storage backend and records how long each call takes"""
+
+    def __init__(self, storage):
+        self._storage = storage
+        self.timings = {}
+
+    def __getattr__(self, name):
+        attribute = getattr(self._storage, name)
+        if not callable(attribute):
+            return attribute
+
+        def timed(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return attribute(*args, **kwargs)
+            finally:
+                self.timings.setdefault(name, []).append(time.perf_counter() - started)
+
+        return timed
+
+
+def configure_environment(workdir: str, extra: dict = None):
+    """Point all bot state at a scratch directory. Must run before ``bot`` is imported."""
+    workdir = Path(workdir)
+    workdir.mkdir(parents=True, exist_ok=True)
+    settings = {
+        'TELEGRAM_BOT_TOKEN': '123456:benchmark',
+        'OPENAI_API_KEY': 'sk-benchmark',
+        'ANALYTICS_DIR': str(workdir / 'analytics'),
+        'ANALYTICS_DB': str(workdir / 'analytics' / 'dream_analytics.db'),
+        'DREAM_HISTORY_DB': str(workdir / 'dream_history.db'),
+        'INTERPRETATION_CACHE_STATS': str(workdir / 'cache_stats.json'),
+        'INTERPRETATION_CACHE_PATH': '',
+        'WARM_SNAPSHOT_PATH': str(workdir / 'warm_state.snap'),
+        # Audio normalization needs ffmpeg and would dominate the measurements
+        'VOICE_TRIM_SILENCE': '0',
+        'VOICE_DOWNMIX': '0',
+    }
+    settings.update(extra or {})
+    for key, value in settings.items():
+        os.environ.setdefault(key, value)
+
+
+class BotHarness:
+    """The real handlers from ``bot.py`` running against fake Telegram and OpenAI backends"""
+
+    def __init__(self, openai_fake: FakeOpenAI = None, telegram_fake: FakeTelegramRequest = None):
+        self.bot = importlib.import_module('bot')
+        self.bot.init_state()
+        self.openai = openai_fake or FakeOpenAI()
+        self.telegram = telegram_fake or FakeTelegramRequest()
+        self.bot.llm.client = self.openai
+        self.storage = TimedStorage(self.bot.analytics.storage)
+        self.bot.analytics.storage = self.storage
+        self.application = self.bot.build_application(request=self.telegram)
+        self.updates = None
+
+    async def start(self):
+        await self.application.initialize()
+        if self.application.post_init:
+            await self.application.post_init(self.application)
+        self.updates = UpdateFactory(self.application.bot)
+
+    async def stop(self):
+        await self.application.shutdown()
+        if self.application.post_shutdown:
+            await self.application.post_shutdown(self.application)
+
+    async def process(self, update):
+        """Run an update through the application's update processor and the registered handlers.
+
+        Returns why the scheduler rejected the update ('duplicate', 'user' or
+        'global'), or None if it was handled.
+        """
+        rejected_job.set(None)
+        await self.application.update_processor.process_update(
+            update, self.application.process_update(update)
+        )
+        return rejected_job.get()
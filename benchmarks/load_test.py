@@ -0,0 +1,196 @@
+"""Drive many simulated users through the real bot handlers.
+
+Example:
+    python -m benchmarks.load_test --users 2000 --messages 3 --llm-latency 1.5
+
+With ``--button-p95-ms`` it exits with status 1 when a button's p95 latency
+is over that target, measured with the outbox's rate limits on. Button
+replies share Telegram's global limit with everything else, so the check
+only holds while button presses alone arrive slower than OUTBOX_GLOBAL_RATE.
+"""
+import sys
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+from benchmarks.harness import configure_environment, BotHarness
+from benchmarks.fakes import FakeOpenAI, FakeTelegramRequest
+from benchmarks.report import (
+    summarize, LoopStallMonitor, print_table, save_report, load_report, compare_reports, print_comparison
+)
+
+DREAM_TEMPLATES = [
+    "Мне снилось, что я летаю над морем и вижу огромный маяк номер {n}",
+    "Я бежал по длинному коридору, а за мной гналась тень, дверь {n} не открывалась",
+    "Снилось, что у меня выпадают зубы, и я стою перед экзаменом {n}",
+    "Я оказался в старом доме бабушки, там было {n} комнат и все были пустые",
+]
+
+
+class Scenario:
+    """Picks what each simulated user does next"""
+
+    def __init__(self, voice_share: float, button_share: float, followup_share: float, duplicate_share: float):
+        self.voice_share = voice_share
+        self.button_share = button_share
+        self.followup_share = followup_share
+        self.duplicate_share = duplicate_share
+
+    def next_action(self, rng: random.Random, user_id: int, step: int):
+        roll = rng.random()
+        if roll < self.button_share:
+            return 'button', rng.choice(['stats', 'help', 'dream_history'])
+        roll -= self.button_share
+        if roll < self.voice_share:
+            return 'voice', None
+        roll -= self.voice_share
+        if step > 0 and roll < self.followup_share:
+            return 'followup', "Почему во сне появилась вода? Поясни, пожалуйста"
+        n = rng.randint(1, 5) if rng.random() < self.duplicate_share else user_id * 1000 + step
+        return 'text', rng.choice(DREAM_TEMPLATES).format(n=n)
+
+
+async def simulate_user(harness: BotHarness, scenario: Scenario, user_id: int, messages: int,
+                        think_time: float, timings: dict, rejections: dict, rng: random.Random):
+    for step in range(messages):
+        kind, payload = scenario.next_action(rng, user_id, step)
+        if kind == 'button':
+            update = harness.updates.callback(user_id, payload)
+            kind = f"button:{payload}"
+        elif kind == 'voice':
+            update = harness.updates.voice(user_id, duration=rng.randint(5, 50))
+        else:
+            update = harness.updates.text(user_id, payload)
+
+        started = time.perf_counter()
+        rejected = await harness.process(update)
+        if rejected:
+            # A rejected update is answered at once; timing it would pass for a fast completion
+            rejections.setdefault(kind, {}).setdefault(rejected, 0)
+            rejections[kind][rejected] += 1
+        else:
+            timings.setdefault(kind, []).append(time.perf_counter() - started)
+        if think_time:
+            await asyncio.sleep(rng.random() * think_time)
+
+
+async def run(args) -> dict:
+    openai_fake = FakeOpenAI(
+        latency=args.llm_latency, jitter=args.llm_jitter, completion_tokens=args.tokens,
+        token_delay=args.token_delay, transcribe_latency=args.transcribe_latency
+    )
+    telegram_fake = FakeTelegramRequest(latency=args.telegram_latency, flood_limit=args.flood_limit)
+    harness = BotHarness(openai_fake, telegram_fake)
+    await harness.start()
+
+    scenario = Scenario(args.voice_share, args.button_share, args.followup_share, args.duplicate_share)
+    rng = random.Random(args.seed)
+    timings, rejections = {}, {}
+    monitor = LoopStallMonitor()
+    monitor.start()
+
+    started = time.perf_counter()
+    tasks = []
+    for index in range(args.users):
+        user_id = 100000 + index
+        tasks.append(asyncio.create_task(simulate_user(
+            harness, scenario, user_id, args.messages, args.think_time, timings, rejections,
+            random.Random(rng.random())
+        )))
+        # Spread arrivals over the ramp-up period
+        if args.ramp_up:
+            await asyncio.sleep(args.ramp_up / args.users)
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - started
+
+    await monitor.stop()
+    await harness.stop()
+
+    operations = sum(len(values) for values in timings.values())
+    return {
+        'config': vars(args),
+        'throughput': {
+            'operations': operations,
+            'elapsed_s': round(elapsed, 3),
+            'ops_per_s': round(operations / elapsed, 2) if elapsed else 0.0
+        },
+        'latency': {kind: summarize(values) for kind, values in sorted(timings.items())},
+        'rejected': rejections,
+        'analytics_io': {name: summarize(values) for name, values in sorted(harness.storage.timings.items())},
+        'event_loop': {'stall': monitor.summary()},
+        'dispatch_lanes': harness.application.update_processor.stats(),
+        'outbox': harness.bot.outbox.stats(),
+        'upstream_calls': {
+            'chat': openai_fake.chat_calls,
+            'transcription': openai_fake.transcription_calls,
+            'telegram': telegram_fake.calls
+        }
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Load test the dream bot handlers with local fakes")
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--messages', type=int, default=3, help="updates sent by each user")
+    parser.add_argument('--ramp-up', type=float, default=5.0, help="seconds over which users arrive")
+    parser.add_argument('--think-time', type=float, default=1.0, help="max pause between a user's updates")
+    parser.add_argument('--voice-share', type=float, default=0.4)
+    parser.add_argument('--button-share', type=float, default=0.3)
+    parser.add_argument('--followup-share', type=float, default=0.1)
+    parser.add_argument('--duplicate-share', type=float, default=0.0, help="share of repeated dream texts")
+    parser.add_argument('--llm-latency', type=float, default=1.0, help="seconds to first token")
+    parser.add_argument('--llm-jitter', type=float, default=0.5)
+    parser.add_argument('--token-delay', type=float, default=0.0, help="seconds between streamed tokens")
+    parser.add_argument('--tokens', type=int, default=200)
+    parser.add_argument('--transcribe-latency', type=float, default=0.5)
+    parser.add_argument('--telegram-latency', type=float, default=0.0)
+    parser.add_argument('--flood-limit', type=int, default=None,
+                        help="messages per chat per second before the fake Telegram answers 429")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--workdir', default=None, help="directory for analytics and history files")
+    parser.add_argument('--output', default=None, help="write the JSON report here")
+    parser.add_argument('--baseline', default=None, help="compare against a previous JSON report")
+    parser.add_argument('--tolerance', type=float, default=1.5)
+    parser.add_argument('--button-p95-ms', type=float, default=None,
+                        help="fail when a button's p95 latency is above this many ms")
+    return parser.parse_args(argv)
+
+
+def slow_buttons(latency: dict, target_ms: float) -> dict:
+    """Get the p95 of every button whose p95 latency is over the target"""
+    return {name: summary['p95_ms'] for name, summary in latency.items()
+            if name.startswith('button:') and summary['p95_ms'] > target_ms}
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    configure_environment(args.workdir or tempfile.mkdtemp(prefix='dream_bench_'))
+    report = asyncio.run(run(args))
+
+    throughput = report['throughput']
+    print(f"\n{throughput['operations']} operations in {throughput['elapsed_s']}s ({throughput['ops_per_s']} ops/s)")
+    print_table("End-to-end latency", report['latency'])
+    print_table("Analytics I/O per call", report['analytics_io'])
+    stall = report['event_loop']['stall']
+    print(f"\nEvent loop stalls: {stall['stalls']}, total {stall['total_ms']:.1f} ms, max {stall['max_ms']:.1f} ms")
+    print(f"Rejected by the scheduler (not timed): {report['rejected'] or 'none'}")
+    print(f"Dispatch lanes: {report['dispatch_lanes']}")
+    print(f"Outbox: {report['outbox']}")
+    print(f"Upstream calls: {report['upstream_calls']}")
+
+    if args.output:
+        save_report(report, args.output)
+    failed = False
+    if args.button_p95_ms:
+        for name, p95 in slow_buttons(report['latency'], args.button_p95_ms).items():
+            print(f"FAIL: {name} p95 {p95:.1f} ms is over the {args.button_p95_ms:g} ms target")
+            failed = True
+    if args.baseline:
+        failed = print_comparison(compare_reports(report, load_report(args.baseline), tolerance=args.tolerance)) or failed
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,230 @@
+"""Replay recorded production traffic through the real bot handlers, optionally sped up.
+
+Record with TRAFFIC_RECORD_PATH set on the bot, then replay the log against
+local Telegram and OpenAI stand-ins. Arrival times are kept, divided by
+``--speed``; texts are made up to match each recorded text's length, word
+count and follow-up markers, with repeated texts repeated.
+
+Example:
+    python -m benchmarks.replay traffic.ndjson.gz --speed 20 --output replay.json
+"""
+import sys
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+import itertools
+from benchmarks.harness import configure_environment, BotHarness
+from benchmarks.fakes import FakeOpenAI, FakeTelegramRequest
+from benchmarks.load_test import DREAM_TEMPLATES
+from benchmarks.report import (
+    summarize, LoopStallMonitor, print_table, save_report, load_report, compare_reports, print_comparison
+)
+from similarity import FOLLOW_UP_PHRASES
+from themes import THEME_LEXICON
+from traffic import read_recording
+
+# Replayed users get ids far from the fakes' own
+USER_ID_BASE = 100000
+
+WORDS = sorted({word for words in THEME_LEXICON.values() for word in words})
+
+
+def synthesize_text(number: int, words: int, follow_up: bool = False, question: bool = False) -> str:
+    """Make up a text of ``words`` words; the same arguments always give the same text"""
+    rng = random.Random(number)
+    if follow_up:
+        start = rng.choice(FOLLOW_UP_PHRASES).split()
+    elif question:
+        start = []
+    else:
+        start = rng.choice(DREAM_TEMPLATES).format(n=number).split()[:words]
+    text = ' '.join(start + [rng.choice(WORDS) for _ in range(max(0, words - len(start)))])
+    return text + '?' if question else text
+
+
+def schedule(events: list, speed: float, max_gap: float = None) -> list:
+    """Get ``(offset_seconds, event)`` pairs, with idle gaps capped at ``max_gap`` recorded seconds"""
+    timeline, offset, previous = [], 0.0, None
+    for event in events:
+        if previous is not None:
+            gap = event['t'] - previous
+            offset += min(gap, max_gap) if max_gap is not None else gap
+        previous = event['t']
+        timeline.append((offset / speed, event))
+    return timeline
+
+
+class Replayer:
+    """Turns recorded events into updates for the harness's bot"""
+
+    def __init__(self, harness: BotHarness):
+        self.harness = harness
+        self.skipped = 0
+
+    def _dream_id(self, user_id: int, age: int) -> int:
+        latest = self.harness.bot.dream_history.latest(user_id)
+        return max(1, (latest.id if latest else 1) - age)
+
+    def update_for(self, event: dict):
+        """Build the update for an event, or None for kinds the bot does not handle"""
+        updates = self.harness.updates
+        user_id = USER_ID_BASE + event['user']
+        kind = event['k']
+        if kind == 'text':
+            return updates.text(user_id, synthesize_text(event['d'], event['w'], event['f'], event['q']))
+        if kind == 'voice':
+            return updates.voice(user_id, duration=event['s'])
+        if kind == 'command':
+            return updates.command(user_id, event['c'])
+        if kind == 'callback':
+            data = event['c']
+            if 'a' in event:
+                # Buttons of users whose history was not in memory when recorded go to the latest dream
+                data = f"{data}{self._dream_id(user_id, event['a'] or 0)}"
+            return updates.callback(user_id, data)
+        self.skipped += 1
+        return None
+
+
+def operation(event: dict) -> str:
+    """Name an event for the latency table, e.g. 'text', 'button:stats', 'button:show_dream'"""
+    if event['k'] == 'callback':
+        return f"button:{event['c'].rstrip('_0123456789') or 'other'}"
+    if event['k'] == 'command':
+        return f"command:{event['c']}"
+    return event['k']
+
+
+async def run(args, events: list) -> dict:
+    transcripts = itertools.count(1)
+    openai_fake = FakeOpenAI(
+        latency=args.llm_latency, jitter=args.llm_jitter, completion_tokens=args.tokens,
+        token_delay=args.token_delay, transcribe_latency=args.transcribe_latency,
+        # Every voice note says something new, about 2 words per second
+        transcript=lambda: synthesize_text(-next(transcripts), 40)
+    )
+    telegram_fake = FakeTelegramRequest(latency=args.telegram_latency, flood_limit=args.flood_limit)
+    harness = BotHarness(openai_fake, telegram_fake)
+    await harness.start()
+    replayer = Replayer(harness)
+
+    timings, rejections, lags, tasks = {}, {}, [], []
+    monitor = LoopStallMonitor()
+    monitor.start()
+
+    async def timed(name: str, update):
+        started = time.perf_counter()
+        rejected = await harness.process(update)
+        if rejected:
+            # A rejected update is answered at once; timing it would pass for a fast completion
+            rejections.setdefault(name, {}).setdefault(rejected, 0)
+            rejections[name][rejected] += 1
+        else:
+            timings.setdefault(name, []).append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    for offset, event in schedule(events, args.speed, args.max_gap):
+        delay = offset - (time.perf_counter() - started)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        # How late the update is sent shows whether the replay itself keeps up
+        lags.append(max(0.0, -delay))
+        update = replayer.update_for(event)
+        if update is not None:
+            tasks.append(asyncio.create_task(timed(operation(event), update)))
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - started
+
+    await monitor.stop()
+    await harness.stop()
+
+    operations = sum(len(values) for values in timings.values())
+    return {
+        'config': {name: value for name, value in vars(args).items() if name != 'recordings'},
+        'throughput': {
+            'operations': operations,
+            'skipped': replayer.skipped,
+            'recorded_s': round(events[-1]['t'] - events[0]['t'], 3) if events else 0.0,
+            'elapsed_s': round(elapsed, 3),
+            'ops_per_s': round(operations / elapsed, 2) if elapsed else 0.0
+        },
+        'latency': {name: summarize(values) for name, values in sorted(timings.items())},
+        'rejected': rejections,
+        'dispatch': {'lag': summarize(lags)},
+        'event_loop': {'stall': monitor.summary()},
+        'dispatch_lanes': harness.application.update_processor.stats(),
+        'outbox': harness.bot.outbox.stats(),
+        'upstream_calls': {
+            'chat': openai_fake.chat_calls,
+            'transcription': openai_fake.transcription_calls,
+            'telegram': telegram_fake.calls
+        }
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Replay recorded traffic through the dream bot handlers")
+    parser.add_argument('recordings', nargs='+', help="logs written with TRAFFIC_RECORD_PATH (one per worker)")
+    parser.add_argument('--speed', type=float, default=1.0, help="time acceleration, 1 to 100")
+    parser.add_argument('--max-gap', type=float, default=None, help="cap idle gaps at this many recorded seconds")
+    parser.add_argument('--limit', type=int, default=None, help="replay only the first N events")
+    parser.add_argument('--llm-latency', type=float, default=1.0, help="seconds to first token")
+    parser.add_argument('--llm-jitter', type=float, default=0.5)
+    parser.add_argument('--token-delay', type=float, default=0.0, help="seconds between streamed tokens")
+    parser.add_argument('--tokens', type=int, default=200)
+    parser.add_argument('--transcribe-latency', type=float, default=0.5)
+    parser.add_argument('--telegram-latency', type=float, default=0.0)
+    parser.add_argument('--flood-limit', type=int, default=None,
+                        help="messages per chat per second before the fake Telegram answers 429")
+    parser.add_argument('--workdir', default=None, help="directory for analytics and history files")
+    parser.add_argument('--output', default=None, help="write the JSON report here")
+    parser.add_argument('--baseline', default=None, help="compare against a previous JSON report")
+    parser.add_argument('--tolerance', type=float, default=1.5)
+    args = parser.parse_args(argv)
+    if not 1 <= args.speed <= 100:
+        parser.error("--speed must be between 1 and 100")
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    events = read_recording(args.recordings)[:args.limit]
+    if not events:
+        sys.exit("No recorded events to replay")
+    configure_environment(args.workdir or tempfile.mkdtemp(prefix='dream_replay_'))
+    recorded = events[-1]['t'] - events[0]['t']
+    print(f"Replaying {len(events)} events recorded over {recorded:.0f}s at {args.speed:g}x")
+    report = asyncio.run(run(args, events))
+
+    throughput = report['throughput']
+    print(f"\n{throughput['operations']} operations in {throughput['elapsed_s']}s ({throughput['ops_per_s']} ops/s), "
+          f"{throughput['skipped']} skipped")
+    print_table("End-to-end latency", report['latency'])
+    print_table("Dispatch", report['dispatch'])
+    stall = report['event_loop']['stall']
+    print(f"\nEvent loop stalls: {stall['stalls']}, total {stall['total_ms']:.1f} ms, max {stall['max_ms']:.1f} ms")
+    print(f"Rejected by the scheduler (not timed): {report['rejected'] or 'none'}")
+    print(f"Dispatch lanes: {report['dispatch_lanes']}")
+    print(f"Outbox: {report['outbox']}")
+    print(f"Upstream calls: {report['upstream_calls']}")
+
+    if args.output:
+        save_report(report, args.output)
+    if args.baseline:
+        baseline = load_report(args.baseline)
+        regressed = print_comparison(compare_reports(report, baseline, tolerance=args.tolerance))
+        # Throughput regresses when it drops, unlike latencies
+        old = baseline.get('throughput', {}).get('ops_per_s')
+        if old:
+            ratio = throughput['ops_per_s'] / old
+            marker = "  REGRESSION" if ratio < 1 / args.tolerance else ""
+            print(f"  {'throughput/ops_per_s':<48}{old:>11.2f}{throughput['ops_per_s']:>11.2f}{ratio:>8.2f}x{marker}")
+            regressed = regressed or bool(marker)
+        if regressed:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
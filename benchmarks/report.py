@@ -0,0 +1,114 @@
+"""Helpers for summarizing benchmark measurements and comparing runs."""
+import json
+import math
+import time
+import asyncio
+from pathlib import Path
+
+
+def percentile(values: list, pct: float) -> float:
+    """Get a percentile (0-100) of a list of numbers using nearest-rank"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, math.ceil(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def summarize(values: list) -> dict:
+    """Summarize durations in seconds as milliseconds"""
+    return {
+        'count': len(values),
+        'mean_ms': round(sum(values) / len(values) * 1000, 3) if values else 0.0,
+        'p50_ms': round(percentile(values, 50) * 1000, 3),
+        'p95_ms': round(percentile(values, 95) * 1000, 3),
+        'p99_ms': round(percentile(values, 99) * 1000, 3),
+        'max_ms': round(max(values) * 1000, 3) if values else 0.0,
+        'total_ms': round(sum(values) * 1000, 3)
+    }
+
+
+class LoopStallMonitor:
+    """Measures how long the event loop is blocked by synchronous work.
+
+    A task sleeps for a short interval in a loop; any time it wakes up later
+    than requested is time the loop could not run anything else.
+    """
+
+    def __init__(self, interval: float = 0.01):
+        self.interval = interval
+        self.stalls = []
+        self._task = None
+
+    async def _run(self):
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            overshoot = time.perf_counter() - started - self.interval
+            if overshoot > 0.001:
+                self.stalls.append(overshoot)
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+
+    def summary(self) -> dict:
+        summary = summarize(self.stalls)
+        summary['stalls'] = summary.pop('count')
+        return summary
+
+
+def print_table(title: str, rows: dict):
+    """Print ``{name: summary}`` as an aligned table"""
+    print(f"\n{title}")
+    print(f"  {'operation':<32}{'count':>8}{'p50 ms':>11}{'p95 ms':>11}{'p99 ms':>11}{'max ms':>11}")
+    for name, summary in rows.items():
+        print(
+            f"  {name:<32}{summary['count']:>8}{summary['p50_ms']:>11.2f}{summary['p95_ms']:>11.2f}"
+            f"{summary['p99_ms']:>11.2f}{summary['max_ms']:>11.2f}"
+        )
+
+
+def save_report(report: dict, path: str):
+    Path(path).write_text(json.dumps(report, ensure_ascii=False, indent=2), encoding='utf-8')
+
+
+def load_report(path: str) -> dict:
+    return json.loads(Path(path).read_text(encoding='utf-8'))
+
+
+def compare_reports(current: dict, baseline: dict, metric: str = 'p95_ms', tolerance: float = 1.5) -> list:
+    """Compare ``{section: {name: summary}}`` reports.
+
+    Returns ``(section, name, baseline, current, ratio, regressed)`` rows for
+    every operation present in both runs; ``regressed`` is set when the ratio
+    exceeds ``tolerance``.
+    """
+    rows = []
+    for section, entries in current.items():
+        if not isinstance(entries, dict) or section not in baseline:
+            continue
+        for name, summary in entries.items():
+            old = baseline[section].get(name)
+            if not isinstance(summary, dict) or not isinstance(old, dict) or metric not in summary or metric not in old:
+                continue
+            ratio = summary[metric] / old[metric] if old[metric] else 1.0
+            rows.append((section, name, old[metric], summary[metric], ratio, ratio > tolerance))
+    return rows
+
+
+def print_comparison(rows: list, metric: str = 'p95_ms') -> bool:
+    """Print a comparison table; returns True if any regression was found"""
+    print(f"\nComparison against baseline ({metric})")
+    regressed = False
+    for section, name, old, new, ratio, is_regression in rows:
+        marker = "  REGRESSION" if is_regression else ""
+        regressed = regressed or is_regression
+        print(f"  {section + '/' + name:<48}{old:>11.2f}{new:>11.2f}{ratio:>8.2f}x{marker}")
+    return regressed
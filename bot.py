@@ -1,13 +1,32 @@
+from __future__ import annotations
+
 import os
+import time
+import asyncio
 import logging
+import contextlib
+import threading
 from pathlib import Path
+from typing import TYPE_CHECKING
 from dotenv import load_dotenv
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, MessageHandler, ContextTypes, filters, CallbackQueryHandler
-import openai
-from analytics import DreamAnalytics
+from telegram.error import BadRequest
+from llm import LLMPool, CircuitOpenError
+from streaming import MessageStreamer, MAX_MESSAGE_LENGTH
+from voice import VoicePipeline, OpenAITranscriber
+from cache import InterpretationCache, normalize_text
+from scheduler import UserScheduler
+from prompts import PromptBuilder, PROMPT_VERSION, count_tokens
+from outbox import Outbox
+import metrics
 from datetime import datetime
 
+# telegram.ext, the stores (numpy via the similarity index) and the warm-state modules are imported
+# by init_state() and build_application(), off the import path of the webhook front process and
+# of the workers' spawn bootstrap; the handlers only need the telegram types
+if TYPE_CHECKING:
+    from telegram.ext import Application, ContextTypes
+
 # Load environment variables
 load_dotenv()
 
@@ -18,12 +37,178 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# Initialize OpenAI client and analytics
-client = openai.OpenAI(api_key=os.getenv('OPENAI_API_KEY'))
-analytics = DreamAnalytics()
+def create_openai_client():
+    """Create the OpenAI client; openai is imported here, off the startup path"""
+    import openai
+    # Retries are done by LLMPool behind its circuit breaker, not by the client
+    return openai.AsyncOpenAI(api_key=os.getenv('OPENAI_API_KEY'), max_retries=0)
+
+# Per-process state, created by init_state() in the process that serves updates, so importing
+# this module (a webhook front process, or a worker's spawn bootstrap) opens and loads nothing
+llm = None
+voice_pipeline = None
+analytics = None
+dream_history = None
+similarity_index = None
+interpretation_cache = None
+outbox = None
+traffic_recorder = None
+WARM_SNAPSHOT_PATH = None
+
+# One interpretation at a time per user, with a global cap on pending work; the handlers are
+# wrapped by it when they are defined, and it holds nothing until updates arrive
+scheduler = UserScheduler()
+metrics.REGISTRY.register(metrics.Gauge(
+    "dream_bot_scheduler_pending", "Interpretations running or waiting for their user's turn"
+)).set_function(lambda: scheduler.pending)
+
+# Dream a user chose to ask about with the follow-up button
+followup_focus = {}  # Format: {user_id: dream_id}
+
+# Token-budgeted prompts with a fixed system prefix
+prompt_builder = PromptBuilder()
+
+# Stream GPT responses into the "processing" message as they are generated
+STREAM_RESPONSES = os.getenv('STREAM_RESPONSES', '1') == '1'
+
+def init_state():
+    """Create the clients, stores and queues the handlers use; later calls do nothing."""
+    global llm, voice_pipeline, analytics, dream_history, similarity_index, interpretation_cache
+    global outbox, traffic_recorder, WARM_SNAPSHOT_PATH
+    if analytics is not None:
+        return
+    from analytics import DreamAnalytics
+    from history import DreamHistory
+    from similarity import SimilarityIndex
+    from snapshot import default_snapshot_path
+    from traffic import TrafficRecorder
+
+    # Initialize OpenAI client and analytics
+    llm = LLMPool(client_factory=create_openai_client)
+    metrics.REGISTRY.register(metrics.Gauge(
+        "dream_bot_openai_pool", "OpenAI calls waiting for a slot or in flight", ("state",)
+    )).set_function(lambda: {("waiting",): llm.waiting, ("in_flight",): llm.in_flight})
+    voice_pipeline = VoicePipeline(OpenAITranscriber(llm))
+    analytics = DreamAnalytics()
+
+    # Persistent store of user's dreams context
+    dream_history = DreamHistory()
+    metrics.REGISTRY.register(metrics.Gauge(
+        "dream_bot_history_memory_bytes", "Approximate memory held by users' recent dreams"
+    )).set_function(lambda: dream_history.memory)
+    metrics.REGISTRY.register(metrics.Gauge(
+        "dream_bot_history_users", "Users whose recent dreams are loaded in memory"
+    )).set_function(lambda: dream_history.stats()["users"])
+
+    # Vectors of stored dreams for follow-up context and "similar dreams"
+    similarity_index = SimilarityIndex()
+
+    # Cache of interpretations for new dreams
+    interpretation_cache = InterpretationCache()
+
+    # Quota counters, recent dreams and cached interpretations are kept across restarts
+    WARM_SNAPSHOT_PATH = default_snapshot_path()
+
+    # Outgoing messages are queued per chat and sent within Telegram's rate limits
+    outbox = Outbox()
+    metrics.REGISTRY.register(metrics.Gauge(
+        "dream_bot_outbox_queued", "Outgoing Telegram calls waiting in the send queues"
+    )).set_function(lambda: outbox.queued)
+
+    # Anonymized log of incoming updates for replaying real traffic (only with TRAFFIC_RECORD_PATH set)
+    traffic_recorder = TrafficRecorder(latest_dream_id=dream_history.cached_latest_id)
+
+# Buttons that read the user's stored dreams
+DREAM_BUTTONS = ("dream_history", "history_page_", "show_dream_", "ask_followup_", "similar_")
+
+# Dreams shown on one page of the history message
+HISTORY_PAGE_SIZE = int(os.getenv('HISTORY_PAGE_SIZE', '5'))
+
+BUSY_MESSAGE = (
+    "🌙 Сейчас ко мне пришло очень много снов, и я не успеваю за всеми. "
+    "Пожалуйста, попробуй отправить свой сон через пару минут! ✨"
+)
+
+def answering_fast_lane() -> bool:
+    """Whether the current handler answers a button or a command, whose sends skip queued dream replies."""
+    from lanes import FAST_LANE, current_lane
+    return current_lane.get() == FAST_LANE
 
-# Dictionary to store user's dreams context
-user_dreams = {}  # Format: {user_id: [{"dream": text, "interpretation": text, "timestamp": datetime, "id": int}, ...]}
+async def reply(message, text: str, **kwargs):
+    """Reply to a message through the outbox."""
+    return await outbox.send(
+        message.chat_id, lambda: message.reply_text(text, **kwargs), kind='reply', urgent=answering_fast_lane()
+    )
+
+async def edit(message, text: str, **kwargs):
+    """Edit a sent message through the outbox; a newer edit of the same message replaces a queued one."""
+    try:
+        return await outbox.send(
+            message.chat_id, lambda: message.edit_text(text, **kwargs), kind='edit', key=('edit', message.message_id),
+            urgent=answering_fast_lane()
+        )
+    except BadRequest as e:
+        # Repeated taps can ask for the text the message already has
+        if "not modified" not in str(e).lower():
+            raise
+        return None
+
+async def reply_busy(update: Update, context: ContextTypes.DEFAULT_TYPE, reason: str):
+    """Answer a message the scheduler did not admit."""
+    metrics.ERRORS.inc(type=f'rejected_{reason}')
+    if reason == 'duplicate':
+        # The same dream is already being interpreted
+        return
+    if reason == 'user':
+        await reply(
+            update.message,
+            "⏳ Я ещё разбираюсь с твоими предыдущими снами. "
+            "Дождись толкования, и потом присылай следующий! 😊"
+        )
+        return
+    await reply(update.message, BUSY_MESSAGE)
+
+async def reject_update(update: object):
+    """Answer a dream the worker lane had no room for."""
+    if isinstance(update, Update) and update.effective_message:
+        await reply(update.effective_message, BUSY_MESSAGE)
+
+def render_history_page(dreams: list, page: int):
+    """Render one page of the dream history as a single message with page buttons.
+
+    Returns the text and keyboard of the page, newest dreams first.
+    """
+    dreams = list(reversed(dreams))
+    pages = (len(dreams) + HISTORY_PAGE_SIZE - 1) // HISTORY_PAGE_SIZE
+    page = max(0, min(page, pages - 1))
+    start = page * HISTORY_PAGE_SIZE
+
+    blocks = []
+    keyboard = []
+    for number, dream in enumerate(dreams[start:start + HISTORY_PAGE_SIZE], start + 1):
+        date = dream['timestamp'].strftime('%d.%m.%Y')
+        dream_preview = dream['dream'][:150] + "..." if len(dream['dream']) > 150 else dream['dream']
+        interpretation_preview = dream['interpretation'][:150] + "..." if len(dream['interpretation']) > 150 else dream['interpretation']
+        blocks.append(
+            f"{number}. 🌟 {date}\n"
+            f"💭 Ваш сон:\n{dream_preview}\n"
+            f"✨ Толкование:\n{interpretation_preview}"
+        )
+        keyboard.append([InlineKeyboardButton(
+            f"📖 {number}. Показать полностью ({date})", callback_data=f"show_dream_{dream['id']}"
+        )])
+
+    navigation = []
+    if page > 0:
+        navigation.append(InlineKeyboardButton("◀️ Новее", callback_data=f"history_page_{page - 1}"))
+    if page < pages - 1:
+        navigation.append(InlineKeyboardButton("Старше ▶️", callback_data=f"history_page_{page + 1}"))
+    if navigation:
+        keyboard.append(navigation)
+
+    header = "📖 История снов" + (f" (страница {page + 1} из {pages})" if pages > 1 else "") + ":\n\n"
+    text = header + "\n\n".join(blocks)
+    return text[:MAX_MESSAGE_LENGTH], InlineKeyboardMarkup(keyboard)
 
 def get_main_keyboard():
     """Get the main menu keyboard."""
@@ -38,6 +223,7 @@ def get_main_keyboard():
     ]
     return InlineKeyboardMarkup(keyboard)
 
+@metrics.timed_handler('command')
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Send a message when the command /start is issued."""
     welcome_message = (
@@ -48,8 +234,9 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "✍️ Написать свой сон текстом\n\n"
         "Я проанализирую его и расскажу, что он может значить. 🌙✨"
     )
-    await update.message.reply_text(welcome_message, reply_markup=get_main_keyboard())
+    await reply(update.message, welcome_message, reply_markup=get_main_keyboard())
 
+@metrics.timed_handler('command')
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Send a message when the command /help is issued."""
     help_text = (
@@ -57,108 +244,139 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "Напиши создателю бота — @ArtemyPak\n"
         "Буду рад обратной связи! ✨"
     )
-    await update.message.reply_text(help_text)
+    await reply(update.message, help_text)
 
+@metrics.timed_handler('voice')
+@scheduler.serialized(
+    key=lambda update: f"voice:{update.message.voice.file_unique_id}", on_overload=reply_busy
+)
 async def handle_voice(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle voice messages."""
     try:
-        # Download the voice message
         voice_file = await update.message.voice.get_file()
-        voice_path = f"temp_voice_{update.message.from_user.id}.ogg"
-        await voice_file.download_to_drive(voice_path)
 
         # Inform user that processing has started
-        await update.message.reply_text("🤔 Разбираюсь в твоём сне… Дай мне секундочку! 😊")
+        await reply(update.message, "🤔 Разбираюсь в твоём сне… Дай мне секундочку! 😊")
 
-        # Transcribe the voice message using Whisper API
-        with open(voice_path, "rb") as audio_file:
-            transcript = client.audio.transcriptions.create(
-                model="whisper-1",
-                file=audio_file
-            )
+        # Download the voice message into memory
+        with metrics.span('voice_download'):
+            audio = await voice_pipeline.download(voice_file)
 
-        # Remove the temporary voice file
-        os.remove(voice_path)
+        # Transcribe the voice message using Whisper API
+        with metrics.span('transcription'):
+            transcript = await voice_pipeline.transcribe_bytes(audio, duration=update.message.voice.duration)
 
         # Process the transcribed text
-        await process_dream(update, transcript.text, message_type='voice')
+        await process_dream(update, transcript, message_type='voice')
+
+    except CircuitOpenError:
+        await reply(update.message, BUSY_MESSAGE)
 
     except Exception as e:
         logger.error(f"Error processing voice message: {str(e)}")
         analytics.log_error('voice_processing', str(e))
-        await update.message.reply_text(
+        await reply(
+            update.message,
             "❌ Ой, что-то пошло не так при обработке… Попробуй отправить сон в виде текста!"
         )
 
+@metrics.timed_handler('text')
+@scheduler.serialized(key=lambda update: f"text:{normalize_text(update.message.text)}", on_overload=reply_busy)
 async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle text messages."""
     await process_dream(update, update.message.text, message_type='text')
 
+@metrics.timed_handler('callback')
 async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle button presses."""
     query = update.callback_query
     await query.answer()  # Answer the callback query to remove the loading state
     
     user_id = str(query.from_user.id)
+    if query.data.startswith(DREAM_BUTTONS):
+        # History reads only look in memory; a user who is not there is read from the database in a thread
+        await dream_history.load_user(user_id)
     
-    if query.data == "dream_history":
-        if user_id not in user_dreams or not user_dreams[user_id]:
-            await query.message.reply_text(
+    if query.data == "dream_history" or query.data.startswith("history_page_"):
+        dreams = dream_history.get_dreams(user_id)
+        if not dreams:
+            await reply(
+                query.message,
                 "У вас пока нет сохранённых снов. Расскажите мне свой сон, "
                 "и я помогу вам разобраться в его значении! 🌙"
             )
             return
+
+        # The whole history is one message; page buttons edit it in place
+        if query.data == "dream_history":
+            history_text, reply_markup = render_history_page(dreams, 0)
+            await reply(query.message, history_text, reply_markup=reply_markup)
+        else:
+            history_text, reply_markup = render_history_page(dreams, int(query.data.rsplit("_", 1)[1]))
+            await edit(query.message, history_text, reply_markup=reply_markup)
+    
+    elif query.data.startswith("show_dream_"):
+        dream_id = int(query.data.split("_")[2])
+        dream = dream_history.get(user_id, dream_id)
+        if dream:
+            full_text = (
+                f"🌟 {dream['timestamp'].strftime('%d.%m.%Y')}\n\n"
+                f"💭 Ваш сон:\n{dream['dream']}\n\n"
+                f"✨ Полное толкование:\n{dream['interpretation']}"
+            )
             
-        for dream in reversed(user_dreams[user_id]):
-            date = dream['timestamp'].strftime('%d.%m.%Y')
-            dream_preview = dream['dream'][:150] + "..." if len(dream['dream']) > 150 else dream['dream']
-            interpretation_preview = dream['interpretation'][:150] + "..." if len(dream['interpretation']) > 150 else dream['interpretation']
-            
-            keyboard = [[InlineKeyboardButton("📖 Показать полностью", callback_data=f"show_dream_{dream['id']}")]]
+            # Create keyboard with options after showing full dream
+            keyboard = [
+                [InlineKeyboardButton("❓ Задать уточняющий вопрос", callback_data=f"ask_followup_{dream_id}")],
+                [InlineKeyboardButton("🔎 Похожие сны", callback_data=f"similar_{dream_id}")],
+                [InlineKeyboardButton("📖 Вернуться к истории снов", callback_data="dream_history")],
+                [InlineKeyboardButton("📊 Моя статистика", callback_data="stats")]
+            ]
             reply_markup = InlineKeyboardMarkup(keyboard)
             
-            history_text = (
-                f"🌟 {date}\n\n"
-                f"💭 Ваш сон:\n{dream_preview}\n\n"
-                f"✨ Толкование:\n{interpretation_preview}"
+            await reply(query.message, full_text, reply_markup=reply_markup)
+        else:
+            await reply(
+                query.message,
+                "Этот сон больше не хранится в истории. Откройте «📖 История снов», чтобы увидеть последние сны."
             )
-            
-            await query.message.reply_text(history_text, reply_markup=reply_markup)
-    
-    elif query.data.startswith("show_dream_"):
-        dream_id = int(query.data.split("_")[2])
-        for dream in user_dreams[user_id]:
-            if dream['id'] == dream_id:
-                full_text = (
-                    f"🌟 {dream['timestamp'].strftime('%d.%m.%Y')}\n\n"
-                    f"💭 Ваш сон:\n{dream['dream']}\n\n"
-                    f"✨ Полное толкование:\n{dream['interpretation']}"
-                )
-                
-                # Create keyboard with options after showing full dream
-                keyboard = [
-                    [InlineKeyboardButton("❓ Задать уточняющий вопрос", callback_data=f"ask_followup_{dream_id}")],
-                    [InlineKeyboardButton("📖 Вернуться к истории снов", callback_data="dream_history")],
-                    [InlineKeyboardButton("📊 Моя статистика", callback_data="stats")]
-                ]
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                
-                await query.message.reply_text(full_text, reply_markup=reply_markup)
-                break
     
     elif query.data.startswith("ask_followup_"):
         dream_id = int(query.data.split("_")[2])
-        for dream in user_dreams[user_id]:
-            if dream['id'] == dream_id:
-                await query.message.reply_text(
-                    "💭 Задайте свой вопрос об этом сне, и я постараюсь дать более подробное толкование.\n\n"
-                    "Например:\n"
-                    "• Что символизирует [определенный символ]?\n"
-                    "• Почему во сне появился [элемент сна]?\n"
-                    "• Можешь объяснить значение [часть сна]?"
-                )
-                break
+        if dream_history.get(user_id, dream_id):
+            followup_focus[user_id] = dream_id
+            await reply(
+                query.message,
+                "💭 Задайте свой вопрос об этом сне, и я постараюсь дать более подробное толкование.\n\n"
+                "Например:\n"
+                "• Что символизирует [определенный символ]?\n"
+                "• Почему во сне появился [элемент сна]?\n"
+                "• Можешь объяснить значение [часть сна]?"
+            )
     
+    elif query.data.startswith("similar_"):
+        dream_id = int(query.data.split("_")[1])
+        dream = dream_history.get(user_id, dream_id)
+        similar = similarity_index.similar(user_id, dream, dream_history.get_dreams(user_id)) if dream else []
+        if not similar:
+            await reply(
+                query.message,
+                "Похожих снов в истории пока нет. Чем больше снов вы расскажете, тем больше связей я смогу найти! 🌙"
+            )
+            return
+
+        keyboard = [
+            [InlineKeyboardButton(
+                f"🌟 {other['timestamp'].strftime('%d.%m.%Y')}: {other['dream'][:40]}",
+                callback_data=f"show_dream_{other['id']}"
+            )]
+            for _, other in similar
+        ]
+        await reply(
+            query.message,
+            "🔎 Сны, похожие на этот:", reply_markup=InlineKeyboardMarkup(keyboard)
+        )
+
     elif query.data == "help":
         help_text = (
             "🤔 Как пользоваться ботом:\n\n"
@@ -171,9 +389,10 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             "• Задавайте вопросы о конкретных символах\n\n"
             "❓ Есть вопросы? Напишите создателю бота — @ArtemyPak"
         )
-        await query.message.reply_text(help_text)
+        await reply(query.message, help_text)
     
     elif query.data == "stats":
+        await analytics.load_quota(int(user_id))
         usage = analytics.get_user_monthly_usage(int(user_id))
         remaining = 20 - usage['total_dreams']
         remaining_days = 30 - datetime.now().day
@@ -186,27 +405,73 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             f"🌟 Всего снов: {usage['total_dreams']}\n\n"
             f"ℹ️ Лимит обновится через {remaining_days} дней"
         )
-        await query.message.reply_text(stats_text)
+        await reply(query.message, stats_text)
+
+async def generate_interpretation(messages: list, prompt_tokens: int, processing_message, header: str):
+    """Get the GPT-4 interpretation, streaming it into the processing message if enabled.
+
+    Returns the interpretation text and the token usage:
+    ``{'prompt_tokens': int, 'completion_tokens': int}``.
+    """
+    if not STREAM_RESPONSES:
+        with metrics.span('llm'):
+            response = await llm.chat(
+                model="gpt-4",
+                messages=messages,
+                max_tokens=600,
+                temperature=0.6
+            )
+        usage = {'prompt_tokens': response.usage.prompt_tokens, 'completion_tokens': response.usage.completion_tokens}
+        return response.choices[0].message.content, usage
+
+    streamer = MessageStreamer(processing_message, header, outbox=outbox)
+    usage = {}
+    first_token = True
+    stream = llm.stream_chat(
+        usage=usage,
+        model="gpt-4",
+        messages=messages,
+        max_tokens=600,
+        temperature=0.6
+    )
+    # Closed as soon as the loop exits, so a failed edit releases the pool slot and the HTTP stream at once
+    async with contextlib.aclosing(stream):
+        with metrics.span('llm'):
+            started = time.perf_counter()
+            async for delta in stream:
+                if first_token:
+                    first_token = False
+                    metrics.STAGE_SECONDS.observe(time.perf_counter() - started, stage='llm_first_token')
+                await streamer.push(delta)
+
+    if not usage:
+        # The API did not report usage; count the reply the way the prompt was counted when it was built
+        usage = {'prompt_tokens': prompt_tokens, 'completion_tokens': count_tokens(streamer.text)}
+    return streamer.text, usage
 
 async def process_dream(update: Update, dream_text: str, message_type: str = 'text'):
     """Process the dream text and generate an interpretation."""
+    slot_reserved = False
     try:
         user_id = str(update.effective_user.id)
         
-        # Initialize user's dream history if not exists
-        if user_id not in user_dreams:
-            user_dreams[user_id] = []
-        
-        # Check if this is a follow-up question
-        is_follow_up = any(keyword in dream_text.lower() for keyword in [
-            'почему', 'что значит', 'можешь объяснить', 'расскажи подробнее', 
-            'что это значит', 'как это понимать', 'уточни', 'расскажи', 'поясни'
-        ])
-
-        # Check monthly limit before processing
-        if not analytics.check_monthly_limit(update.effective_user.id, message_type):
+        # Check if this is a follow-up question about one of the stored dreams
+        await dream_history.load_user(user_id)
+        stored_dreams = dream_history.get_dreams(user_id)
+        focus_id = followup_focus.pop(user_id, None)
+        is_follow_up = (
+            (focus_id is not None and dream_history.get(user_id, focus_id) is not None)
+            or similarity_index.is_follow_up(user_id, dream_text, stored_dreams)
+        )
+
+        # Reserve one of the monthly interpretations before processing; right after a cold start
+        # the counters may still be loading, and looking the user up must not block the event loop
+        await analytics.load_quota(update.effective_user.id)
+        slot_reserved = analytics.reserve_slot(update.effective_user.id)
+        if not slot_reserved:
             remaining_days = 30 - datetime.now().day
-            await update.message.reply_text(
+            await reply(
+                update.message,
                 "🌙 Вы достигли месячного лимита интерпретаций (20 снов).\n"
                 f"Новые интерпретации будут доступны через {remaining_days} дней.\n\n"
                 "Спасибо, что пользуетесь ботом! ✨"
@@ -214,59 +479,41 @@ async def process_dream(update: Update, dream_text: str, message_type: str = 'te
             return
 
         # Inform user that interpretation is in progress
-        processing_message = await update.message.reply_text(
+        processing_message = await reply(
+            update.message,
             "🤔 Разбираюсь в твоём сне… Дай мне секундочку! 😊"
         )
 
-        messages = [
-            {"role": "system", "content": """Ты толкователь снов, который сочетает психологические знания с пониманием символов и архетипов. Твои интерпретации должны быть понятными, глубокими и увлекательными. Отвечай мягко и поддерживающе, помогая человеку осознать возможные значения сна, но не навязывая однозначных выводов.
-
-**Структура ответа для нового сна:**
-1. Начни с краткого пересказа ключевых моментов сна (1-2 предложения)
-2. Выдели 2-3 главных символа или темы
-3. Объясни возможные значения этих символов
-4. Свяжи толкование с текущей жизненной ситуацией человека
-5. Заверши позитивным наблюдением или инсайтом
-
-**Структура ответа для уточняющих вопросов:**
-1. Сфокусируйся на конкретном аспекте или символе, о котором спрашивает человек
-2. Дай более глубокое толкование этого аспекта
-3. Свяжи его с общим контекстом сна
-
-**Стиль общения:**
-- Используй дружелюбный, но уважительный тон
-- Избегай категоричных утверждений, используй фразы "возможно", "это может означать", "часто символизирует"
-- Не давай советов по действиям в реальной жизни
-- Фокусируйся на эмоциональном и символическом значении"""}
-        ]
-
-        # Add context from previous dream if this is a follow-up question
-        if is_follow_up and user_dreams[user_id]:
-            last_dream = user_dreams[user_id][-1]  # Get the most recent dream
-            messages.extend([
-                {"role": "user", "content": f"Вот мой сон: {last_dream['dream']}"},
-                {"role": "assistant", "content": last_dream['interpretation']},
-                {"role": "user", "content": dream_text}
-            ])
+        # Add context from the most relevant previous dreams if this is a follow-up question
+        if is_follow_up:
+            context = similarity_index.select_context(
+                user_id, dream_text, stored_dreams, focus_id, cost=prompt_builder.context_cost
+            )
+            messages, prompt_tokens = prompt_builder.follow_up(dream_text, context)
         else:
-            messages.append({"role": "user", "content": f"Пожалуйста, помоги разобраться в значении этого сна: {dream_text}"})
-
-        # Generate dream interpretation using GPT-4
-        response = client.chat.completions.create(
-            model="gpt-4",
-            messages=messages,
-            max_tokens=600,
-            temperature=0.6
-        )
-
-        interpretation = response.choices[0].message.content
+            messages, prompt_tokens = prompt_builder.new_dream(dream_text)
 
         # Get current date in Russian format
         current_date = datetime.now().strftime('%d.%m.%Y')
-        
-        # Get user's remaining interpretations for the month
-        usage = analytics.get_user_monthly_usage(update.effective_user.id)
-        remaining = 20 - usage["total_dreams"]
+        header = f"✨ Толкование сна ({current_date}):\n\n"
+
+        # Generate dream interpretation using GPT-4
+        if is_follow_up:
+            interpretation, usage = await generate_interpretation(messages, prompt_tokens, processing_message, header)
+        else:
+            # New dreams go through the cache; identical concurrent dreams share one GPT call
+            cache_key = interpretation_cache.make_key(dream_text, model="gpt-4", prompt_version=PROMPT_VERSION)
+            (interpretation, usage), cached = await interpretation_cache.get_or_create(
+                cache_key, lambda: generate_interpretation(messages, prompt_tokens, processing_message, header),
+                # An empty reply from a broken stream must not be served to everyone for the whole TTL
+                cacheable=lambda result: bool(result[0].strip())
+            )
+            if cached:
+                # No upstream tokens were spent on this reply
+                usage = {'prompt_tokens': 0, 'completion_tokens': 0}
+
+        # Get user's remaining interpretations for the month (the reserved slot counts as used)
+        remaining = analytics.get_remaining_dreams(update.effective_user.id)
 
         # Create inline keyboard for the interpretation message
         keyboard = [
@@ -276,45 +523,108 @@ async def process_dream(update: Update, dream_text: str, message_type: str = 'te
         reply_markup = InlineKeyboardMarkup(keyboard)
 
         # Send the interpretation with remaining count and buttons
-        sent_message = await processing_message.edit_text(
-            f"✨ Толкование сна ({current_date}):\n\n{interpretation}\n\n"
-            f"Осталось интерпретаций в этом месяце: {remaining} из 20\n\n"
-            "💭 Хочешь разобраться в каком-то моменте толкования подробнее? Спрашивай, я помогу! 😊",
-            reply_markup=reply_markup
-        )
+        with metrics.span('edit_text'):
+            await edit(
+                processing_message,
+                f"{header}{interpretation}\n\n"
+                f"Осталось интерпретаций в этом месяце: {remaining} из 20\n\n"
+                "💭 Хочешь разобраться в каком-то моменте толкования подробнее? Спрашивай, я помогу! 😊",
+                reply_markup=reply_markup
+            )
 
         # Store the new dream and interpretation if it's not a follow-up question
         if not is_follow_up:
-            dream_id = len(user_dreams[user_id]) + 1
-            user_dreams[user_id].append({
-                "dream": dream_text,
-                "interpretation": interpretation,
-                "timestamp": datetime.now(),
-                "id": dream_id
-            })
-            # Keep only last 5 dreams to manage memory
-            if len(user_dreams[user_id]) > 5:
-                user_dreams[user_id] = user_dreams[user_id][-5:]
-
-        # Log the interaction
+            dream_history.add(user_id, dream_text, interpretation)
+
+        metrics.TOKENS.inc(usage['prompt_tokens'], model="gpt-4", kind="prompt")
+        metrics.TOKENS.inc(usage['completion_tokens'], model="gpt-4", kind="completion")
+
+        # Log the interaction (this consumes the reserved slot)
         analytics.log_dream_interpretation(
             user_id=update.effective_user.id,
             message_type=message_type,
             dream_text=dream_text,
-            tokens_used=response.usage.total_tokens
+            tokens_used=usage['prompt_tokens'] + usage['completion_tokens'],
+            prompt_tokens=usage['prompt_tokens'],
+            completion_tokens=usage['completion_tokens']
         )
+        slot_reserved = False
+
+    except CircuitOpenError:
+        # OpenAI is failing; answer quickly instead of queueing more calls
+        if slot_reserved:
+            analytics.release_slot(update.effective_user.id)
+        await reply(update.message, BUSY_MESSAGE)
 
     except Exception as e:
         logger.error(f"Error interpreting dream: {str(e)}")
+        if slot_reserved:
+            analytics.release_slot(update.effective_user.id)
         analytics.log_error('dream_interpretation', str(e))
-        await update.message.reply_text(
+        await reply(
+            update.message,
             "❌ Ой, что-то пошло не так при обработке… Попробуй отправить сон в виде текста!"
         )
 
-def main():
-    """Start the bot."""
-    # Create the Application
-    application = Application.builder().token(os.getenv('TELEGRAM_BOT_TOKEN')).build()
+async def post_init(application: Application):
+    """Start background tasks once the event loop is running."""
+    llm.prewarm()
+    restored = set()
+    if WARM_SNAPSHOT_PATH:
+        from snapshot import restore_warm_state
+        restored = restore_warm_state(WARM_SNAPSHOT_PATH, analytics.quota, dream_history, interpretation_cache)
+    if 'quota' not in restored:
+        # Read the counters off the startup path; until they are in, users are looked up one by one
+        threading.Thread(target=analytics.quota.warm_load, name='quota-warm-load', daemon=True).start()
+    dream_history.start()
+    analytics.start()
+    traffic_recorder.start()
+    interpretation_cache.load()
+    interpretation_cache.start()
+    if os.getenv('METRICS_PORT'):
+        application.bot_data['metrics_server'] = await metrics.start_http_server(int(os.getenv('METRICS_PORT')))
+
+async def post_shutdown(application: Application):
+    """Flush pending writes before the process exits."""
+    await outbox.stop()
+    await traffic_recorder.stop()
+    await dream_history.stop()
+    await analytics.stop()
+    await interpretation_cache.stop()
+    if WARM_SNAPSHOT_PATH:
+        # Quota counters are only saved once all of them are loaded, which a short run may not have done yet
+        await asyncio.to_thread(analytics.quota.warm_load)
+        try:
+            from snapshot import save_warm_state
+            size = save_warm_state(WARM_SNAPSHOT_PATH, analytics.quota, dream_history, interpretation_cache)
+            logger.info(f"Saved warm-state snapshot to {WARM_SNAPSHOT_PATH} ({size} bytes)")
+        except Exception as e:
+            logger.error(f"Error saving warm-state snapshot: {e}")
+    if 'metrics_server' in application.bot_data:
+        application.bot_data.pop('metrics_server').close()
+
+def build_application(request=None) -> Application:
+    """Create the Application with all handlers registered.
+
+    ``request`` replaces the HTTP backend used to talk to Telegram (benchmarks use a local fake).
+    """
+    from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, filters
+    from lanes import PriorityUpdateProcessor
+
+    init_state()
+    builder = (
+        Application.builder()
+        .token(os.getenv('TELEGRAM_BOT_TOKEN'))
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        # Buttons and commands get their own lane and never wait behind dreams
+        .concurrent_updates(PriorityUpdateProcessor(
+            on_reject=reject_update, on_update=traffic_recorder.record if traffic_recorder.enabled else None
+        ))
+    )
+    if request is not None:
+        builder = builder.request(request).get_updates_request(request)
+    application = builder.build()
 
     # Add handlers
     application.add_handler(CommandHandler("start", start))
@@ -322,8 +632,18 @@ def main():
     application.add_handler(MessageHandler(filters.VOICE, handle_voice))
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text))
     application.add_handler(CallbackQueryHandler(button_handler))
+    return application
+
+def main():
+    """Start the bot."""
+    if os.getenv('BOT_MODE', 'polling').lower() == 'webhook':
+        # Serve updates over HTTP, optionally sharded across worker processes
+        import webhook
+        webhook.serve(build_application)
+        return
 
     # Start the Bot
+    application = build_application()
     application.run_polling(allowed_updates=Update.ALL_TYPES)
 
 if __name__ == '__main__':
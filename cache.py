@@ -0,0 +1,219 @@
+import os
+import re
+import json
+import time
+import asyncio
+import hashlib
+import logging
+from collections import OrderedDict
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_text(text: str) -> str:
+    """Normalize dream text so trivially different messages share a cache key"""
+    text = text.lower().replace('ё', 'е')
+    text = re.sub(r'[^\w\s]', ' ', text)
+    return ' '.join(text.split())
+
+
+class InterpretationAborted(Exception):
+    """Raised to coalesced waiters when the call they were waiting for was cancelled"""
+
+
+class InterpretationCache:
+    """LRU cache of GPT interpretations with TTL and in-flight request coalescing.
+
+    Keys combine the normalized dream text with the model and prompt version,
+    so changing the prompt invalidates old entries. Concurrent requests for
+    the same key share one upstream call.
+    """
+
+    def __init__(self, max_size: int = None, ttl: float = None, path: str = None, stats_path: str = None,
+                 save_interval: float = None):
+        self.max_size = max_size or int(os.getenv('INTERPRETATION_CACHE_SIZE', '1000'))
+        self.ttl = ttl or float(os.getenv('INTERPRETATION_CACHE_TTL', str(7 * 24 * 3600)))
+        path = path if path is not None else os.getenv('INTERPRETATION_CACHE_PATH', '')
+        self.path = Path(path) if path else None
+        stats_path = stats_path if stats_path is not None else os.getenv(
+            'INTERPRETATION_CACHE_STATS', 'analytics/cache_stats.json'
+        )
+        self.stats_path = Path(stats_path) if stats_path else None
+        self.save_interval = save_interval or float(os.getenv('INTERPRETATION_CACHE_SAVE_INTERVAL', '60'))
+
+        self._entries = OrderedDict()  # Format: {key: (expires_at, value)}, least recently used first
+        self._in_flight = {}           # Format: {key: Future}
+        self._task = None
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def make_key(self, text: str, model: str, prompt_version: str) -> str:
+        raw = f"{model}\n{prompt_version}\n{normalize_text(text)}"
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+    def _lookup(self, key: str):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at < time.time():
+            del self._entries[key]
+            self.expirations += 1
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def get(self, key: str):
+        """Get a cached value, or None"""
+        value = self._lookup(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def put(self, key: str, value, expires_at: float = None):
+        """Store a value, evicting least recently used entries above the size cap"""
+        self._entries[key] = (expires_at or time.time() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    async def get_or_create(self, key: str, factory, cacheable=None):
+        """Get a cached value or create it with ``await factory()``.
+
+        Returns ``(value, cached)``. Concurrent calls with the same key wait for
+        the first one instead of calling the factory again; if that call is
+        cancelled, they get ``InterpretationAborted``. A created value is only
+        stored if ``cacheable(value)`` is true, but waiters get it either way.
+        """
+        value = self._lookup(key)
+        if value is not None:
+            self.hits += 1
+            return value, True
+
+        future = self._in_flight.get(key)
+        if future is not None:
+            self.coalesced += 1
+            return await asyncio.shield(future), True
+
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self._in_flight[key] = future
+        try:
+            value = await factory()
+        except BaseException as e:
+            # Cancelling the future would cancel the waiters too, skipping their own error handling
+            future.set_exception(e if isinstance(e, Exception) else InterpretationAborted())
+            # Waiters get the exception; don't warn if there were none
+            future.exception()
+            raise
+        finally:
+            del self._in_flight[key]
+
+        if cacheable is None or cacheable(value):
+            self.put(key, value)
+        future.set_result(value)
+        return value, False
+
+    def stats(self) -> dict:
+        """Get cache counters"""
+        lookups = self.hits + self.coalesced + self.misses
+        return {
+            'size': len(self._entries),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'coalesced': self.coalesced,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+            'hit_rate': round((self.hits + self.coalesced) / lookups * 100, 1) if lookups else 0
+        }
+
+    def load(self):
+        """Load persisted entries from disk"""
+        if not self.path or not self.path.exists():
+            return
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                entries = json.load(f)
+        except Exception as e:
+            logger.error(f"Error loading interpretation cache: {e}")
+            return
+        self.restore_entries(entries)
+        logger.info(f"Loaded {len(self._entries)} cached interpretations")
+
+    def export_entries(self) -> list:
+        """Get ``[key, expires_at, value]`` for every entry, least recently used first"""
+        return [[key, expires_at, value] for key, (expires_at, value) in self._entries.items()]
+
+    def restore_entries(self, entries):
+        """Add entries returned by ``export_entries()``, skipping expired ones"""
+        now = time.time()
+        for key, expires_at, value in entries:
+            if expires_at > now:
+                self.put(key, value, expires_at)
+
+    def _snapshot(self) -> list:
+        """Get (path, data) pairs to write, taken on the event loop thread"""
+        files = []
+        if self.path:
+            files.append((self.path, self.export_entries()))
+        if self.stats_path:
+            files.append((self.stats_path, dict(self.stats(), updated_at=time.time())))
+        return files
+
+    def save(self):
+        """Persist entries (if a path is configured) and counters to disk"""
+        for path, data in self._snapshot():
+            self._write_json(path, data)
+
+    def _write_json(self, path: Path, data):
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = path.with_name(path.name + '.tmp')
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(data, f, ensure_ascii=False)
+            os.replace(tmp_path, path)
+        except Exception as e:
+            logger.error(f"Error saving interpretation cache to {path}: {e}")
+
+    async def _saver(self):
+        while True:
+            await asyncio.sleep(self.save_interval)
+            for path, data in self._snapshot():
+                await asyncio.to_thread(self._write_json, path, data)
+
+    def start(self):
+        """Start periodically saving the cache and its counters"""
+        if self._task is None:
+            self._task = asyncio.create_task(self._saver())
+
+    async def stop(self):
+        """Stop the background saver and save one last time"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self.save()
+
+
+def read_cache_stats(path: str = None):
+    """Read the counters written by the bot's cache, or None if unavailable"""
+    path = Path(path or os.getenv('INTERPRETATION_CACHE_STATS', 'analytics/cache_stats.json'))
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logger.error(f"Error reading cache stats: {e}")
+        return None
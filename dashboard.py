@@ -1,13 +1,18 @@
-from fastapi import FastAPI, Request, HTTPException, Depends
-from fastapi.responses import HTMLResponse, RedirectResponse
+from fastapi import FastAPI, Request, HTTPException, Depends, Query
+from fastapi.responses import HTMLResponse, RedirectResponse, Response, PlainTextResponse, StreamingResponse
 from fastapi.templating import Jinja2Templates
 from fastapi.staticfiles import StaticFiles
 from fastapi.security import APIKeyQuery
 from pathlib import Path
+from contextlib import asynccontextmanager
+from datetime import date, datetime
 import os
 import logging
-from datetime import datetime, timedelta
 from analytics import DreamAnalytics
+from rollups import DashboardRollup
+from livefeed import LiveHub
+from export import DATASETS, FORMATS, export
+import metrics
 from dotenv import load_dotenv
 
 # Configure logging
@@ -24,8 +29,25 @@ load_dotenv()
 dashboard_token = os.getenv('DASHBOARD_TOKEN')
 logger.debug(f"Loaded DASHBOARD_TOKEN: {dashboard_token}")
 
-app = FastAPI(title="Dream Bot Analytics Dashboard")
 analytics = DreamAnalytics()
+rollup = DashboardRollup(analytics)
+
+# One reader of the bot's change feed shared by every live dashboard
+live_hub = LiveHub(cost=rollup.estimate_cost)
+metrics.REGISTRY.register(metrics.Gauge(
+    "dream_dashboard_live_clients", "Dashboards receiving live updates"
+)).set_function(lambda: live_hub.clients)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    live_hub.start()
+    yield
+    await live_hub.stop()
+
+app = FastAPI(title="Dream Bot Analytics Dashboard", lifespan=lifespan)
+
+# Last rendered page per period, reused while the data version (ETag) is unchanged
+rendered_page = {}
 
 # Create templates directory if it doesn't exist
 templates_dir = Path("templates")
@@ -64,66 +86,86 @@ async def verify_token(token: str = Depends(api_key_query)):
 @app.get("/", response_class=HTMLResponse)
 async def dashboard(
     request: Request,
+    days: int = Query(7, ge=1, le=DashboardRollup.MAX_DAYS),
     token: str = Depends(verify_token)
 ):
     """Display the main dashboard"""
-    # Get current month's stats
-    monthly_stats = analytics.get_monthly_stats()
-    if not monthly_stats:
-        monthly_stats = {
-            'total_dreams': 0,
-            'voice_messages': 0,
-            'text_messages': 0,
-            'total_users': 0,
-            'tokens_used': 0,
-            'errors': 0
-        }
+    # Live updates resume after the feed position read before the aggregates; deltas past it that
+    # the aggregates already include are skipped by the page using their write versions
+    live_hub.poll()
+    live_id = live_hub.last_id
+    snapshot = rollup.get(days)
+    etag = snapshot['etag']
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
 
-    # Get daily stats for the last 7 days
-    daily_stats = []
-    for i in range(7):
-        date = (datetime.now() - timedelta(days=i)).strftime('%Y-%m-%d')
-        stats = analytics.get_daily_stats(date)
-        if stats:
-            stats['date'] = date
-            daily_stats.append(stats)
-
-    # Calculate some derived metrics
-    if monthly_stats['total_dreams'] > 0:
-        voice_percentage = (monthly_stats['voice_messages'] / monthly_stats['total_dreams']) * 100
-        text_percentage = (monthly_stats['text_messages'] / monthly_stats['total_dreams']) * 100
-        avg_tokens_per_dream = monthly_stats['tokens_used'] / monthly_stats['total_dreams']
-        error_rate = (monthly_stats['errors'] / monthly_stats['total_dreams']) * 100
-    else:
-        voice_percentage = 0
-        text_percentage = 0
-        avg_tokens_per_dream = 0
-        error_rate = 0
-
-    # Calculate estimated costs (assuming current OpenAI pricing)
-    gpt4_cost_per_1k = 0.03  # $0.03 per 1K tokens
-    whisper_cost_per_minute = 0.006  # $0.006 per minute
-    estimated_voice_minutes = monthly_stats['voice_messages'] * 2  # Assuming average 2 minutes per voice message
-    
-    gpt4_cost = (monthly_stats['tokens_used'] / 1000) * gpt4_cost_per_1k
-    whisper_cost = estimated_voice_minutes * whisper_cost_per_minute
-    total_cost = gpt4_cost + whisper_cost
-
-    return templates.TemplateResponse(
-        "dashboard.html",
-        {
-            "request": request,
-            "monthly_stats": monthly_stats,
-            "daily_stats": daily_stats,
-            "voice_percentage": round(voice_percentage, 1),
-            "text_percentage": round(text_percentage, 1),
-            "avg_tokens_per_dream": round(avg_tokens_per_dream, 1),
-            "error_rate": round(error_rate, 1),
-            "current_month": datetime.now().strftime('%B %Y'),
-            "estimated_cost": round(total_cost, 2)
+    # The browser already has this version of the page
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+
+    # Render the page once per data version
+    page = rendered_page.get(days)
+    if page is None or page['etag'] != etag:
+        page = rendered_page[days] = {
+            'etag': etag,
+            'html': templates.get_template("dashboard.html").render(
+                request=request, live_id=live_id, **snapshot['context']
+            )
         }
+
+    return HTMLResponse(page['html'], headers=headers)
+
+@app.get("/live")
+async def live(
+    request: Request,
+    since: str = Query(None),
+    token: str = Depends(verify_token)
+):
+    """Stream statistics deltas to an open dashboard as Server-Sent Events"""
+    # A reconnecting EventSource sends the id of the last delta it applied
+    queue = live_hub.subscribe(request.headers.get("last-event-id") or since)
+    return StreamingResponse(
+        live_hub.stream(queue),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@app.get("/export/{dataset}")
+async def export_data(
+    dataset: str,
+    start: date = Query(...),
+    end: date = Query(None),
+    fmt: str = Query("csv", alias="format", pattern="^(csv|ndjson)$"),
+    token: str = Depends(verify_token)
+):
+    """Stream daily stats, per-user monthly usage or stored events between two dates.
+
+    With SQLite rows are read a page at a time. The JSON backend has to parse a
+    month's file whole, so memory use is bounded by the largest month in the
+    range (about 60 MB for 100k active users) rather than constant.
+    """
+    if dataset not in DATASETS:
+        raise HTTPException(status_code=404, detail=f"Нет данных для выгрузки: {dataset}")
+    if dataset == "events" and not analytics.stores_events:
+        raise HTTPException(status_code=404, detail="Отдельные события хранятся только при ANALYTICS_BACKEND=sqlite")
+    end = end or datetime.now().date()
+    if start > end:
+        raise HTTPException(status_code=400, detail="Начало периода позже его конца")
+
+    # A plain generator: the server reads it chunk by chunk in a worker thread
+    return StreamingResponse(
+        export(analytics, dataset, fmt, start.isoformat(), end.isoformat()),
+        media_type=FORMATS[fmt],
+        headers={"Content-Disposition": f'attachment; filename="dream_{dataset}_{start}_{end}.{fmt}"'}
     )
 
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics_endpoint(token: str = Depends(verify_token)):
+    """Expose the dashboard process's own metrics (live clients, reads) in Prometheus text format.
+
+    The bot's handler, LLM and outbox metrics are served by the bot itself on METRICS_PORT.
+    """
+    return PlainTextResponse(metrics.REGISTRY.render(), media_type="text/plain; version=0.0.4")
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000) 
\ No newline at end of file
@@ -0,0 +1,84 @@
+import io
+import csv
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+FORMATS = {
+    'csv': 'text/csv; charset=utf-8',
+    'ndjson': 'application/x-ndjson'
+}
+
+DAILY_COLUMNS = ('date', 'total_dreams', 'voice_messages', 'text_messages', 'tokens_used', 'prompt_tokens',
+                 'completion_tokens', 'errors')
+USER_COLUMNS = ('month', 'user_id', 'total_dreams', 'voice_messages', 'text_messages', 'first_interaction',
+                'last_interaction')
+EVENT_COLUMNS = ('created_at', 'date', 'kind', 'user_id', 'message_type', 'tokens_used', 'prompt_tokens',
+                 'completion_tokens', 'error_type', 'error_message')
+
+
+def daily_rows(analytics, start_date: str, end_date: str):
+    for date, day in analytics.iter_daily_stats(start_date, end_date):
+        # Days written before a counter existed lack it
+        yield {'date': date, **{column: day.get(column, 0) for column in DAILY_COLUMNS[1:]}}
+
+
+def user_rows(analytics, start_date: str, end_date: str):
+    for month, user_id, usage in analytics.iter_user_monthly(start_date[:7], end_date[:7]):
+        yield {
+            'month': month,
+            'user_id': user_id,
+            'total_dreams': usage.get('total_dreams', 0),
+            'voice_messages': usage.get('voice_messages', 0),
+            'text_messages': usage.get('text_messages', 0),
+            'first_interaction': usage.get('first_interaction'),
+            'last_interaction': usage.get('last_interaction')
+        }
+
+
+def event_rows(analytics, start_date: str, end_date: str):
+    for event in analytics.iter_events(start_date, end_date):
+        yield {column: event[column] for column in EVENT_COLUMNS}
+
+
+# Format: {dataset: (columns, rows(analytics, start_date, end_date))}
+DATASETS = {
+    'daily': (DAILY_COLUMNS, daily_rows),
+    'users': (USER_COLUMNS, user_rows),
+    'events': (EVENT_COLUMNS, event_rows)
+}
+
+
+def encode(rows, columns: tuple, fmt: str, chunk_size: int = 64 * 1024):
+    """Encode rows as CSV (with a header) or NDJSON, yielding chunks of about ``chunk_size`` bytes.
+
+    Rows are pulled from the iterator as chunks are consumed, so memory use
+    does not depend on how many rows are exported.
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer) if fmt == 'csv' else None
+    if writer is not None:
+        writer.writerow(columns)
+
+    for row in rows:
+        if writer is not None:
+            writer.writerow([row[column] for column in columns])
+        else:
+            buffer.write(json.dumps(row, ensure_ascii=False) + '\n')
+        if buffer.tell() >= chunk_size:
+            yield buffer.getvalue().encode('utf-8')
+            buffer.seek(0)
+            buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode('utf-8')
+
+
+def export(analytics, dataset: str, fmt: str, start_date: str, end_date: str):
+    """Stream a dataset between two dates (inclusive) as encoded chunks"""
+    columns, rows = DATASETS[dataset]
+    exported = 0
+    for chunk in encode(rows(analytics, start_date, end_date), columns, fmt):
+        exported += len(chunk)
+        yield chunk
+    logger.info(f"Exported {dataset} from {start_date} to {end_date} as {fmt}: {exported} bytes")
@@ -0,0 +1,450 @@
+import os
+import sys
+import zlib
+import bisect
+import marshal
+import asyncio
+import sqlite3
+import logging
+import threading
+from array import array
+from collections import OrderedDict
+from datetime import datetime
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+# Texts longer than this (in UTF-8 bytes) are kept zlib-compressed in memory
+COMPRESS_MIN_BYTES = 256
+
+
+def _pack(text: str):
+    """Compress a long text if that makes it smaller; short texts are kept as they are"""
+    data = text.encode('utf-8')
+    if len(data) < COMPRESS_MIN_BYTES:
+        return text
+    packed = zlib.compress(data, 6)
+    return packed if len(packed) < sys.getsizeof(text) - sys.getsizeof('') else text
+
+
+def _unpack(value) -> str:
+    return zlib.decompress(value).decode('utf-8') if isinstance(value, bytes) else value
+
+
+class DreamRecord:
+    """A stored dream in compact form.
+
+    Timestamps are whole seconds since the epoch and long texts are
+    compressed. Reading works like the dicts used before:
+    ``record['dream']``, ``record['interpretation']``, ``record['timestamp']``
+    (a datetime) and ``record['id']``.
+    """
+
+    __slots__ = ('id', 'created', '_dream', '_interpretation')
+
+    def __init__(self, dream_id: int, dream: str, interpretation: str, created: int):
+        self.id = dream_id
+        self.created = created
+        self._dream = _pack(dream)
+        self._interpretation = _pack(interpretation)
+
+    @classmethod
+    def from_packed(cls, dream_id: int, created: int, dream, interpretation) -> 'DreamRecord':
+        """Rebuild a record from texts that are already packed, e.g. read from a snapshot"""
+        record = cls.__new__(cls)
+        record.id = dream_id
+        record.created = created
+        record._dream = dream
+        record._interpretation = interpretation
+        return record
+
+    @property
+    def dream(self) -> str:
+        return _unpack(self._dream)
+
+    @property
+    def interpretation(self) -> str:
+        return _unpack(self._interpretation)
+
+    @property
+    def timestamp(self) -> datetime:
+        return datetime.fromtimestamp(self.created)
+
+    def __getitem__(self, key: str):
+        if key not in ('id', 'dream', 'interpretation', 'timestamp'):
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def get(self, key: str, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def size(self) -> int:
+        """Approximate bytes held by the record"""
+        return sys.getsizeof(self) + sys.getsizeof(self._dream) + sys.getsizeof(self._interpretation)
+
+
+class _UserState:
+    """A user's recent dreams (oldest first), the same keyed by id, and the last dream id issued to them"""
+
+    __slots__ = ('dreams', 'by_id', 'last_id', 'size')
+
+    def __init__(self, dreams: tuple, last_id: int):
+        self.dreams = dreams
+        self.by_id = {record.id: record for record in dreams}  # Format: {dream_id: DreamRecord}
+        self.last_id = last_id
+        self.size = 0
+
+
+class DreamHistory:
+    """Persistent per-user dream history with a bounded in-memory working set.
+
+    Users' recent dreams are kept in memory as compact records, within a
+    memory budget: when it is exceeded, the least recently used users are
+    dropped and reloaded from SQLite the next time they are needed. Users
+    with writes still queued are never dropped. Ids are monotonic per user
+    and never reused, even after old dreams are trimmed. Reads only look in
+    memory: code on an event loop awaits ``load_user()`` first, which reads
+    the database in a thread when the user is not there. Writes are queued
+    and flushed to SQLite in batches by a background task, off the reply path.
+    The most recently used users can be saved to a warm-state snapshot and
+    restored from it one by one, as they are first needed after a restart.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS dreams (
+            user_id INTEGER NOT NULL,
+            dream_id INTEGER NOT NULL,
+            dream TEXT NOT NULL,
+            interpretation TEXT NOT NULL,
+            created_at TEXT NOT NULL,
+            PRIMARY KEY (user_id, dream_id)
+        );
+        CREATE TABLE IF NOT EXISTS user_counters (
+            user_id INTEGER PRIMARY KEY,
+            last_dream_id INTEGER NOT NULL
+        );
+    """
+
+    # Per-user overhead besides the records and their tuple: state object, LRU entry and key
+    USER_OVERHEAD = sys.getsizeof(_UserState((), 0)) + 100 + 32
+
+    def __init__(self, db_path: str = None, depth: int = None, flush_interval: float = None,
+                 batch_size: int = None, memory_budget: int = None):
+        self.db_path = Path(db_path or os.getenv('DREAM_HISTORY_DB', 'data/dream_history.db'))
+        self.depth = depth or int(os.getenv('DREAM_HISTORY_DEPTH', '5'))
+        self.flush_interval = flush_interval or float(os.getenv('DREAM_HISTORY_FLUSH_INTERVAL', '1.0'))
+        self.batch_size = batch_size or int(os.getenv('DREAM_HISTORY_BATCH_SIZE', '100'))
+        self.memory_budget = memory_budget or int(float(os.getenv('DREAM_HISTORY_MEMORY_MB', '256')) * 1024 * 1024)
+
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self._db_lock = threading.Lock()
+        self.conn = sqlite3.connect(str(self.db_path), check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(self.SCHEMA)
+
+        self._users = OrderedDict()  # Format: {user_id: _UserState}, least recently used first
+        self._dirty = {}             # Format: {user_id: dreams queued for writing}
+        self._pending = []           # Dreams waiting to be written: [(user_id, DreamRecord)]
+        self.memory = 0              # Approximate bytes held by self._users
+        self.loads = 0
+        self.evictions = 0
+        self.restored = 0
+        self._snapshot = None      # Restored users: (sorted user ids, offsets into data, data)
+        self._snapshot_used = set()
+        self._wakeup = None
+        self._task = None
+
+    def _restore_user(self, user_id: int):
+        """Get a user's state from the restored snapshot, or None if it is not there"""
+        if self._snapshot is None or user_id in self._snapshot_used:
+            return None
+        user_ids, offsets, data = self._snapshot
+        index = bisect.bisect_left(user_ids, user_id)
+        if index == len(user_ids) or user_ids[index] != user_id:
+            return None
+        # Once dropped from memory again, the user may have newer dreams than the snapshot
+        self._snapshot_used.add(user_id)
+        last_id, dreams = marshal.loads(data[offsets[index]:offsets[index + 1]])
+        return _UserState(tuple(DreamRecord.from_packed(*dream) for dream in dreams), last_id)
+
+    def _read_user(self, user_id: int) -> _UserState:
+        """Read a user's recent dreams from the database; safe to call from a thread"""
+        with self._db_lock:
+            rows = self.conn.execute(
+                "SELECT dream_id, dream, interpretation, created_at FROM dreams "
+                "WHERE user_id = ? ORDER BY dream_id DESC LIMIT ?",
+                (user_id, self.depth)
+            ).fetchall()
+            counter = self.conn.execute(
+                "SELECT last_dream_id FROM user_counters WHERE user_id = ?", (user_id,)
+            ).fetchone()
+
+        dreams = tuple(
+            DreamRecord(dream_id, dream, interpretation, int(datetime.fromisoformat(created_at).timestamp()))
+            for dream_id, dream, interpretation, created_at in reversed(rows)
+        )
+        last_id = max([counter[0] if counter else 0] + [record.id for record in dreams])
+        return _UserState(dreams, last_id)
+
+    def _load_user(self, user_id: int) -> _UserState:
+        """Load a user's recent dreams from the snapshot or the database"""
+        state = self._cached_state(user_id)
+        if state is None:
+            state = self._read_user(user_id)
+            self.loads += 1
+            self._store(user_id, state)
+        return state
+
+    def _store(self, user_id: int, state: _UserState):
+        """Put a user's state in memory, accounting for its size and evicting others if needed"""
+        old = self._users.get(user_id)
+        if old is not None:
+            self.memory -= old.size
+        state.size = (self.USER_OVERHEAD + sys.getsizeof(state.dreams) + sys.getsizeof(state.by_id)
+                      + sum(record.size() for record in state.dreams))
+        self._users[user_id] = state
+        self._users.move_to_end(user_id)
+        self.memory += state.size
+        if self.memory > self.memory_budget:
+            self._evict(keep=user_id)
+
+    def _evict(self, keep: int = None):
+        """Drop least recently used users until memory is back under 90% of the budget"""
+        # The margin keeps every new user from evicting exactly one other
+        excess = self.memory - int(self.memory_budget * 0.9)
+        victims = []
+        for user_id, state in self._users.items():
+            if excess <= 0:
+                break
+            if user_id in self._dirty or user_id == keep:
+                # Not written yet; reloading would lose the queued dreams
+                continue
+            victims.append(user_id)
+            excess -= state.size
+        for user_id in victims:
+            self.memory -= self._users.pop(user_id).size
+        self.evictions += len(victims)
+
+    def _cached_state(self, user_id: int):
+        """Get a user's state from memory or the restored snapshot, or None; never reads the database"""
+        state = self._users.get(user_id)
+        if state is not None:
+            self._users.move_to_end(user_id)
+            return state
+        state = self._restore_user(user_id)
+        if state is not None:
+            self.restored += 1
+            self._store(user_id, state)
+        return state
+
+    async def load_user(self, user_id):
+        """Make sure a user's dreams are in memory, reading the database in a thread, off the event loop"""
+        user_id = int(user_id)
+        if self._cached_state(user_id) is not None:
+            return
+        state = await asyncio.to_thread(self._read_user, user_id)
+        self.loads += 1
+        # Dreams added while the read ran are newer than what it found
+        if user_id not in self._users:
+            self._store(user_id, state)
+
+    def get_dreams(self, user_id) -> list:
+        """Get user's stored dreams, oldest first; empty unless the user is loaded (see ``load_user``)"""
+        state = self._cached_state(int(user_id))
+        return list(state.dreams) if state is not None else []
+
+    def get(self, user_id, dream_id: int):
+        """Get a dream by id, or None if it is no longer stored or the user is not loaded"""
+        state = self._cached_state(int(user_id))
+        return state.by_id.get(dream_id) if state is not None else None
+
+    def latest(self, user_id):
+        """Get user's most recent dream, or None (also when the user is not loaded)"""
+        state = self._cached_state(int(user_id))
+        return state.dreams[-1] if state is not None and state.dreams else None
+
+    def cached_latest_id(self, user_id):
+        """Get the id of user's most recent dream if the user is in memory, else None.
+
+        Never loads the user and leaves the least-recently-used order alone.
+        """
+        state = self._users.get(int(user_id))
+        return state.dreams[-1].id if state is not None and state.dreams else None
+
+    def add(self, user_id, dream_text: str, interpretation: str) -> DreamRecord:
+        """Store a new dream and queue it for writing"""
+        user_id = int(user_id)
+        # Callers on the event loop await load_user() first; reading here only covers the others
+        state = self._load_user(user_id)
+        record = DreamRecord(state.last_id + 1, dream_text, interpretation, int(datetime.now().timestamp()))
+        # Keep only the last `depth` dreams
+        self._store(user_id, _UserState((state.dreams + (record,))[-self.depth:], record.id))
+
+        self._pending.append((user_id, record))
+        self._dirty[user_id] = self._dirty.get(user_id, 0) + 1
+        if self._wakeup is not None and len(self._pending) >= self.batch_size:
+            self._wakeup.set()
+        return record
+
+    def memory_usage(self, user_id=None) -> int:
+        """Get the approximate bytes held in memory for one user (0 if not loaded) or in total"""
+        if user_id is None:
+            return self.memory
+        state = self._users.get(int(user_id))
+        return state.size if state is not None else 0
+
+    def stats(self) -> dict:
+        """Get the size of the in-memory working set and load/eviction counters"""
+        return {
+            'users': len(self._users),
+            'memory_bytes': self.memory,
+            'memory_budget': self.memory_budget,
+            'bytes_per_user': round(self.memory / len(self._users)) if self._users else 0,
+            'loads': self.loads,
+            'evictions': self.evictions,
+            'restored': self.restored,
+            'pending': len(self._pending)
+        }
+
+    def fingerprint(self) -> int:
+        """Get a value that changes whenever dreams are written, comparable across processes"""
+        with self._db_lock:
+            # Every insert gets a rowid above all others; trims only delete older rows
+            return self.conn.execute("SELECT MAX(rowid) FROM dreams").fetchone()[0] or 0
+
+    def export_state(self, limit: int):
+        """Get the ``limit`` most recently used users as ``(user_ids, offsets, data)`` for a snapshot.
+
+        Returns None while dreams are waiting to be written. ``user_ids`` is sorted;
+        the marshalled state of ``user_ids[i]`` is ``data[offsets[i]:offsets[i + 1]]``.
+        """
+        if self._pending:
+            return None
+        states = {}  # Format: {user_id: marshalled state}
+        for user_id in reversed(self._users):
+            if len(states) >= limit:
+                break
+            state = self._users[user_id]
+            states[user_id] = marshal.dumps((state.last_id, tuple(
+                (record.id, record.created, record._dream, record._interpretation) for record in state.dreams
+            )))
+        if self._snapshot is not None:
+            # Users restored but not needed since are still as recent as they were
+            snapshot_ids, snapshot_offsets, snapshot_data = self._snapshot
+            for index, user_id in enumerate(snapshot_ids):
+                if len(states) >= limit:
+                    break
+                if user_id not in states and user_id not in self._snapshot_used:
+                    states[user_id] = snapshot_data[snapshot_offsets[index]:snapshot_offsets[index + 1]]
+        user_ids = array('q', sorted(states))
+        offsets = array('q', [0])
+        data = bytearray()
+        for user_id in user_ids:
+            data += states[user_id]
+            offsets.append(len(data))
+        return user_ids, offsets, bytes(data)
+
+    def restore_state(self, user_ids, offsets, data):
+        """Serve users from a snapshot taken by ``export_state()`` until they are loaded.
+
+        The sequences are only read, so they can point into a memory-mapped file.
+        """
+        self._snapshot = (user_ids, offsets, data)
+        self._snapshot_used = set()
+        logger.info(f"Restored recent dreams of {len(user_ids)} users")
+
+    def _written(self, batch: list):
+        """Mark users of a written batch as safe to evict"""
+        for user_id, _ in batch:
+            left = self._dirty.get(user_id, 0) - 1
+            if left > 0:
+                self._dirty[user_id] = left
+            else:
+                self._dirty.pop(user_id, None)
+
+    def _write_batch(self, batch: list):
+        """Write queued dreams and trim old ones in a single transaction.
+
+        Dreams are upserted on (user_id, dream_id) and trimmed against the
+        stored counter rather than the batch, so writing a batch again, e.g.
+        a requeued one after a newer batch was written, stores the same rows.
+        """
+        with self._db_lock, self.conn:
+            self.conn.executemany(
+                "INSERT INTO dreams (user_id, dream_id, dream, interpretation, created_at) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT (user_id, dream_id) DO UPDATE SET dream = excluded.dream, "
+                "interpretation = excluded.interpretation, created_at = excluded.created_at",
+                [(user_id, record.id, record.dream, record.interpretation, record.timestamp.isoformat())
+                 for user_id, record in batch]
+            )
+            last_ids = {}
+            for user_id, record in batch:
+                last_ids[user_id] = max(last_ids.get(user_id, 0), record.id)
+            self.conn.executemany(
+                "INSERT INTO user_counters (user_id, last_dream_id) VALUES (?, ?) "
+                "ON CONFLICT (user_id) DO UPDATE SET last_dream_id = MAX(last_dream_id, excluded.last_dream_id)",
+                list(last_ids.items())
+            )
+            self.conn.executemany(
+                "DELETE FROM dreams WHERE user_id = ? "
+                "AND dream_id <= (SELECT last_dream_id FROM user_counters WHERE user_id = ?) - ?",
+                [(user_id, user_id, self.depth) for user_id in last_ids]
+            )
+
+    def flush(self):
+        """Write all queued dreams now"""
+        batch, self._pending = self._pending, []
+        if not batch:
+            return
+        try:
+            self._write_batch(batch)
+        except Exception as e:
+            logger.error(f"Error saving dream history: {e}")
+            # The transaction rolled back; the batch is requeued whole, and writing it again is harmless
+            self._pending = batch + self._pending
+            return
+        self._written(batch)
+
+    async def _flush_async(self):
+        batch, self._pending = self._pending, []
+        if not batch:
+            return
+        try:
+            await asyncio.to_thread(self._write_batch, batch)
+        except Exception as e:
+            logger.error(f"Error saving dream history: {e}")
+            # The transaction rolled back; the batch is requeued whole, and writing it again is harmless
+            self._pending = batch + self._pending
+            return
+        self._written(batch)
+
+    async def _writer(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self._flush_async()
+
+    def start(self):
+        """Start the background writer task"""
+        if self._task is None:
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._writer())
+
+    async def stop(self):
+        """Stop the background writer and flush what is left"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+            self._wakeup = None
+        await self._flush_async()
@@ -0,0 +1,119 @@
+import os
+import time
+import asyncio
+import logging
+import contextvars
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+import metrics
+
+logger = logging.getLogger(__name__)
+
+FAST_LANE = 'fast'
+WORKER_LANE = 'worker'
+
+# The lane of the update being handled, seen by everything its handlers await
+current_lane = contextvars.ContextVar('current_lane', default=None)
+
+
+def lane_for(update) -> str:
+    """Pick the lane for an update: menu buttons and commands are fast, dreams go to workers"""
+    if not isinstance(update, Update) or update.callback_query is not None:
+        return FAST_LANE
+    message = update.effective_message
+    if message is None or (message.text and message.text.startswith('/')):
+        return FAST_LANE
+    return WORKER_LANE
+
+
+class Lane:
+    """A concurrency limit with an optional cap on updates waiting for it"""
+
+    def __init__(self, name: str, concurrency: int, backlog: int = None):
+        self.name = name
+        self.concurrency = concurrency
+        self.backlog = backlog
+        self.semaphore = None  # Created in initialize(), inside the running event loop
+        self.waiting = 0
+        self.running = 0
+        self.rejected = 0
+
+    def stats(self) -> dict:
+        return {
+            'concurrency': self.concurrency,
+            'backlog': self.backlog,
+            'waiting': self.waiting,
+            'running': self.running,
+            'rejected': self.rejected
+        }
+
+
+class PriorityUpdateProcessor(BaseUpdateProcessor):
+    """Processes updates in separate lanes so cheap interactions never queue behind dreams.
+
+    Callback queries and commands run in the fast lane; text and voice dreams
+    run in the worker lane, whose backlog is bounded. When the backlog is full
+    the update is not processed and ``on_reject(update)`` is awaited instead,
+    so worker updates can never take the slots reserved for the fast lane.
+    ``on_update(update)`` is called for every update as it arrives, before it
+    waits for its lane.
+    """
+
+    def __init__(self, fast_concurrency: int = None, worker_concurrency: int = None,
+                 worker_backlog: int = None, on_reject=None, on_update=None):
+        fast = Lane(FAST_LANE, fast_concurrency or int(os.getenv('UPDATE_FAST_CONCURRENCY', '32')))
+        worker = Lane(
+            WORKER_LANE,
+            worker_concurrency or int(os.getenv('UPDATE_WORKER_CONCURRENCY', '64')),
+            worker_backlog or int(os.getenv('UPDATE_WORKER_BACKLOG', '500'))
+        )
+        # The base limit covers every lane, so it never blocks on its own
+        super().__init__(fast.concurrency + worker.concurrency + worker.backlog)
+        self.lanes = {FAST_LANE: fast, WORKER_LANE: worker}
+        self.on_reject = on_reject
+        self.on_update = on_update
+
+    def stats(self) -> dict:
+        """Get per-lane concurrency, queue depth and rejection counters"""
+        return {name: lane.stats() for name, lane in self.lanes.items()}
+
+    async def initialize(self):
+        for lane in self.lanes.values():
+            lane.semaphore = asyncio.Semaphore(lane.concurrency)
+
+    async def shutdown(self):
+        pass
+
+    async def do_process_update(self, update, coroutine):
+        if self.on_update is not None:
+            self.on_update(update)
+        lane = self.lanes[lane_for(update)]
+        if lane.backlog is not None and lane.waiting >= lane.backlog:
+            lane.rejected += 1
+            coroutine.close()
+            logger.warning(f"The {lane.name} lane backlog is full ({lane.waiting}), rejecting update")
+            metrics.ERRORS.inc(type=f'rejected_{lane.name}_lane')
+            if self.on_reject is not None:
+                await self.on_reject(update)
+            return
+
+        lane.waiting += 1
+        metrics.LANE_UPDATES.inc(lane=lane.name, state='waiting')
+        queued_at = time.perf_counter()
+        try:
+            await lane.semaphore.acquire()
+        finally:
+            lane.waiting -= 1
+            metrics.LANE_UPDATES.dec(lane=lane.name, state='waiting')
+        metrics.LANE_QUEUE_SECONDS.observe(time.perf_counter() - queued_at, lane=lane.name)
+
+        lane.running += 1
+        metrics.LANE_UPDATES.inc(lane=lane.name, state='running')
+        token = current_lane.set(lane.name)
+        try:
+            await coroutine
+        finally:
+            current_lane.reset(token)
+            lane.running -= 1
+            metrics.LANE_UPDATES.dec(lane=lane.name, state='running')
+            lane.semaphore.release()
@@ -0,0 +1,249 @@
+import os
+import json
+import time
+import asyncio
+import logging
+from collections import deque
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+# Counters carried by every delta, matching the daily statistics
+DELTA_FIELDS = ('total_dreams', 'voice_messages', 'text_messages', 'tokens_used', 'prompt_tokens',
+                'completion_tokens', 'errors')
+
+# Sent to a client that missed deltas which are no longer kept: it has to reload the page
+RELOAD_FRAME = b"event: reload\ndata: {}\n\n"
+PING_FRAME = b": ping\n\n"
+
+
+def default_feed_path() -> Path:
+    return Path(os.getenv('LIVE_FEED_PATH') or Path(os.getenv('ANALYTICS_DIR', 'analytics')) / 'changes.log')
+
+
+def batch_deltas(batch: list) -> list:
+    """Sum a batch of analytics events into counter deltas, one per day, oldest first"""
+    days = {}
+    for event in batch:
+        date = event['when'].strftime('%Y-%m-%d')
+        day = days.get(date)
+        if day is None:
+            day = days[date] = {'date': date, 'month': date[:7], **dict.fromkeys(DELTA_FIELDS, 0)}
+        if event['kind'] == 'dream':
+            voice = 1 if event['message_type'] == 'voice' else 0
+            day['total_dreams'] += 1
+            day['voice_messages'] += voice
+            day['text_messages'] += 1 - voice
+            day['tokens_used'] += event['tokens_used']
+            day['prompt_tokens'] += event.get('prompt_tokens', 0)
+            day['completion_tokens'] += event.get('completion_tokens', 0)
+        else:
+            day['errors'] += 1
+    return [days[date] for date in sorted(days)]
+
+
+class ChangeFeed:
+    """Append-only NDJSON log of statistics deltas for live dashboards.
+
+    The analytics writer appends one line per day touched by a written batch,
+    tagged ``v`` with the month's write version after the batch, so a
+    dashboard can skip deltas its snapshot already counted.
+    Every append opens the file anew, so several bot processes can share the
+    feed and a rotated file is never written to again. Once the file grows
+    past ``max_bytes`` it is renamed to ``<path>.1`` and a new one is started.
+    """
+
+    def __init__(self, path: str = None, max_bytes: int = None):
+        self.path = Path(path) if path else default_feed_path()
+        self.max_bytes = max_bytes or int(os.getenv('LIVE_FEED_MAX_BYTES', str(1024 * 1024)))
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+
+    def append(self, batch: list, versions: dict = None):
+        """Append the deltas of a written batch, with ``{month: version}`` returned by storage"""
+        deltas = batch_deltas(batch)
+        if not deltas:
+            return
+        ts = round(time.time(), 3)
+        versions = versions or {}
+        lines = ''.join(
+            json.dumps(dict(delta, ts=ts, v=versions.get(delta['month'])), separators=(',', ':')) + '\n'
+            for delta in deltas
+        )
+        try:
+            if self.path.stat().st_size >= self.max_bytes:
+                os.replace(self.path, self.path.with_name(self.path.name + '.1'))
+        except FileNotFoundError:
+            pass
+        with open(self.path, 'a', encoding='utf-8') as f:
+            f.write(lines)
+
+
+class LiveHub:
+    """Follows the change feed once per process and fans deltas out to every live dashboard.
+
+    A single task polls the feed for new lines, adds the cost of each delta
+    (``cost(delta)``) and encodes it as a Server-Sent Events frame once; the
+    same frame is handed to every subscriber, so open dashboards add no
+    work beyond a queue put each. Recent frames are kept so a client can
+    catch up from its last event id. A client that fell too far behind, or
+    reads too slowly to keep up, is told to reload the page instead.
+    """
+
+    def __init__(self, path: str = None, poll_interval: float = None, backlog: int = None,
+                 queue_size: int = 256, heartbeat: float = 15.0, cost=None):
+        self.path = Path(path) if path else default_feed_path()
+        self.poll_interval = poll_interval or float(os.getenv('LIVE_POLL_INTERVAL', '1.0'))
+        self.recent = deque(maxlen=backlog or int(os.getenv('LIVE_BACKLOG', '1000')))  # Format: (number, frame)
+        self.queue_size = queue_size
+        self.heartbeat = heartbeat
+        self.cost = cost
+        self.epoch = format(int(time.time()), 'x')  # Event ids of an earlier run of the dashboard are not replayed
+        self.counter = 0
+        self.dropped = 0
+        self._subscribers = set()
+        self._file = None
+        self._inode = None
+        self._buffer = b''
+        self._task = None
+
+    @property
+    def last_id(self) -> str:
+        """Id of the latest delta; a page rendered now is up to date until this id"""
+        return f"{self.epoch}-{self.counter}"
+
+    @property
+    def clients(self) -> int:
+        return len(self._subscribers)
+
+    def _number(self, event_id: str):
+        epoch, _, number = event_id.partition('-')
+        if epoch != self.epoch or not number.isdigit():
+            return None
+        return int(number)
+
+    def subscribe(self, last_event_id: str = None) -> asyncio.Queue:
+        """Get a queue of frames, starting after ``last_event_id`` if given"""
+        queue = asyncio.Queue(self.queue_size)
+        if last_event_id:
+            number = self._number(last_event_id)
+            oldest = self.recent[0][0] if self.recent else self.counter + 1
+            missed = self.counter - number if number is not None else None
+            if missed is None or missed < 0 or number + 1 < oldest or missed >= self.queue_size:
+                queue.put_nowait(RELOAD_FRAME)
+                return queue
+            for frame_number, frame in self.recent:
+                if frame_number > number:
+                    queue.put_nowait(frame)
+        self._subscribers.add(queue)
+        return queue
+
+    def unsubscribe(self, queue: asyncio.Queue):
+        self._subscribers.discard(queue)
+
+    async def stream(self, queue: asyncio.Queue):
+        """Yield the frames of a subscription, with heartbeats, until the client goes away"""
+        try:
+            yield b"retry: 3000\n\n"
+            while True:
+                try:
+                    frame = await asyncio.wait_for(queue.get(), timeout=self.heartbeat)
+                except asyncio.TimeoutError:
+                    frame = PING_FRAME
+                yield frame
+                if frame is RELOAD_FRAME:
+                    return
+        finally:
+            self.unsubscribe(queue)
+
+    def _read_available(self) -> list:
+        data = self._buffer + self._file.read()
+        *lines, self._buffer = data.split(b'\n')
+        return lines
+
+    def _read_lines(self) -> list:
+        """Read the complete lines added since the last call, following truncation and rotation"""
+        lines = []
+        if self._file is not None:
+            if os.fstat(self._file.fileno()).st_size < self._file.tell():
+                self._file.seek(0)
+                self._buffer = b''
+            # Finish a rotated file before switching to the new one
+            lines += self._read_available()
+        try:
+            inode = os.stat(self.path).st_ino
+        except FileNotFoundError:
+            return lines
+        if inode != self._inode:
+            if self._file is not None:
+                self._file.close()
+            self._file = open(self.path, 'rb')
+            self._inode = inode
+            self._buffer = b''
+            lines += self._read_available()
+        return lines
+
+    def _publish(self, line: bytes):
+        try:
+            delta = json.loads(line)
+        except ValueError:
+            logger.warning(f"Skipping a malformed change feed line: {line[:100]!r}")
+            return
+        if self.cost is not None:
+            delta['cost'] = round(self.cost(delta), 4)
+        self.counter += 1
+        frame = f"id: {self.epoch}-{self.counter}\nevent: delta\ndata: {json.dumps(delta)}\n\n".encode('utf-8')
+        self.recent.append((self.counter, frame))
+        for queue in list(self._subscribers):
+            try:
+                queue.put_nowait(frame)
+            except asyncio.QueueFull:
+                # Rather than fall further behind, the client reloads the page once
+                self._subscribers.discard(queue)
+                while not queue.empty():
+                    queue.get_nowait()
+                queue.put_nowait(RELOAD_FRAME)
+                self.dropped += 1
+
+    def poll(self) -> int:
+        """Publish the deltas appended since the last poll; returns how many"""
+        if self._task is None:
+            return 0
+        lines = [line for line in self._read_lines() if line.strip()]
+        for line in lines:
+            self._publish(line)
+        return len(lines)
+
+    async def _run(self):
+        # Reads are a few new lines per second, cheaper than handing them to a thread
+        while True:
+            try:
+                self.poll()
+            except Exception as e:
+                logger.error(f"Error reading the live change feed: {e}")
+            await asyncio.sleep(self.poll_interval)
+
+    def start(self):
+        """Start following the feed from its current end"""
+        if self._task is None:
+            try:
+                self._file = open(self.path, 'rb')
+                self._file.seek(0, os.SEEK_END)
+                self._inode = os.fstat(self._file.fileno()).st_ino
+            except FileNotFoundError:
+                pass
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Stop following the feed"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self._subscribers.clear()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            self._inode = None
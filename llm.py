@@ -0,0 +1,269 @@
+import os
+import time
+import random
+import asyncio
+import threading
+import functools
+import contextlib
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+@functools.lru_cache(maxsize=None)
+def retryable_errors() -> tuple:
+    """Upstream failures worth another attempt; client errors (4xx) are not"""
+    # Imported on first use: openai is the largest part of the bot's startup time
+    import openai
+    return (
+        asyncio.TimeoutError,
+        openai.APIConnectionError,
+        openai.RateLimitError,
+        openai.InternalServerError,
+    )
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling OpenAI while the circuit breaker is open"""
+
+
+class CircuitBreaker:
+    """Stops calling an upstream that keeps failing.
+
+    After ``failure_threshold`` consecutive failures the breaker opens and
+    calls fail fast for ``reset_timeout`` seconds. Then a single trial call is
+    let through: success closes the breaker, failure opens it again.
+    """
+
+    def __init__(self, failure_threshold: int = None, reset_timeout: float = None):
+        self.failure_threshold = failure_threshold or int(os.getenv('OPENAI_BREAKER_THRESHOLD', '5'))
+        self.reset_timeout = reset_timeout or float(os.getenv('OPENAI_BREAKER_RESET', '30'))
+        self.failures = 0
+        self.opened_at = None
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return 'closed'
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return 'half-open'
+        return 'open'
+
+    def check(self):
+        """Raise CircuitOpenError unless a call may go through now"""
+        state = self.state
+        if state == 'open':
+            raise CircuitOpenError("OpenAI is unavailable, circuit breaker is open")
+        if state == 'half-open':
+            # Let this one trial call through and keep failing fast for the others
+            self.opened_at = time.monotonic()
+
+    def record_success(self):
+        if self.opened_at is not None:
+            logger.info("OpenAI circuit breaker closed")
+        self.failures = 0
+        self.opened_at = None
+
+    def record_failure(self):
+        self.failures += 1
+        if self.failures >= self.failure_threshold:
+            if self.opened_at is None:
+                logger.warning(f"OpenAI circuit breaker opened after {self.failures} failures")
+            self.opened_at = time.monotonic()
+
+
+class LLMPool:
+    """Async wrapper around the OpenAI client with a global concurrency limit.
+
+    Every chat completion and transcription goes through one semaphore, so the
+    number of simultaneous upstream requests is bounded while the event loop
+    stays free to handle other updates. Transient failures are retried with
+    jittered exponential backoff behind a circuit breaker. The client can be
+    given as ``client_factory`` instead, to be created on first use.
+    """
+
+    def __init__(self, client=None, max_concurrency: int = None, chat_timeout: float = None,
+                 transcribe_timeout: float = None, retries: int = None, retry_delay: float = None,
+                 breaker: CircuitBreaker = None, client_factory=None):
+        self._client = client
+        self.client_factory = client_factory
+        self._client_lock = threading.Lock()
+        self.max_concurrency = max_concurrency or int(os.getenv('OPENAI_MAX_CONCURRENCY', '8'))
+        self.chat_timeout = chat_timeout or float(os.getenv('OPENAI_CHAT_TIMEOUT', '60'))
+        self.transcribe_timeout = transcribe_timeout or float(os.getenv('OPENAI_TRANSCRIBE_TIMEOUT', '60'))
+        self.retries = retries if retries is not None else int(os.getenv('OPENAI_RETRIES', '2'))
+        self.retry_delay = retry_delay or float(os.getenv('OPENAI_RETRY_DELAY', '0.5'))
+        self.breaker = breaker or CircuitBreaker()
+        self._semaphore = None  # Created lazily inside the running event loop
+        self.waiting = 0
+        self.in_flight = 0
+        self.completed = 0
+        self.timeouts = 0
+        self.retried = 0
+
+    @property
+    def client(self):
+        """The OpenAI client, created with ``client_factory`` on first use"""
+        if self._client is None:
+            with self._client_lock:
+                if self._client is None:
+                    self._client = self.client_factory()
+        return self._client
+
+    @client.setter
+    def client(self, client):
+        self._client = client
+
+    def _create_client(self):
+        try:
+            self.client
+        except Exception as e:
+            logger.error(f"Error creating the OpenAI client: {e}")
+
+    def prewarm(self):
+        """Create the client in a background thread, so the first call does not wait for it"""
+        if self._client is None and self.client_factory is not None:
+            threading.Thread(target=self._create_client, name='openai-prewarm', daemon=True).start()
+
+    def _get_semaphore(self):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._semaphore
+
+    def stats(self) -> dict:
+        """Get current queue depth and call counters"""
+        return {
+            'max_concurrency': self.max_concurrency,
+            'waiting': self.waiting,
+            'in_flight': self.in_flight,
+            'completed': self.completed,
+            'timeouts': self.timeouts,
+            'retried': self.retried,
+            'breaker': self.breaker.state
+        }
+
+    async def _backoff(self, kind: str, attempt: int, error: Exception):
+        """Sleep before the next attempt: full jitter over an exponentially growing window"""
+        delay = random.uniform(0, self.retry_delay * 2 ** attempt)
+        self.retried += 1
+        logger.warning(f"OpenAI {kind} call failed ({type(error).__name__}), retrying in {delay:.2f}s")
+        await asyncio.sleep(delay)
+
+    @contextlib.asynccontextmanager
+    async def _slot(self, kind: str):
+        """Wait for a free slot in the pool and hold it for the duration of a call"""
+        semaphore = self._get_semaphore()
+        self.waiting += 1
+        if semaphore.locked():
+            logger.info(f"OpenAI pool is full, queued {kind} call (waiting: {self.waiting})")
+        queued_at = time.monotonic()
+        try:
+            await semaphore.acquire()
+        finally:
+            self.waiting -= 1
+
+        self.in_flight += 1
+        started_at = time.monotonic()
+        try:
+            yield
+        finally:
+            self.in_flight -= 1
+            self.completed += 1
+            semaphore.release()
+            logger.debug(
+                f"OpenAI {kind} call: queued {started_at - queued_at:.3f}s, "
+                f"took {time.monotonic() - started_at:.3f}s"
+            )
+
+    async def _run(self, kind: str, call, timeout: float):
+        """Run an upstream call once a slot is free, with a per-call timeout and retries"""
+        attempt = 0
+        while True:
+            self.breaker.check()
+            try:
+                async with self._slot(kind):
+                    try:
+                        result = await asyncio.wait_for(call(), timeout=timeout)
+                    except asyncio.TimeoutError:
+                        self.timeouts += 1
+                        logger.error(f"OpenAI {kind} call timed out after {timeout}s")
+                        raise
+            except retryable_errors() as e:
+                self.breaker.record_failure()
+                if attempt >= self.retries:
+                    raise
+                await self._backoff(kind, attempt, e)
+                attempt += 1
+                continue
+            self.breaker.record_success()
+            return result
+
+    async def chat(self, **kwargs):
+        """Create a chat completion"""
+        return await self._run(
+            'chat',
+            lambda: self.client.chat.completions.create(**kwargs),
+            self.chat_timeout
+        )
+
+    async def stream_chat(self, usage: dict = None, **kwargs):
+        """Stream a chat completion, yielding text deltas as they arrive.
+
+        The pool slot is held until the stream is exhausted or closed, and the
+        chat timeout applies to the whole stream. A failed attempt is retried
+        only if nothing has been yielded yet. If ``usage`` is given, the API is
+        asked to end the stream with the token usage, which is filled into it
+        as ``prompt_tokens`` and ``completion_tokens``; it stays empty when
+        the API does not report usage.
+        """
+        if usage is not None:
+            kwargs['extra_body'] = {**kwargs.get('extra_body', {}), 'stream_options': {'include_usage': True}}
+        attempt = 0
+        while True:
+            self.breaker.check()
+            yielded = False
+            try:
+                async with self._slot('chat stream'):
+                    deadline = time.monotonic() + self.chat_timeout
+                    try:
+                        stream = await asyncio.wait_for(
+                            self.client.chat.completions.create(stream=True, **kwargs),
+                            timeout=self.chat_timeout
+                        )
+                        iterator = stream.__aiter__()
+                        while True:
+                            try:
+                                chunk = await asyncio.wait_for(
+                                    iterator.__anext__(), timeout=max(0.0, deadline - time.monotonic())
+                                )
+                            except StopAsyncIteration:
+                                break
+                            if usage is not None and getattr(chunk, 'usage', None) is not None:
+                                # The last chunk has no choices, only the usage of the whole stream
+                                usage['prompt_tokens'] = chunk.usage.prompt_tokens
+                                usage['completion_tokens'] = chunk.usage.completion_tokens
+                            if chunk.choices and chunk.choices[0].delta.content:
+                                yielded = True
+                                yield chunk.choices[0].delta.content
+                    except asyncio.TimeoutError:
+                        self.timeouts += 1
+                        logger.error(f"OpenAI chat stream timed out after {self.chat_timeout}s")
+                        raise
+            except retryable_errors() as e:
+                self.breaker.record_failure()
+                if yielded or attempt >= self.retries:
+                    raise
+                await self._backoff('chat stream', attempt, e)
+                attempt += 1
+                continue
+            self.breaker.record_success()
+            return
+
+    async def transcribe(self, file, model: str = "whisper-1"):
+        """Transcribe an audio file"""
+        return await self._run(
+            'transcription',
+            lambda: self.client.audio.transcriptions.create(model=model, file=file),
+            self.transcribe_timeout
+        )
+
@@ -0,0 +1,278 @@
+import os
+import time
+import random
+import asyncio
+import logging
+import threading
+import functools
+import contextlib
+import contextvars
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(labelnames: tuple, values: tuple, extra: dict = None) -> str:
+    pairs = list(zip(labelnames, values)) + list((extra or {}).items())
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+def _format_value(value) -> str:
+    if value == float('inf'):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            items = list(self._values.items())
+        for key, value in sorted(items):
+            lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}")
+        return lines
+
+
+class Counter(_Metric):
+    """Monotonically increasing counter"""
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+
+class Gauge(_Metric):
+    """Value that can go up and down, or be read from a callback at scrape time"""
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        super().__init__(name, documentation, labelnames)
+        self._function = None
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    def set_function(self, function):
+        """Read values at scrape time. ``function`` returns a number or ``{label_values_tuple: number}``."""
+        self._function = function
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def render(self) -> list:
+        if self._function is not None:
+            try:
+                values = self._function()
+            except Exception as e:
+                logger.error(f"Error reading gauge {self.name}: {e}")
+                values = {}
+            with self._lock:
+                self._values = values if isinstance(values, dict) else {(): values}
+        return super().render()
+
+
+class Histogram(_Metric):
+    """Distribution of observed values in cumulative buckets"""
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][index] += 1
+                    break
+            state[1] += value
+            state[2] += 1
+
+    def count(self, **labels) -> int:
+        state = self._values.get(self._key(labels))
+        return state[2] if state else 0
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            items = [(key, (list(state[0]), state[1], state[2])) for key, state in self._values.items()]
+        for key, (bucket_counts, total, count) in sorted(items):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, bucket_counts):
+                cumulative += bucket_count
+                labels = _format_labels(self.labelnames, key, {"le": _format_value(bound)})
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+class Registry:
+    """Collection of metrics rendered together in Prometheus text format"""
+
+    def __init__(self):
+        self._metrics = {}
+
+    def register(self, metric):
+        self._metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+STAGE_SECONDS = REGISTRY.register(Histogram(
+    "dream_bot_stage_seconds", "Time spent in each processing stage", ("stage",)
+))
+STAGE_IN_FLIGHT = REGISTRY.register(Gauge(
+    "dream_bot_stage_in_flight", "Operations currently running in each stage", ("stage",)
+))
+REQUEST_SECONDS = REGISTRY.register(Histogram(
+    "dream_bot_request_seconds", "End-to-end handling time of an update", ("kind",)
+))
+REQUESTS_IN_FLIGHT = REGISTRY.register(Gauge(
+    "dream_bot_requests_in_flight", "Updates currently being handled", ("kind",)
+))
+TOKENS = REGISTRY.register(Counter(
+    "dream_bot_tokens_total", "OpenAI tokens used", ("model", "kind")
+))
+ERRORS = REGISTRY.register(Counter(
+    "dream_bot_errors_total", "Errors by type", ("type",)
+))
+LANE_QUEUE_SECONDS = REGISTRY.register(Histogram(
+    "dream_bot_lane_queue_seconds", "Time an update waited for a slot in its dispatch lane", ("lane",)
+))
+LANE_UPDATES = REGISTRY.register(Gauge(
+    "dream_bot_lane_updates", "Updates waiting or running in each dispatch lane", ("lane", "state")
+))
+OUTBOX_QUEUE_SECONDS = REGISTRY.register(Histogram(
+    "dream_bot_outbox_queue_seconds", "Time an outgoing Telegram call waited in its chat's send queue", ("kind",)
+))
+OUTBOX_SENDS = REGISTRY.register(Counter(
+    "dream_bot_outbox_sends_total", "Outgoing Telegram calls by result", ("kind", "result")
+))
+
+# Per-request timing breakdown: [(stage, seconds), ...] for the update being handled
+_request_stages = contextvars.ContextVar('request_stages', default=None)
+
+TIMING_SAMPLE_RATE = float(os.getenv('METRICS_TIMING_SAMPLE_RATE', '0'))
+
+
+@contextlib.contextmanager
+def span(stage: str):
+    """Time a processing stage. Works around awaits inside async handlers."""
+    STAGE_IN_FLIGHT.inc(stage=stage)
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        STAGE_IN_FLIGHT.dec(stage=stage)
+        STAGE_SECONDS.observe(elapsed, stage=stage)
+        stages = _request_stages.get()
+        if stages is not None:
+            stages.append((stage, elapsed))
+
+
+@contextlib.contextmanager
+def request_timer(kind: str):
+    """Time the handling of one update and log a sampled per-stage breakdown"""
+    stages = []
+    token = _request_stages.set(stages)
+    REQUESTS_IN_FLIGHT.inc(kind=kind)
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        REQUESTS_IN_FLIGHT.dec(kind=kind)
+        REQUEST_SECONDS.observe(elapsed, kind=kind)
+        _request_stages.reset(token)
+        if TIMING_SAMPLE_RATE and random.random() < TIMING_SAMPLE_RATE:
+            breakdown = ", ".join(f"{stage} {seconds:.3f}s" for stage, seconds in stages)
+            logger.info(f"Timing for {kind}: total {elapsed:.3f}s ({breakdown or 'no stages'})")
+
+
+def timed_handler(kind: str):
+    """Decorate an async update handler with ``request_timer(kind)``"""
+    def decorator(handler):
+        @functools.wraps(handler)
+        async def wrapper(*args, **kwargs):
+            with request_timer(kind):
+                return await handler(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+async def _handle_http(reader, writer):
+    try:
+        request_line = await reader.readline()
+        # Skip the request headers
+        while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+            pass
+        parts = request_line.split()
+        if len(parts) >= 2 and parts[1].split(b"?")[0] == b"/metrics":
+            body = REGISTRY.render().encode('utf-8')
+            status = "200 OK"
+        else:
+            body = b"Not Found\n"
+            status = "404 Not Found"
+        writer.write(
+            f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+            f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode('ascii') + body
+        )
+        await writer.drain()
+    except Exception as e:
+        logger.warning(f"Error serving metrics: {e}")
+    finally:
+        writer.close()
+
+
+async def start_http_server(port: int, host: str = "0.0.0.0"):
+    """Serve ``/metrics`` in Prometheus text format from the running event loop"""
+    server = await asyncio.start_server(_handle_http, host, port)
+    logger.info(f"Metrics available at http://{host}:{port}/metrics")
+    return server
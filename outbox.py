@@ -0,0 +1,255 @@
+import os
+import time
+import asyncio
+import logging
+from collections import deque
+from telegram.error import RetryAfter
+import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """Allows ``rate`` events per second on average, in bursts of up to ``capacity``"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, reserve: float = 0) -> float:
+        """Seconds to wait before a token is available while leaving ``reserve`` tokens in the bucket"""
+        now = time.monotonic()
+        self._refill(now)
+        wait = max(0.0, self.blocked_until - now)
+        needed = min(1 + reserve, self.capacity)
+        if self.tokens < needed:
+            wait = max(wait, (needed - self.tokens) / self.rate)
+        return wait
+
+    def take(self):
+        self.tokens -= 1
+
+    def block(self, seconds: float):
+        """Hand out no tokens for ``seconds``, e.g. after a flood-limit response"""
+        now = time.monotonic()
+        self.blocked_until = max(self.blocked_until, now + seconds)
+        self._refill(now)
+        self.tokens = min(self.tokens, 0)
+
+    def idle(self) -> bool:
+        """Whether the bucket is full again, i.e. forgetting it changes nothing"""
+        return self.delay() == 0 and self.tokens >= self.capacity
+
+
+class _Send:
+    __slots__ = ('factory', 'kind', 'key', 'urgent', 'futures', 'queued_at', 'attempts', 'sending')
+
+    def __init__(self, factory, kind: str, key, urgent: bool = False):
+        self.factory = factory
+        self.kind = kind
+        self.key = key
+        self.urgent = urgent
+        self.futures = []
+        self.queued_at = time.perf_counter()
+        self.attempts = 0
+        self.sending = False
+
+
+class _Chat:
+    __slots__ = ('bucket', 'queue', 'task', 'wakeup')
+
+    def __init__(self, bucket: TokenBucket):
+        self.bucket = bucket
+        self.queue = deque()
+        self.task = None
+        self.wakeup = asyncio.Event()  # Set when an urgent send is queued while the drain task waits
+
+    def enqueue(self, item: _Send):
+        """Append a send; an urgent one goes ahead of every other send that has not been tried yet"""
+        if not item.urgent:
+            self.queue.append(item)
+            return
+        index = next((index for index, queued in enumerate(self.queue)
+                      if not queued.urgent and queued.attempts == 0 and not queued.sending), len(self.queue))
+        self.queue.insert(index, item)
+        self.wakeup.set()
+
+
+class Outbox:
+    """Delivers outgoing Telegram calls through per-chat queues within rate limits.
+
+    Every chat has a FIFO queue drained by its own task, so one chat never
+    waits behind another. Each send takes a token from the chat's bucket and
+    from a global one, keeping the bot under Telegram's flood limits instead
+    of running into them. A ``RetryAfter`` response pauses the chat for the
+    requested time and retries the same call. A send with the ``key`` of a
+    call still waiting in the queue replaces it: only the latest version is
+    delivered and every caller gets its result.
+
+    Urgent sends, the answers to buttons and commands, skip ahead of queued
+    ones in their chat. Other sends leave one token of the chat's bucket and
+    ``urgent_reserve`` tokens of the global one unused, so an urgent send
+    finds a token right away even while dream replies saturate the limits.
+    """
+
+    def __init__(self, chat_rate: float = None, chat_burst: float = None, global_rate: float = None,
+                 global_burst: float = None, max_retries: int = None, urgent_reserve: float = None):
+        self.chat_rate = chat_rate or float(os.getenv('OUTBOX_CHAT_RATE', '1.0'))
+        self.chat_burst = chat_burst or float(os.getenv('OUTBOX_CHAT_BURST', '3'))
+        global_rate = global_rate or float(os.getenv('OUTBOX_GLOBAL_RATE', '30'))
+        self.bucket = TokenBucket(global_rate, global_burst or float(os.getenv('OUTBOX_GLOBAL_BURST', '30')))
+        self.max_retries = max_retries if max_retries is not None else int(os.getenv('OUTBOX_MAX_RETRIES', '3'))
+        self.urgent_reserve = (urgent_reserve if urgent_reserve is not None
+                               else float(os.getenv('OUTBOX_URGENT_RESERVE', '5')))
+        self._chats = {}  # Format: {chat_id: _Chat}
+        self.queued = 0
+        self.sent = 0
+        self.coalesced = 0
+        self.retried = 0
+        self.failed = 0
+
+    def stats(self) -> dict:
+        """Get queue depth and delivery counters"""
+        return {
+            'queued': self.queued,
+            'chats': len(self._chats),
+            'sent': self.sent,
+            'coalesced': self.coalesced,
+            'retried': self.retried,
+            'failed': self.failed
+        }
+
+    def _chat(self, chat_id) -> _Chat:
+        chat = self._chats.get(chat_id)
+        if chat is None:
+            if len(self._chats) >= 1000:
+                self._prune()
+            chat = self._chats[chat_id] = _Chat(TokenBucket(self.chat_rate, self.chat_burst))
+        return chat
+
+    def try_acquire(self, chat_id) -> bool:
+        """Take a chat and a global token for a call made outside the queue, if both are free right now
+
+        Meant for sends that may simply be skipped, like intermediate edits of a streamed reply:
+        they never wait, never overtake queued sends of the chat and leave the urgent reserve alone.
+        """
+        chat = self._chat(chat_id)
+        if chat.queue or chat.bucket.delay(1) > 0 or self.bucket.delay(self.urgent_reserve) > 0:
+            return False
+        chat.bucket.take()
+        self.bucket.take()
+        return True
+
+    async def send(self, chat_id, factory, kind: str = 'message', key=None, urgent: bool = False):
+        """Queue ``await factory()`` for delivery to a chat and wait for its result"""
+        chat = self._chat(chat_id)
+
+        future = asyncio.get_running_loop().create_future()
+        pending = None
+        if key is not None:
+            pending = next((item for item in chat.queue if item.key == key and not item.sending), None)
+        if pending is not None:
+            # Deliver the latest version only; it answers every caller
+            pending.factory = factory
+            pending.futures.append(future)
+            if urgent and not pending.urgent:
+                chat.queue.remove(pending)
+                pending.urgent = True
+                chat.enqueue(pending)
+            self.coalesced += 1
+            metrics.OUTBOX_SENDS.inc(kind=kind, result='coalesced')
+        else:
+            item = _Send(factory, kind, key, urgent)
+            item.futures.append(future)
+            chat.enqueue(item)
+            self.queued += 1
+        if chat.task is None:
+            chat.task = asyncio.create_task(self._drain(chat_id, chat))
+        return await future
+
+    def _prune(self):
+        """Forget chats with nothing queued whose rate limit has fully recovered"""
+        for chat_id, chat in list(self._chats.items()):
+            if chat.task is None and not chat.queue and chat.bucket.idle():
+                del self._chats[chat_id]
+
+    async def _wait_for_tokens(self, chat: _Chat) -> _Send:
+        """Wait until the send at the head of the queue may go out and take its tokens"""
+        while True:
+            item = chat.queue[0]
+            if item.urgent:
+                delay = max(chat.bucket.delay(), self.bucket.delay())
+            else:
+                delay = max(chat.bucket.delay(1), self.bucket.delay(self.urgent_reserve))
+            if delay == 0:
+                chat.bucket.take()
+                self.bucket.take()
+                return item
+            # An urgent send queued meanwhile becomes the new head and may not need to wait
+            chat.wakeup.clear()
+            try:
+                await asyncio.wait_for(chat.wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _drain(self, chat_id, chat: _Chat):
+        try:
+            while chat.queue:
+                item = await self._wait_for_tokens(chat)
+                if item.attempts == 0:
+                    metrics.OUTBOX_QUEUE_SECONDS.observe(time.perf_counter() - item.queued_at, kind=item.kind)
+                item.attempts += 1
+                item.sending = True
+                try:
+                    result = await item.factory()
+                except RetryAfter as e:
+                    item.sending = False
+                    chat.bucket.block(e.retry_after)
+                    if item.attempts <= self.max_retries:
+                        # Keep the call at the head of the queue and send it once the chat is unblocked
+                        self.retried += 1
+                        metrics.OUTBOX_SENDS.inc(kind=item.kind, result='retry_after')
+                        logger.warning(f"Telegram asked to wait {e.retry_after}s before sending to chat {chat_id}")
+                        continue
+                    self._finish(chat, item, error=e)
+                except Exception as e:
+                    self._finish(chat, item, error=e)
+                else:
+                    self._finish(chat, item, result=result)
+        finally:
+            chat.task = None
+
+    def _finish(self, chat: _Chat, item: _Send, result=None, error: Exception = None):
+        chat.queue.remove(item)
+        self.queued -= 1
+        if error is None:
+            self.sent += 1
+            metrics.OUTBOX_SENDS.inc(kind=item.kind, result='sent')
+        else:
+            self.failed += 1
+            metrics.OUTBOX_SENDS.inc(kind=item.kind, result='error')
+        for future in item.futures:
+            if future.done():
+                continue
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
+
+    async def stop(self, timeout: float = 10.0):
+        """Wait for queued sends to be delivered, then cancel what is left"""
+        tasks = [chat.task for chat in self._chats.values() if chat.task is not None]
+        if not tasks:
+            return
+        done, pending = await asyncio.wait(tasks, timeout=timeout)
+        for task in pending:
+            task.cancel()
+        if pending:
+            logger.warning(f"Dropped queued messages for {len(pending)} chat(s) on shutdown")
@@ -0,0 +1,160 @@
+import os
+import re
+import hashlib
+import logging
+import functools
+
+try:
+    import tiktoken
+except ImportError:  # Token counts are estimated without it
+    tiktoken = None
+
+logger = logging.getLogger(__name__)
+
+SYSTEM_PROMPT = """Ты толкователь снов, который сочетает психологические знания с пониманием символов и архетипов. Твои интерпретации должны быть понятными, глубокими и увлекательными. Отвечай мягко и поддерживающе, помогая человеку осознать возможные значения сна, но не навязывая однозначных выводов.
+
+**Структура ответа для нового сна:**
+1. Начни с краткого пересказа ключевых моментов сна (1-2 предложения)
+2. Выдели 2-3 главных символа или темы
+3. Объясни возможные значения этих символов
+4. Свяжи толкование с текущей жизненной ситуацией человека
+5. Заверши позитивным наблюдением или инсайтом
+
+**Структура ответа для уточняющих вопросов:**
+1. Сфокусируйся на конкретном аспекте или символе, о котором спрашивает человек
+2. Дай более глубокое толкование этого аспекта
+3. Свяжи его с общим контекстом сна
+
+**Стиль общения:**
+- Используй дружелюбный, но уважительный тон
+- Избегай категоричных утверждений, используй фразы "возможно", "это может означать", "часто символизирует"
+- Не давай советов по действиям в реальной жизни
+- Фокусируйся на эмоциональном и символическом значении"""
+
+NEW_DREAM_TEMPLATE = "Пожалуйста, помоги разобраться в значении этого сна: {dream_text}"
+
+# Cached interpretations are invalidated whenever the prompt changes
+PROMPT_VERSION = hashlib.sha256((SYSTEM_PROMPT + NEW_DREAM_TEMPLATE).encode('utf-8')).hexdigest()[:12]
+
+CONTEXT_DREAM_TEMPLATE = "Вот мой сон: {dream_text}"
+
+# Chat format overhead: role and separators of each message, and the primer of the reply
+MESSAGE_OVERHEAD = 3
+REPLY_OVERHEAD = 3
+
+SENTENCE_END_RE = re.compile(r'(?<=[.!?…])\s+')
+
+
+@functools.lru_cache(maxsize=None)
+def _encoding(model: str):
+    if tiktoken is None:
+        return None
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding('cl100k_base')
+
+
+def count_tokens(text: str, model: str = 'gpt-4') -> int:
+    """Count the tokens of a text with tiktoken, or estimate them without it"""
+    encoding = _encoding(model)
+    if encoding is None:
+        # Russian text averages about 3 characters per token for GPT-4
+        return len(text) // 3 + 1
+    return len(encoding.encode(text))
+
+
+def count_message_tokens(messages: list, model: str = 'gpt-4') -> int:
+    """Count the prompt tokens of chat messages"""
+    return sum(MESSAGE_OVERHEAD + count_tokens(message['content'], model) for message in messages) + REPLY_OVERHEAD
+
+
+def _cut(text: str, max_tokens: int, model: str) -> str:
+    """Cut a text to at most ``max_tokens`` at a word boundary"""
+    encoding = _encoding(model)
+    if encoding is None:
+        text = text[:max(0, max_tokens - 1) * 3]
+    else:
+        text = encoding.decode(encoding.encode(text)[:max_tokens]).rstrip('\ufffd')
+    head, space, _ = text.rpartition(' ')
+    return head if space and head else text
+
+
+def trim_text(text: str, max_tokens: int, model: str = 'gpt-4') -> str:
+    """Shorten a text to about ``max_tokens``, keeping whole sentences from the start"""
+    if count_tokens(text, model) <= max_tokens:
+        return text
+    budget = max_tokens - 1  # Room for the ellipsis
+    kept, used = [], 0
+    for sentence in SENTENCE_END_RE.split(text.strip()):
+        cost = count_tokens(sentence + ' ', model)
+        if used + cost > budget:
+            break
+        kept.append(sentence)
+        used += cost
+    if not kept:
+        # Even the first sentence is too long
+        return _cut(text, budget, model) + '…'
+    return ' '.join(kept) + ' …'
+
+
+class PromptBuilder:
+    """Assembles the chat messages sent to GPT within a token budget.
+
+    The system prompt is always the first message and never changes, so every
+    request starts with the same bytes and upstream prompt caching can reuse
+    that prefix. Everything that varies comes after it: a very long dream is
+    trimmed to ``max_dream_tokens``, and earlier dreams sent with a follow-up
+    are compacted to their first sentences within per-dream limits. If the
+    prompt still exceeds ``max_prompt_tokens`` the oldest context is dropped.
+    """
+
+    def __init__(self, model: str = 'gpt-4', max_prompt_tokens: int = None, max_dream_tokens: int = None,
+                 context_dream_tokens: int = None, context_interpretation_tokens: int = None):
+        self.model = model
+        self.max_prompt_tokens = max_prompt_tokens or int(os.getenv('PROMPT_MAX_TOKENS', '3000'))
+        self.max_dream_tokens = max_dream_tokens or int(os.getenv('PROMPT_MAX_DREAM_TOKENS', '1500'))
+        self.context_dream_tokens = context_dream_tokens or int(os.getenv('PROMPT_CONTEXT_DREAM_TOKENS', '300'))
+        self.context_interpretation_tokens = context_interpretation_tokens or int(
+            os.getenv('PROMPT_CONTEXT_INTERPRETATION_TOKENS', '400')
+        )
+        self.system_message = {"role": "system", "content": SYSTEM_PROMPT}
+        self.system_tokens = MESSAGE_OVERHEAD + count_tokens(SYSTEM_PROMPT, model)
+
+    def _message(self, role: str, content: str):
+        """Get a message and its token count"""
+        return {"role": role, "content": content}, MESSAGE_OVERHEAD + count_tokens(content, self.model)
+
+    def _context(self, dream: dict):
+        """Get the compacted user/assistant pair of an earlier dream and its token count"""
+        dream_text = trim_text(dream['dream'], self.context_dream_tokens, self.model)
+        interpretation = trim_text(dream['interpretation'], self.context_interpretation_tokens, self.model)
+        user, user_tokens = self._message("user", CONTEXT_DREAM_TEMPLATE.format(dream_text=dream_text))
+        assistant, assistant_tokens = self._message("assistant", interpretation)
+        return [user, assistant], user_tokens + assistant_tokens
+
+    def context_cost(self, dream: dict) -> int:
+        """Get the prompt tokens an earlier dream adds to a follow-up"""
+        return self._context(dream)[1]
+
+    def new_dream(self, dream_text: str):
+        """Build the prompt for a new dream: ``(messages, prompt_tokens)``"""
+        dream_text = trim_text(dream_text, self.max_dream_tokens, self.model)
+        message, tokens = self._message("user", NEW_DREAM_TEMPLATE.format(dream_text=dream_text))
+        return [self.system_message, message], self.system_tokens + tokens + REPLY_OVERHEAD
+
+    def follow_up(self, question: str, dreams: list):
+        """Build the prompt for a question about earlier ``dreams`` (oldest first): ``(messages, prompt_tokens)``"""
+        message, tokens = self._message("user", trim_text(question, self.max_dream_tokens, self.model))
+        total = self.system_tokens + tokens + REPLY_OVERHEAD
+        pairs = [self._context(dream) for dream in dreams]
+        total += sum(pair_tokens for _, pair_tokens in pairs)
+        while pairs and total > self.max_prompt_tokens:
+            total -= pairs.pop(0)[1]
+            logger.info("Dropped the oldest dream from a follow-up prompt to stay within the token budget")
+
+        messages = [self.system_message]
+        for pair, _ in pairs:
+            messages.extend(pair)
+        messages.append(message)
+        return messages, total
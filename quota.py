@@ -0,0 +1,210 @@
+import logging
+import threading
+import contextlib
+from array import array
+from bisect import bisect_left
+from datetime import datetime
+from storage import month_key
+
+logger = logging.getLogger(__name__)
+
+# Monthly limit of 20 messages (combined voice and text)
+MONTHLY_LIMIT = 20
+
+
+class QuotaTracker:
+    """In-memory per-user monthly counters.
+
+    Counters are loaded from storage with ``warm_load()``, updated when a
+    dream is logged and reset when the month changes. Until the load is
+    done, a user's counters are looked up in storage on their own when the
+    user is first seen, and users looked up this way keep their counters
+    when the loaded ones are swapped in. Storage is never read with the
+    counters' lock held; code on an event loop should call ``load_user()``
+    in a thread when ``needs_lookup()`` says a call would read storage.
+    Counters can also be restored from the arrays of a warm-state
+    snapshot, which are read in place: a user's counters are copied out only
+    when that user is first seen. A slot can be reserved before calling GPT
+    so that parallel requests from one user cannot overrun the limit.
+    """
+
+    def __init__(self, storage, limit: int = MONTHLY_LIMIT):
+        self.storage = storage
+        self.limit = limit
+        self._lock = threading.Lock()       # Guards the counters; never held while storage is read
+        self._load_lock = threading.Lock()  # One full load at a time
+        self._month = None
+        self._complete = False  # Whether every user's counters are in memory, not only those looked up
+        self._usage = {}     # Format: {user_id: [total_dreams, voice_messages, text_messages]}
+        self._reserved = {}  # Format: {user_id: reserved_slots}
+        # Restored snapshot: sorted user ids and their counters, three per user
+        self._base_ids = None
+        self._base_counters = None
+
+    def _read_usage(self, month: str) -> dict:
+        usage = {}
+        try:
+            for user_id, user_data in self.storage.iter_user_usage(month):
+                usage[int(user_id)] = [
+                    user_data.get('total_dreams', 0),
+                    user_data.get('voice_messages', 0),
+                    user_data.get('text_messages', 0)
+                ]
+        except Exception as e:
+            logger.error(f"Error loading quota counters: {e}")
+        logger.info(f"Loaded quota counters for {len(usage)} users ({month})")
+        return usage
+
+    def warm_load(self):
+        """Load current month's counters from storage now, unless they are already loaded"""
+        with self._load_lock:
+            if self._complete:
+                return
+            month = month_key(datetime.now())
+            usage = self._read_usage(month)
+            with self._lock:
+                if self._complete or self._month not in (None, month):
+                    return
+                # Users looked up or counted while the load ran are more current
+                usage.update(self._usage)
+                self._usage = usage
+                self._month = month
+                self._complete = True
+
+    def needs_lookup(self, user_id: int) -> bool:
+        """Whether a call for this user would read storage first"""
+        return not self._complete and int(user_id) not in self._usage
+
+    def load_user(self, user_id: int):
+        """Look up one user's counters in storage, unless every user's counters are loaded"""
+        if not getattr(self.storage, 'per_user_lookups', True):
+            # Reading one user would parse the whole month too; wait for the full load instead of racing it
+            self.warm_load()
+            return
+        user_id = int(user_id)
+        month = month_key(datetime.now())
+        try:
+            user_data = self.storage.get_user_usage(user_id, month) or {}
+        except Exception as e:
+            logger.error(f"Error loading quota counters for user {user_id}: {e}")
+            user_data = {}
+        counters = [user_data.get('total_dreams', 0), user_data.get('voice_messages', 0),
+                    user_data.get('text_messages', 0)]
+        with self._lock:
+            if self._complete or self._month not in (None, month):
+                return
+            self._month = month
+            self._usage.setdefault(user_id, counters)
+
+    @contextlib.contextmanager
+    def _locked(self, user_id: int):
+        """Hold the counters' lock, with the user's counters in memory"""
+        if self.needs_lookup(user_id):
+            self.load_user(user_id)
+        with self._lock:
+            self._roll_month()
+            yield
+
+    def _roll_month(self):
+        """Reset counters when a new month starts. Must be called with the lock held."""
+        month = month_key(datetime.now())
+        if self._month is not None and month != self._month:
+            logger.info(f"New month {month}, resetting quota counters")
+            self._usage = {}
+            self._month = month
+            self._complete = True
+            self._reserved = {}
+            self._base_ids = self._base_counters = None
+
+    def restore_state(self, month: str, user_ids, counters):
+        """Use counters saved by ``export_state()`` instead of loading them from storage.
+
+        ``user_ids`` must be sorted; both sequences are only read, never copied.
+        """
+        with self._lock:
+            if self._month is not None:
+                return False
+            self._month = month
+            self._complete = True
+            self._usage = {}
+            self._base_ids = user_ids
+            self._base_counters = counters
+        logger.info(f"Restored quota counters for {len(user_ids)} users ({month})")
+        return True
+
+    def export_state(self):
+        """Get ``(month, user_ids, counters)`` as sorted typed arrays, or None if nothing is loaded"""
+        with self._lock:
+            if not self._complete:
+                return None
+            usage = dict(self._usage)
+            if self._base_ids is not None:
+                for index, user_id in enumerate(self._base_ids):
+                    if user_id not in usage:
+                        usage[user_id] = self._base_counters[3 * index:3 * index + 3]
+            month = self._month
+        user_ids = array('q', sorted(usage))
+        counters = array('i')
+        for user_id in user_ids:
+            counters.extend(usage[user_id])
+        return month, user_ids, counters
+
+    def _counters(self, user_id: int):
+        """Get a user's counters, copying them out of the restored snapshot on first use. Must be called with the lock held."""
+        counters = self._usage.get(user_id)
+        if counters is None and self._base_ids is not None:
+            index = bisect_left(self._base_ids, user_id)
+            if index < len(self._base_ids) and self._base_ids[index] == user_id:
+                counters = self._usage[user_id] = list(self._base_counters[3 * index:3 * index + 3])
+        return counters
+
+    def usage(self, user_id: int) -> dict:
+        """Get user's usage for current month"""
+        with self._locked(user_id):
+            total, voice, text = self._counters(int(user_id)) or (0, 0, 0)
+        return {"total_dreams": total, "voice_messages": voice, "text_messages": text}
+
+    def remaining(self, user_id: int) -> int:
+        """Get the number of interpretations left, counting reserved slots as used"""
+        user_id = int(user_id)
+        with self._locked(user_id):
+            used = (self._counters(user_id) or (0,))[0] + self._reserved.get(user_id, 0)
+        return max(0, self.limit - used)
+
+    def has_quota(self, user_id: int) -> bool:
+        return self.remaining(user_id) > 0
+
+    def reserve(self, user_id: int) -> bool:
+        """Reserve a slot for an interpretation in progress. Returns False if the limit is reached."""
+        user_id = int(user_id)
+        with self._locked(user_id):
+            used = (self._counters(user_id) or (0,))[0] + self._reserved.get(user_id, 0)
+            if used >= self.limit:
+                return False
+            self._reserved[user_id] = self._reserved.get(user_id, 0) + 1
+            return True
+
+    def release(self, user_id: int):
+        """Give back a reserved slot that was not used"""
+        user_id = int(user_id)
+        with self._locked(user_id):
+            self._release_locked(user_id)
+
+    def _release_locked(self, user_id: int):
+        reserved = self._reserved.get(user_id, 0)
+        if reserved <= 1:
+            self._reserved.pop(user_id, None)
+        else:
+            self._reserved[user_id] = reserved - 1
+
+    def record(self, user_id: int, message_type: str):
+        """Count a logged dream, consuming a reserved slot if there is one"""
+        user_id = int(user_id)
+        with self._locked(user_id):
+            counters = self._counters(user_id) or self._usage.setdefault(user_id, [0, 0, 0])
+            counters[0] += 1
+            if message_type == 'voice':
+                counters[1] += 1
+            elif message_type == 'text':
+                counters[2] += 1
+            self._release_locked(user_id)
@@ -0,0 +1,154 @@
+import os
+import hashlib
+import logging
+import threading
+from datetime import datetime, timedelta
+from cache import read_cache_stats
+
+logger = logging.getLogger(__name__)
+
+EMPTY_MONTHLY_STATS = {
+    'total_dreams': 0,
+    'voice_messages': 0,
+    'text_messages': 0,
+    'total_users': 0,
+    'tokens_used': 0,
+    'prompt_tokens': 0,
+    'completion_tokens': 0,
+    'errors': 0
+}
+
+
+class DashboardRollup:
+    """Dashboard aggregates, recomputed only when the underlying statistics change.
+
+    The analytics change token (file mtime or database version) is checked on
+    every request; as long as it is unchanged, the cached aggregates, derived
+    metrics and ETag are returned without touching the data.
+    """
+
+    MAX_DAYS = 366
+
+    def __init__(self, analytics, days: int = 7, gpt4_prompt_cost_per_1k: float = None,
+                 gpt4_completion_cost_per_1k: float = None, whisper_cost_per_minute: float = 0.006,
+                 cache_stats_path: str = None):
+        self.analytics = analytics
+        self.days = days
+        self.gpt4_prompt_cost_per_1k = gpt4_prompt_cost_per_1k or float(os.getenv('GPT4_PROMPT_PRICE_PER_1K', '0.03'))
+        self.gpt4_completion_cost_per_1k = gpt4_completion_cost_per_1k or float(
+            os.getenv('GPT4_COMPLETION_PRICE_PER_1K', '0.06')
+        )
+        self.whisper_cost_per_minute = whisper_cost_per_minute
+        self.cache_stats_path = cache_stats_path or os.getenv('INTERPRETATION_CACHE_STATS', 'analytics/cache_stats.json')
+        self._lock = threading.Lock()
+        self._snapshots = {}  # Format: {days: (version, snapshot)}
+        # Part of every ETag, so a page cached from another process or an earlier run is never confirmed
+        self.nonce = os.urandom(8).hex()
+        self.recomputes = 0
+
+    def _dates(self, now: datetime, days: int) -> list:
+        return [(now - timedelta(days=i)).strftime('%Y-%m-%d') for i in range(days)]
+
+    def _current_version(self, now: datetime, dates: list):
+        months = sorted({date[:7] for date in dates})
+        try:
+            cache_mtime = os.stat(self.cache_stats_path).st_mtime_ns
+        except OSError:
+            cache_mtime = None
+        return (dates[0], self.analytics.change_token(months), cache_mtime)
+
+    def get(self, days: int = None) -> dict:
+        """Get the current snapshot for the last ``days`` days: ``{'etag': str, 'context': dict}``"""
+        days = max(1, min(days or self.days, self.MAX_DAYS))
+        now = datetime.now()
+        dates = self._dates(now, days)
+        version = (days,) + self._current_version(now, dates)
+        with self._lock:
+            cached = self._snapshots.get(days)
+            if cached is None or cached[0] != version:
+                months = sorted({date[:7] for date in dates})
+                # Versions read on both sides of the aggregates must match, so the page knows exactly
+                # which live deltas it includes; a batch written in between means reading again
+                for _ in range(3):
+                    versions = self.analytics.write_versions(months)
+                    context = self.compute(now, dates)
+                    if self.analytics.write_versions(months) == versions:
+                        break
+                    version = (days,) + self._current_version(now, dates)
+                context['live_versions'] = versions
+                etag = '"' + hashlib.sha1(repr((self.nonce, version)).encode('utf-8')).hexdigest() + '"'
+                if cached is None and len(self._snapshots) >= 8:
+                    self._snapshots.clear()
+                cached = self._snapshots[days] = (version, {'etag': etag, 'context': context})
+                self.recomputes += 1
+            return cached[1]
+
+    def _top_themes(self) -> list:
+        """Current month's top themes with their share of themed dreams"""
+        themes = self.analytics.get_top_themes()
+        total = sum(count for _, count in themes)
+        return [
+            {'theme': theme, 'count': count, 'percentage': round(count / total * 100, 1)}
+            for theme, count in themes
+        ]
+
+    def estimate_cost(self, stats: dict) -> float:
+        """Estimate the cost in dollars of a set of counters, e.g. a month or a live delta"""
+        # Calculate estimated costs from the recorded prompt and completion tokens
+        estimated_voice_minutes = stats['voice_messages'] * 2  # Assuming average 2 minutes per voice message
+
+        prompt_tokens = stats.get('prompt_tokens', 0)
+        completion_tokens = stats.get('completion_tokens', 0)
+        # Tokens logged before prompt and completion were counted apart are priced as prompt tokens
+        unsplit_tokens = max(0, stats['tokens_used'] - prompt_tokens - completion_tokens)
+        gpt4_cost = (
+            (prompt_tokens + unsplit_tokens) / 1000 * self.gpt4_prompt_cost_per_1k
+            + completion_tokens / 1000 * self.gpt4_completion_cost_per_1k
+        )
+        whisper_cost = estimated_voice_minutes * self.whisper_cost_per_minute
+        return gpt4_cost + whisper_cost
+
+    def compute(self, now: datetime, dates: list) -> dict:
+        """Compute aggregates and derived metrics for the dashboard"""
+        # Get current month's stats
+        monthly_stats = self.analytics.get_monthly_stats() or dict(EMPTY_MONTHLY_STATS)
+
+        # Get daily stats for the last days, reading only the months they cover
+        daily_stats = []
+        for date, day in self.analytics.iter_daily_stats(dates[-1], dates[0]):
+            stats = dict(day)
+            stats['date'] = date
+            daily_stats.append(stats)
+        # Newest first
+        daily_stats.reverse()
+
+        # Calculate some derived metrics
+        if monthly_stats['total_dreams'] > 0:
+            voice_percentage = (monthly_stats['voice_messages'] / monthly_stats['total_dreams']) * 100
+            text_percentage = (monthly_stats['text_messages'] / monthly_stats['total_dreams']) * 100
+            avg_tokens_per_dream = monthly_stats['tokens_used'] / monthly_stats['total_dreams']
+            error_rate = (monthly_stats['errors'] / monthly_stats['total_dreams']) * 100
+        else:
+            voice_percentage = 0
+            text_percentage = 0
+            avg_tokens_per_dream = 0
+            error_rate = 0
+
+        total_cost = self.estimate_cost(monthly_stats)
+
+        return {
+            "monthly_stats": monthly_stats,
+            "daily_stats": daily_stats,
+            "days": len(dates),
+            "period_dreams": sum(stats.get('total_dreams', 0) for stats in daily_stats),
+            "voice_percentage": round(voice_percentage, 1),
+            "text_percentage": round(text_percentage, 1),
+            "avg_tokens_per_dream": round(avg_tokens_per_dream, 1),
+            "error_rate": round(error_rate, 1),
+            "current_month": now.strftime('%B %Y'),
+            "month": now.strftime('%Y-%m'),
+            "estimated_cost": round(total_cost, 2),
+            "top_themes": self._top_themes(),
+            "themes_partial": self.analytics.has_partial_themes(),
+            "cache_stats": read_cache_stats(self.cache_stats_path)
+        }
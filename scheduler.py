@@ -0,0 +1,113 @@
+import os
+import asyncio
+import logging
+import functools
+import contextlib
+import contextvars
+
+logger = logging.getLogger(__name__)
+
+
+class Overloaded(Exception):
+    """Raised when a job cannot be admitted. ``reason`` is 'user', 'global' or 'duplicate'."""
+
+    def __init__(self, reason: str):
+        super().__init__(f"Job rejected ({reason})")
+        self.reason = reason
+
+
+# Why a serialized handler rejected the update it was called for; seen by whoever awaited the handler
+rejected_job = contextvars.ContextVar('rejected_job', default=None)
+
+
+class UserScheduler:
+    """Admission control between the update handlers and the LLM.
+
+    Each user has at most one job running; up to ``per_user_queue`` more wait
+    behind it in arrival order. The total number of admitted jobs is capped by
+    ``max_pending`` so that a slow upstream sheds load instead of piling up
+    work. A job whose key (e.g. the same text) is already queued for the user
+    is rejected as a duplicate.
+    """
+
+    def __init__(self, per_user_queue: int = None, max_pending: int = None):
+        self.per_user_queue = per_user_queue if per_user_queue is not None else int(os.getenv('SCHEDULER_USER_QUEUE', '2'))
+        self.max_pending = max_pending or int(os.getenv('SCHEDULER_MAX_PENDING', '200'))
+        self._users = {}  # Format: {user_id: {'lock': asyncio.Lock, 'jobs': int, 'keys': set}}
+        self.pending = 0
+        self.rejected = {'user': 0, 'global': 0, 'duplicate': 0}
+
+    def stats(self) -> dict:
+        """Get the number of admitted jobs and rejection counters"""
+        return {
+            'pending': self.pending,
+            'max_pending': self.max_pending,
+            'users': len(self._users),
+            'rejected': dict(self.rejected)
+        }
+
+    def _reject(self, user_id, reason: str):
+        self.rejected[reason] += 1
+        logger.info(f"Rejected job for user {user_id}: {reason} (pending: {self.pending})")
+        raise Overloaded(reason)
+
+    def _admit(self, user_id, key) -> dict:
+        """Count a new job in or raise Overloaded"""
+        state = self._users.get(user_id)
+        if state is not None and key is not None and key in state['keys']:
+            self._reject(user_id, 'duplicate')
+        if state is not None and state['jobs'] > self.per_user_queue:
+            self._reject(user_id, 'user')
+        if self.pending >= self.max_pending:
+            self._reject(user_id, 'global')
+
+        if state is None:
+            state = self._users[user_id] = {'lock': asyncio.Lock(), 'jobs': 0, 'keys': set()}
+        state['jobs'] += 1
+        if key is not None:
+            state['keys'].add(key)
+        self.pending += 1
+        return state
+
+    def _leave(self, user_id, state: dict, key):
+        self.pending -= 1
+        state['jobs'] -= 1
+        state['keys'].discard(key)
+        if state['jobs'] == 0:
+            del self._users[user_id]
+
+    @contextlib.asynccontextmanager
+    async def slot(self, user_id, key=None):
+        """Wait for the user's turn and hold it for the duration of a job"""
+        state = self._admit(user_id, key)
+        try:
+            async with state['lock']:
+                yield
+        finally:
+            self._leave(user_id, state, key)
+
+    def serialized(self, key=None, on_overload=None):
+        """Decorate an update handler so it runs through ``slot()`` for the update's user.
+
+        ``key(update)`` identifies duplicate jobs; ``on_overload(update, context, reason)``
+        is awaited instead of the handler when the job is rejected.
+        """
+        def decorator(handler):
+            @functools.wraps(handler)
+            async def wrapper(update, context):
+                user_id = update.effective_user.id
+                job_key = key(update) if key else None
+                try:
+                    state = self._admit(user_id, job_key)
+                except Overloaded as e:
+                    rejected_job.set(e.reason)
+                    if on_overload is not None:
+                        await on_overload(update, context, e.reason)
+                    return None
+                try:
+                    async with state['lock']:
+                        return await handler(update, context)
+                finally:
+                    self._leave(user_id, state, job_key)
+            return wrapper
+        return decorator
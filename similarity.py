@@ -0,0 +1,161 @@
+import os
+import re
+import zlib
+import logging
+from collections import OrderedDict
+import numpy as np
+from themes import tokenize
+from prompts import count_tokens
+
+logger = logging.getLogger(__name__)
+
+# Phrases that mark a message as a question about an earlier dream
+FOLLOW_UP_PHRASES = (
+    'почему', 'что значит', 'что это значит', 'что означает', 'можешь объяснить', 'объясни',
+    'расскажи подробнее', 'расскажи про', 'расскажи о', 'как это понимать', 'уточни', 'поясни',
+    'а что', 'а если', 'а почему', 'что символизирует'
+)
+
+WORD_COUNT_RE = re.compile(r'\w+')
+# Matched against the words of a message joined by single spaces, so punctuation and case do not matter
+FOLLOW_UP_RE = re.compile(r'\b(?:' + '|'.join(map(re.escape, FOLLOW_UP_PHRASES)) + r')\b')
+
+
+def asks_about_dream(text: str) -> bool:
+    """Whether a message is worded like a question about an earlier dream.
+
+    One of the follow-up phrases must appear as whole words, and the message
+    must be shaped like a question: it starts with the phrase or ends with a
+    question mark. A dream that merely mentions "почему" is not a follow-up.
+    """
+    words = ' '.join(WORD_COUNT_RE.findall(text.lower()))
+    match = FOLLOW_UP_RE.search(words)
+    if match is None:
+        return False
+    return match.start() == 0 or text.rstrip().endswith('?')
+
+
+def embed(text: str, dim: int = 512) -> np.ndarray:
+    """Hashing embedding of a text: sublinear counts of word stems and stem pairs, L2-normalized"""
+    tokens = tokenize(text or '')
+    features = tokens + [f"{first} {second}" for first, second in zip(tokens, tokens[1:])]
+    vector = np.zeros(dim, dtype=np.float32)
+    if not features:
+        return vector
+    buckets = np.fromiter((zlib.crc32(feature.encode('utf-8')) % dim for feature in features),
+                          dtype=np.intp, count=len(features))
+    np.add.at(vector, buckets, 1.0)
+    np.log1p(vector, out=vector)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+class SimilarityIndex:
+    """Per-user in-memory vectors of stored dreams for follow-ups and "similar dreams".
+
+    Each dream is embedded once (dream text plus, at lower weight, its
+    interpretation) and kept in a per-user matrix, so a query is one
+    embedding and one small matrix-vector product. The index follows the
+    dream history: it is rebuilt for a user whenever their stored dream ids
+    change, embedding only dreams it has not seen.
+    """
+
+    def __init__(self, dim: int = None, max_users: int = None, follow_up_similarity: float = None,
+                 context_tokens: int = None):
+        self.dim = dim or int(os.getenv('SIMILARITY_DIM', '512'))
+        self.max_users = max_users or int(os.getenv('SIMILARITY_MAX_USERS', '10000'))
+        self.follow_up_similarity = follow_up_similarity or float(os.getenv('FOLLOW_UP_SIMILARITY', '0.2'))
+        self.context_tokens = context_tokens or int(os.getenv('FOLLOW_UP_CONTEXT_TOKENS', '1500'))
+        self._users = OrderedDict()  # Format: {user_id: (dream_ids tuple, matrix)}, least recently used first
+        self._vectors = {}           # Format: {(user_id, dream_id): vector}
+
+    def _embed_dream(self, dream: dict) -> np.ndarray:
+        vector = embed(dream['dream'], self.dim) + 0.5 * embed(dream['interpretation'], self.dim)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def _matrix(self, user_id, dreams: list) -> np.ndarray:
+        """Get the user's dream matrix, in the order of ``dreams``"""
+        ids = tuple(dream['id'] for dream in dreams)
+        cached = self._users.get(user_id)
+        if cached is not None and cached[0] == ids:
+            self._users.move_to_end(user_id)
+            return cached[1]
+
+        if cached is not None:
+            # Drop vectors of dreams that left the history
+            for dream_id in set(cached[0]) - set(ids):
+                self._vectors.pop((user_id, dream_id), None)
+        rows = []
+        for dream in dreams:
+            vector = self._vectors.get((user_id, dream['id']))
+            if vector is None:
+                vector = self._vectors[(user_id, dream['id'])] = self._embed_dream(dream)
+            rows.append(vector)
+        matrix = np.vstack(rows) if rows else np.zeros((0, self.dim), dtype=np.float32)
+
+        self._users[user_id] = (ids, matrix)
+        self._users.move_to_end(user_id)
+        while len(self._users) > self.max_users:
+            evicted, (evicted_ids, _) = self._users.popitem(last=False)
+            for dream_id in evicted_ids:
+                self._vectors.pop((evicted, dream_id), None)
+        return matrix
+
+    def scores(self, user_id, text: str, dreams: list) -> np.ndarray:
+        """Cosine similarity of a text to each of the user's dreams"""
+        if not dreams:
+            return np.zeros(0, dtype=np.float32)
+        return self._matrix(user_id, dreams) @ embed(text, self.dim)
+
+    def similar(self, user_id, dream: dict, dreams: list, limit: int = 3, min_score: float = 0.1) -> list:
+        """Get the user's other dreams most similar to ``dream``: ``[(score, dream), ...]``"""
+        matrix = self._matrix(user_id, dreams)
+        if not len(matrix):
+            return []
+        query = self._vectors.get((user_id, dream['id']))
+        if query is None:
+            query = self._embed_dream(dream)
+        scores = matrix @ query
+        ranked = [(float(scores[i]), dreams[i]) for i in np.argsort(scores)[::-1] if dreams[i]['id'] != dream['id']]
+        return [item for item in ranked[:limit] if item[0] >= min_score]
+
+    def is_follow_up(self, user_id, text: str, dreams: list) -> bool:
+        """Decide whether a message is a question about a stored dream rather than a new dream"""
+        if not dreams:
+            return False
+        lowered = text.lower()
+        words = len(WORD_COUNT_RE.findall(lowered))
+        if words <= 60 and asks_about_dream(text):
+            return True
+        # A short question that is about one of the stored dreams
+        if words <= 30 and lowered.rstrip().endswith('?'):
+            return float(self.scores(user_id, text, dreams).max()) >= self.follow_up_similarity
+        return False
+
+    def select_context(self, user_id, question: str, dreams: list, focus_id: int = None, cost=None) -> list:
+        """Pick the stored dreams to send with a follow-up, within the context token budget.
+
+        Dreams are ranked by similarity to the question; the dream the user
+        asked about (``focus_id``) and the most recent dream get a bonus. The
+        best dream is always included, others only if they are similar enough.
+        ``cost(dream)`` gives the tokens a dream adds to the prompt (its full
+        text by default). Returned oldest first.
+        """
+        if not dreams:
+            return []
+        scores = self.scores(user_id, question, dreams).astype(np.float64)
+        scores[-1] += 0.05
+        for index, dream in enumerate(dreams):
+            if dream['id'] == focus_id:
+                scores[index] += 1.0
+
+        selected, used = [], 0
+        for index in np.argsort(scores)[::-1]:
+            dream = dreams[index]
+            tokens = cost(dream) if cost else count_tokens(dream['dream']) + count_tokens(dream['interpretation'])
+            if selected and (scores[index] < self.follow_up_similarity or used + tokens > self.context_tokens):
+                continue
+            selected.append(index)
+            used += tokens
+        return [dreams[index] for index in sorted(selected)]
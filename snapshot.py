@@ -0,0 +1,186 @@
+import os
+import sys
+import json
+import mmap
+import time
+import zlib
+import struct
+import marshal
+import logging
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'DRMSNAP\x01'
+HEADER = struct.Struct('<8sI')  # Magic and the length of the JSON header that follows
+ALIGNMENT = 8
+
+# Users whose recent dreams are kept in the snapshot, most recently used first
+SNAPSHOT_USERS = int(os.getenv('WARM_SNAPSHOT_USERS', '10000'))
+
+
+def default_snapshot_path():
+    """The snapshot file, or None if WARM_SNAPSHOT_PATH is set empty to disable snapshots"""
+    path = os.getenv('WARM_SNAPSHOT_PATH', 'data/warm_state.snap')
+    return Path(path) if path else None
+
+
+def _padding(length: int) -> int:
+    return -length % ALIGNMENT
+
+
+class SnapshotWriter:
+    """Collects sections and writes them as one snapshot file.
+
+    Raw sections hold typed arrays (or bytes) as they are in memory, aligned
+    so they can be used straight from a memory mapping. Packed sections hold
+    any marshallable value, zlib-compressed. Each section can carry a small
+    JSON ``meta`` dict, e.g. what the data must match to still be valid.
+    """
+
+    def __init__(self):
+        self._sections = []  # Format: [(name, kind, typecode, meta, data)]
+
+    def add_raw(self, name: str, values, meta: dict = None):
+        """Add an ``array.array`` or bytes, to be read back with ``Snapshot.array()``"""
+        typecode = getattr(values, 'typecode', 'B')
+        self._sections.append((name, 'raw', typecode, meta or {}, bytes(values)))
+
+    def add(self, name: str, value, meta: dict = None):
+        """Add a marshallable value, to be read back with ``Snapshot.load()``"""
+        self._sections.append((name, 'packed', None, meta or {}, zlib.compress(marshal.dumps(value), 1)))
+
+    def write(self, path):
+        """Write the snapshot atomically: readers see either the old file or the new one"""
+        path = Path(path)
+        sections = {}
+        offset = 0
+        for name, kind, typecode, meta, data in self._sections:
+            sections[name] = {'offset': offset, 'length': len(data), 'kind': kind, 'typecode': typecode,
+                              'meta': meta}
+            offset += len(data) + _padding(len(data))
+        body = b''.join(data + bytes(_padding(len(data))) for *_, data in self._sections)
+        header = json.dumps({'created': time.time(), 'byteorder': sys.byteorder, 'crc': zlib.crc32(body),
+                             'sections': sections}).encode('utf-8')
+        header += b' ' * _padding(HEADER.size + len(header))
+
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(path.name + '.tmp')
+        with open(tmp_path, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, len(header)))
+            f.write(header)
+            f.write(body)
+        os.replace(tmp_path, path)
+        return HEADER.size + len(header) + len(body)
+
+
+class Snapshot:
+    """A snapshot file mapped into memory.
+
+    Raw sections are returned as memoryviews into the mapping, so opening a
+    snapshot reads only its header and checksum; pages holding the data are
+    loaded by the OS when they are first touched.
+    """
+
+    def __init__(self, mapping: mmap.mmap, start: int, header: dict):
+        self._mapping = mapping
+        self._data = memoryview(mapping)[start:]
+        self.created = header['created']
+        self.sections = header['sections']
+
+    @classmethod
+    def open(cls, path):
+        """Map a snapshot file, or return None if it is missing, unreadable or damaged"""
+        try:
+            with open(path, 'rb') as f:
+                mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:  # An empty file cannot be mapped
+            logger.warning(f"Cannot open warm-state snapshot {path}: {e}")
+            return None
+        try:
+            magic, length = HEADER.unpack_from(mapping)
+            if magic != MAGIC:
+                raise ValueError("not a snapshot file")
+            start = HEADER.size + length
+            header = json.loads(mapping[HEADER.size:start])
+            if header['byteorder'] != sys.byteorder:
+                raise ValueError("written on a machine with another byte order")
+            if zlib.crc32(memoryview(mapping)[start:]) != header['crc']:
+                raise ValueError("checksum mismatch")
+        except (struct.error, ValueError, KeyError) as e:
+            logger.warning(f"Ignoring warm-state snapshot {path}: {e}")
+            mapping.close()
+            return None
+        return cls(mapping, start, header)
+
+    def meta(self, name: str):
+        """Get the meta dict of a section, or None if the snapshot has no such section"""
+        section = self.sections.get(name)
+        return section['meta'] if section else None
+
+    def _view(self, name: str) -> memoryview:
+        section = self.sections[name]
+        return self._data[section['offset']:section['offset'] + section['length']]
+
+    def array(self, name: str) -> memoryview:
+        """Get a raw section as a read-only memoryview of its items"""
+        return self._view(name).cast(self.sections[name]['typecode'])
+
+    def load(self, name: str):
+        """Get the value of a packed section"""
+        return marshal.loads(zlib.decompress(self._view(name)))
+
+
+def save_warm_state(path, quota=None, history=None, cache=None) -> int:
+    """Write the state worth keeping across a restart; returns the file size.
+
+    Must run after pending writes are flushed: the snapshot records the
+    storage it matches, and a restore checks that nothing was written since.
+    """
+    writer = SnapshotWriter()
+    if quota is not None:
+        state = quota.export_state()
+        if state is not None:
+            month, user_ids, counters = state
+            writer.add_raw('quota.user_ids', user_ids,
+                           {'month': month, 'fingerprint': quota.storage.fingerprint(month)})
+            writer.add_raw('quota.counters', counters)
+    if history is not None:
+        state = history.export_state(SNAPSHOT_USERS)
+        if state is not None:
+            user_ids, offsets, data = state
+            writer.add_raw('history.user_ids', user_ids, {'fingerprint': history.fingerprint()})
+            writer.add_raw('history.offsets', offsets)
+            writer.add_raw('history.data', data)
+    if cache is not None:
+        writer.add('cache', cache.export_entries())
+    return writer.write(path)
+
+
+def restore_warm_state(path, quota=None, history=None, cache=None) -> set:
+    """Restore what is still valid from a snapshot; returns the names of the parts restored"""
+    snapshot = Snapshot.open(path)
+    if snapshot is None:
+        return set()
+    restored = set()
+    try:
+        meta = snapshot.meta('quota.user_ids')
+        if quota is not None and meta is not None and meta['fingerprint'] == quota.storage.fingerprint(meta['month']):
+            if quota.restore_state(meta['month'], snapshot.array('quota.user_ids'),
+                                   snapshot.array('quota.counters')):
+                restored.add('quota')
+        meta = snapshot.meta('history.user_ids')
+        if history is not None and meta is not None and meta['fingerprint'] == history.fingerprint():
+            history.restore_state(snapshot.array('history.user_ids'), snapshot.array('history.offsets'),
+                                  snapshot.array('history.data'))
+            restored.add('history')
+        if cache is not None and snapshot.meta('cache') is not None:
+            cache.restore_entries(snapshot.load('cache'))
+            restored.add('cache')
+    except Exception as e:
+        logger.error(f"Error restoring warm-state snapshot {path}: {e}")
+    logger.info(f"Restored {', '.join(sorted(restored)) or 'nothing'} from the warm-state snapshot "
+                f"taken {time.time() - snapshot.created:.0f}s ago")
+    return restored
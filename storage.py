@@ -0,0 +1,1018 @@
+import os
+import gzip
+import json
+import sqlite3
+import logging
+import argparse
+import threading
+from datetime import datetime, timedelta
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+MESSAGE_TYPES = ('voice', 'text')
+
+
+def month_key(when: datetime) -> str:
+    """Get the storage month key ('YYYY-MM') for a timestamp"""
+    return when.strftime('%Y-%m')
+
+
+def months_between(start_date: str, end_date: str) -> list:
+    """Get the month keys covering an inclusive 'YYYY-MM-DD' date range"""
+    months = []
+    year, month = int(start_date[:4]), int(start_date[5:7])
+    while f"{year:04d}-{month:02d}" <= end_date[:7]:
+        months.append(f"{year:04d}-{month:02d}")
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return months
+
+
+def dream_event(user_id: int, message_type: str, tokens_used: int, when: datetime,
+                prompt_tokens: int = 0, completion_tokens: int = 0) -> dict:
+    """Build a dream event for ``apply_batch``.
+
+    ``tokens_used`` is the total; the prompt/completion split is kept as well
+    when it is known, so costs can be priced per token kind.
+    """
+    if message_type not in MESSAGE_TYPES:
+        raise ValueError(f"Unknown message type: {message_type}")
+    return {'kind': 'dream', 'when': when, 'user_id': int(user_id), 'message_type': message_type,
+            'tokens_used': tokens_used, 'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens}
+
+
+def error_event(error_type: str, error_message: str, when: datetime) -> dict:
+    """Build an error event for ``apply_batch``"""
+    return {'kind': 'error', 'when': when, 'error_type': error_type, 'error_message': error_message}
+
+
+class PartialBatchError(IOError):
+    """Raised by ``apply_batch`` when some events were stored; ``remaining`` holds the ones that were not"""
+
+    def __init__(self, message: str, remaining: list):
+        super().__init__(message)
+        self.remaining = remaining
+
+
+class JSONStorage:
+    """Storage backend that keeps one JSON document per month.
+
+    This is the original analytics format: ``analytics/dream_analytics_YYYY_MM.json``.
+    Each event goes to the partition of the month it happened in. Months before
+    the current one are gzip-compressed (``.json.gz``) and reopened only when
+    a query needs them; ``index.json`` keeps per-month totals so monthly
+    summaries never load a partition.
+    """
+
+    # Finding one user's usage means reading the whole month
+    per_user_lookups = False
+
+    def __init__(self, analytics_dir="analytics"):
+        self.analytics_dir = Path(analytics_dir)
+        self.analytics_dir.mkdir(exist_ok=True)
+        self._lock = threading.Lock()
+        self._index_cache = None  # Format: (index file mtime_ns, {month: summary})
+
+    def _month_file(self, month: str) -> Path:
+        return self.analytics_dir / f"dream_analytics_{month.replace('-', '_')}.json"
+
+    def _cold_file(self, month: str) -> Path:
+        return self.analytics_dir / f"dream_analytics_{month.replace('-', '_')}.json.gz"
+
+    def _partition(self, month: str):
+        """Get the existing file of a month's partition, or None"""
+        for path in (self._month_file(month), self._cold_file(month)):
+            if path.exists():
+                return path
+        return None
+
+    def months(self) -> list:
+        """Get all months that have a partition, oldest first"""
+        months = set()
+        for path in self.analytics_dir.glob("dream_analytics_*.json*"):
+            name = path.name[len("dream_analytics_"):].split('.')[0]
+            months.add(name.replace('_', '-'))
+        return sorted(months)
+
+    def _empty_month(self) -> dict:
+        return {
+            "total_dreams": 0,
+            "voice_messages": 0,
+            "text_messages": 0,
+            "errors": 0,
+            "tokens_used": 0,
+            "prompt_tokens": 0,
+            "completion_tokens": 0,
+            "common_themes": {},
+            "user_interactions": {},
+            "daily_stats": {}
+        }
+
+    def ensure_month(self, month: str):
+        """Create the month's analytics file if it doesn't exist"""
+        if self._partition(month) is None:
+            self._save(month, self._empty_month())
+
+    def _load(self, month: str):
+        """Load a month's analytics data from file"""
+        try:
+            path = self._month_file(month)
+            if not path.exists() and self._cold_file(month).exists():
+                with gzip.open(self._cold_file(month), 'rt', encoding='utf-8') as f:
+                    return json.load(f)
+            with open(path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except Exception as e:
+            logger.error(f"Error loading analytics data: {e}")
+            return None
+
+    def _stage(self, month: str, data: dict) -> Path:
+        """Write a month's new data next to its file, to be swapped in by ``_commit``"""
+        path = self._month_file(month)
+        tmp_path = path.with_name(path.name + '.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False, indent=2)
+        return tmp_path
+
+    def _commit(self, month: str, data: dict, tmp_path: Path):
+        """Swap a staged month file in; once it is replaced the month counts as stored"""
+        # Readers see either the old or the new file, never a partial one
+        os.replace(tmp_path, self._month_file(month))
+        try:
+            # A late event reopened a compressed month
+            self._cold_file(month).unlink(missing_ok=True)
+            self._update_index(month, data, compressed=False)
+        except Exception as e:
+            # Drop the stale index instead of failing a write that is already stored; reads rebuild it
+            logger.error(f"Error updating analytics index for {month}: {e}")
+            (self.analytics_dir / 'index.json').unlink(missing_ok=True)
+            self._index_cache = None
+
+    def _save(self, month: str, data: dict):
+        """Save a month's analytics data to file atomically"""
+        try:
+            self._commit(month, data, self._stage(month, data))
+        except Exception as e:
+            logger.error(f"Error saving analytics data: {e}")
+            raise
+
+    def _summary(self, data: dict) -> dict:
+        dates = sorted(data['daily_stats'])
+        return {
+            'total_dreams': data['total_dreams'],
+            'voice_messages': data['voice_messages'],
+            'text_messages': data['text_messages'],
+            'total_users': len(data['user_interactions']),
+            'tokens_used': data['tokens_used'],
+            'prompt_tokens': data.get('prompt_tokens', 0),
+            'completion_tokens': data.get('completion_tokens', 0),
+            'errors': data['errors'],
+            'themes': dict(data.get('common_themes', {})),
+            'version': data.get('version', 0),
+            'themes_partial': any(day.get('themes_partial') for day in data['daily_stats'].values()),
+            'first_date': dates[0] if dates else None,
+            'last_date': dates[-1] if dates else None
+        }
+
+    def _index(self) -> dict:
+        """Get the per-month summary index, rebuilding it if it is missing"""
+        path = self.analytics_dir / 'index.json'
+        try:
+            mtime = path.stat().st_mtime_ns
+        except FileNotFoundError:
+            return self._rebuild_index()
+        # Other processes (the bot) update the index; reread it when it changes
+        if self._index_cache is None or self._index_cache[0] != mtime:
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    self._index_cache = (mtime, json.load(f))
+            except Exception as e:
+                logger.error(f"Error loading analytics index: {e}")
+                return self._rebuild_index()
+        return self._index_cache[1]
+
+    def _write_index(self, index: dict):
+        path = self.analytics_dir / 'index.json'
+        tmp_path = path.with_name(path.name + '.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(index, f, ensure_ascii=False, indent=2, sort_keys=True)
+        os.replace(tmp_path, path)
+        self._index_cache = (path.stat().st_mtime_ns, index)
+
+    def _rebuild_index(self) -> dict:
+        index = {}
+        for month in self.months():
+            data = self._load(month)
+            if data:
+                index[month] = self._summary(data)
+                index[month]['compressed'] = not self._month_file(month).exists()
+        self._write_index(index)
+        logger.info(f"Rebuilt analytics index for {len(index)} month(s)")
+        return index
+
+    def _update_index(self, month: str, data: dict, compressed: bool):
+        index = dict(self._index())
+        index[month] = self._summary(data)
+        index[month]['compressed'] = compressed
+        self._write_index(index)
+
+    def compress_cold_months(self, current_month: str) -> int:
+        """Gzip the partitions of months before ``current_month``"""
+        compressed = 0
+        with self._lock:
+            for month in self.months():
+                path = self._month_file(month)
+                if month >= current_month or not path.exists():
+                    continue
+                data = self._load(month)
+                if not data:
+                    continue
+                cold_path = self._cold_file(month)
+                tmp_path = cold_path.with_name(cold_path.name + '.tmp')
+                with gzip.open(tmp_path, 'wt', encoding='utf-8') as f:
+                    json.dump(data, f, ensure_ascii=False)
+                os.replace(tmp_path, cold_path)
+                path.unlink()
+                self._update_index(month, data, compressed=True)
+                compressed += 1
+                logger.info(f"Compressed analytics for {month}")
+        return compressed
+
+    def get_user_usage(self, user_id: int, month: str):
+        data = self._load(month)
+        if not data or str(user_id) not in data['user_interactions']:
+            return None
+        return data['user_interactions'][str(user_id)]
+
+    def iter_user_usage(self, month: str):
+        """Iterate over (user_id, usage) pairs for a month"""
+        data = self._load(month)
+        if not data:
+            return
+        for user_id, user_data in data['user_interactions'].items():
+            yield int(user_id), user_data
+
+    def _apply_dream(self, data: dict, event: dict):
+        """Apply a dream event to a loaded month document"""
+        user_id, message_type, tokens_used = event['user_id'], event['message_type'], event['tokens_used']
+        today = event['when'].strftime('%Y-%m-%d')
+
+        # Update total counts
+        data['total_dreams'] += 1
+        data[f'{message_type}_messages'] += 1
+        data['tokens_used'] += tokens_used
+        # Months written before the prompt/completion split lack these keys
+        for kind in ('prompt_tokens', 'completion_tokens'):
+            data[kind] = data.get(kind, 0) + event.get(kind, 0)
+
+        # Update user statistics
+        if str(user_id) not in data['user_interactions']:
+            data['user_interactions'][str(user_id)] = {
+                'total_dreams': 0,
+                'voice_messages': 0,
+                'text_messages': 0,
+                'first_interaction': today,
+                'last_interaction': today
+            }
+
+        user_data = data['user_interactions'][str(user_id)]
+        user_data['total_dreams'] += 1
+        user_data[f'{message_type}_messages'] = user_data.get(f'{message_type}_messages', 0) + 1
+        user_data['last_interaction'] = today
+
+        # Update daily statistics
+        if today not in data['daily_stats']:
+            data['daily_stats'][today] = {
+                'total_dreams': 0,
+                'voice_messages': 0,
+                'text_messages': 0,
+                'tokens_used': 0
+            }
+
+        data['daily_stats'][today]['total_dreams'] += 1
+        data['daily_stats'][today][f'{message_type}_messages'] += 1
+        data['daily_stats'][today]['tokens_used'] += tokens_used
+        for kind in ('prompt_tokens', 'completion_tokens'):
+            data['daily_stats'][today][kind] = data['daily_stats'][today].get(kind, 0) + event.get(kind, 0)
+
+        # Update theme counts
+        if event.get('themes'):
+            day_themes = data['daily_stats'][today].setdefault('themes', {})
+            for theme in event['themes']:
+                data['common_themes'][theme] = data['common_themes'].get(theme, 0) + 1
+                day_themes[theme] = day_themes.get(theme, 0) + 1
+
+    def _apply_error(self, data: dict, event: dict):
+        """Apply an error event to a loaded month document"""
+        data['errors'] += 1
+
+        today = event['when'].strftime('%Y-%m-%d')
+        if today not in data['daily_stats']:
+            data['daily_stats'][today] = {
+                'total_dreams': 0,
+                'voice_messages': 0,
+                'text_messages': 0,
+                'tokens_used': 0,
+                'errors': 0
+            }
+
+        if 'errors' not in data['daily_stats'][today]:
+            data['daily_stats'][today]['errors'] = 0
+
+        data['daily_stats'][today]['errors'] += 1
+
+    def apply_batch(self, events: list):
+        """Apply queued events with one load and one atomic save per month.
+
+        Every month's new file is written before any is swapped in, so a
+        failure while preparing the batch stores nothing and the whole batch
+        can be retried. Should a swap itself fail, ``PartialBatchError`` lists
+        the events of the months not stored, the only ones to retry. Returns
+        each written month's new version (see ``write_versions``).
+        """
+        by_month = {}
+        for event in events:
+            by_month.setdefault(month_key(event['when']), []).append(event)
+
+        with self._lock:
+            staged = []  # Format: [(month, data, staged file, events)]
+            try:
+                for month, month_events in sorted(by_month.items()):
+                    self.ensure_month(month)
+                    data = self._load(month)
+                    if not data:
+                        raise IOError(f"Analytics data for {month} could not be loaded")
+                    for event in month_events:
+                        if event['kind'] == 'dream':
+                            self._apply_dream(data, event)
+                        else:
+                            self._apply_error(data, event)
+                    data['version'] = data.get('version', 0) + 1
+                    staged.append((month, data, self._stage(month, data), month_events))
+            except Exception:
+                for _, _, tmp_path, _ in staged:
+                    tmp_path.unlink(missing_ok=True)
+                raise
+
+            for position, (month, data, tmp_path, _) in enumerate(staged):
+                try:
+                    self._commit(month, data, tmp_path)
+                except Exception as e:
+                    for _, _, unused_path, _ in staged[position:]:
+                        unused_path.unlink(missing_ok=True)
+                    remaining = [event for *_, month_events in staged[position:] for event in month_events]
+                    raise PartialBatchError(f"Analytics stored only up to the month before {month}: {e}",
+                                            remaining) from e
+            return {month: data['version'] for month, data, _, _ in staged}
+
+    def record_dream(self, user_id: int, message_type: str, tokens_used: int, when: datetime):
+        self.apply_batch([dream_event(user_id, message_type, tokens_used, when)])
+
+    def record_error(self, error_type: str, error_message: str, when: datetime):
+        self.apply_batch([error_event(error_type, error_message, when)])
+
+    def get_monthly(self, month: str):
+        summary = self._index().get(month)
+        if summary is None:
+            data = self._load(month) if self._partition(month) else None
+            if not data:
+                return None
+            summary = self._summary(data)
+
+        return {key: summary.get(key, 0) for key in
+                ('total_dreams', 'voice_messages', 'text_messages', 'total_users', 'tokens_used',
+                 'prompt_tokens', 'completion_tokens', 'errors')}
+
+    def get_daily(self, date: str):
+        data = self._load(date[:7])
+        if not data or date not in data['daily_stats']:
+            return None
+        return data['daily_stats'][date]
+
+    def get_daily_range(self, dates: list) -> dict:
+        """Get daily statistics for several dates, loading each month once"""
+        result = {}
+        for month in sorted({date[:7] for date in dates}):
+            if self._partition(month) is None:
+                continue
+            data = self._load(month)
+            if not data:
+                continue
+            for date in dates:
+                if date[:7] == month and date in data['daily_stats']:
+                    result[date] = data['daily_stats'][date]
+        return result
+
+    def get_themes(self, month: str) -> dict:
+        """Get a month's theme counts: ``{theme: count}``"""
+        summary = self._index().get(month)
+        if summary is not None and 'themes' in summary:
+            return dict(summary['themes'])
+        data = self._load(month) if self._partition(month) else None
+        return dict(data.get('common_themes', {})) if data else {}
+
+    def has_partial_themes(self, month: str) -> bool:
+        """Whether any of a month's theme counts were backfilled from incomplete data"""
+        summary = self._index().get(month)
+        if summary is not None and 'themes_partial' in summary:
+            return summary['themes_partial']
+        data = self._load(month) if self._partition(month) else None
+        return any(day.get('themes_partial') for day in data['daily_stats'].values()) if data else False
+
+    def first_theme_date(self):
+        """Get the first date with theme counts, or None"""
+        for month, summary in sorted(self._index().items()):
+            if not summary.get('themes'):
+                continue
+            data = self._load(month)
+            dates = [date for date, day in data['daily_stats'].items() if day.get('themes')] if data else []
+            if dates:
+                return min(dates)
+        return None
+
+    def set_theme_counts(self, counts: dict, partial: bool = False):
+        """Replace theme counts of the given days: ``{date: {theme: count}}``.
+
+        ``partial`` marks the days as counted from incomplete data, e.g. a backfill.
+        """
+        by_month = {}
+        for date, themes in counts.items():
+            by_month.setdefault(date[:7], {})[date] = themes
+
+        with self._lock:
+            for month, days in sorted(by_month.items()):
+                self.ensure_month(month)
+                data = self._load(month)
+                if not data:
+                    raise IOError(f"Analytics data for {month} could not be loaded")
+                for date, themes in days.items():
+                    day = data['daily_stats'].setdefault(date, {
+                        'total_dreams': 0,
+                        'voice_messages': 0,
+                        'text_messages': 0,
+                        'tokens_used': 0
+                    })
+                    day['themes'] = dict(themes)
+                    if partial:
+                        day['themes_partial'] = True
+                    else:
+                        day.pop('themes_partial', None)
+                # Monthly counts are the sum of the days
+                common_themes = {}
+                for day in data['daily_stats'].values():
+                    for theme, count in day.get('themes', {}).items():
+                        common_themes[theme] = common_themes.get(theme, 0) + count
+                data['common_themes'] = common_themes
+                self._save(month, data)
+
+    def iter_daily(self, start_date: str, end_date: str):
+        """Iterate over (date, stats) in an inclusive date range, oldest first.
+
+        Partitions are opened one at a time as the iteration reaches them and
+        parsed whole, so memory use is bounded by the largest month; months
+        without activity in the range are skipped using the index.
+        """
+        index = self._index()
+        for month in months_between(start_date, end_date):
+            summary = index.get(month)
+            if summary is not None and (summary['first_date'] is None or summary['first_date'] > end_date
+                                        or summary['last_date'] < start_date):
+                continue
+            if self._partition(month) is None:
+                continue
+            data = self._load(month)
+            if not data:
+                continue
+            for date in sorted(data['daily_stats']):
+                if start_date <= date <= end_date:
+                    yield date, data['daily_stats'][date]
+            # Free the month before the next one is parsed, so only one is ever held
+            del data
+
+    def iter_user_monthly(self, start_month: str, end_month: str):
+        """Iterate over (month, user_id, usage) in an inclusive month range, one partition at a time.
+
+        Each partition is parsed whole, so memory use is bounded by the largest month, not by the range.
+        """
+        for month in months_between(f"{start_month}-01", f"{end_month}-01"):
+            if self._partition(month) is None:
+                continue
+            data = self._load(month)
+            if not data:
+                continue
+            for user_id, user_data in data['user_interactions'].items():
+                yield month, int(user_id), user_data
+            del data
+
+    def change_token(self, months: list):
+        """Get a value that changes whenever any of the months' data changes"""
+        token = []
+        for month in months:
+            path = self._partition(month)
+            if path is None:
+                token.append((month, None, None))
+                continue
+            stat = path.stat()
+            token.append((month, path.suffix, stat.st_mtime_ns, stat.st_size))
+        return tuple(token)
+
+    def write_versions(self, months: list) -> dict:
+        """Get ``{month: version}``, where a month's version grows by one with every batch written to it"""
+        versions = {}
+        for month in months:
+            summary = self._index().get(month)
+            if summary is not None and 'version' in summary:
+                versions[month] = summary['version']
+                continue
+            data = self._load(month) if self._partition(month) else None
+            versions[month] = data.get('version', 0) if data else 0
+        return versions
+
+    def fingerprint(self, month: str) -> str:
+        """Get a value that changes whenever the month's data changes, comparable across processes"""
+        _, *token = self.change_token([month])[0]
+        return ':'.join(map(str, token))
+
+
+class SQLiteStorage:
+    """Storage backend on a single SQLite database in WAL mode.
+
+    Dreams and errors are appended to ``events``; per-user monthly counters and
+    per-day rollups are updated in the same transaction, so every read is an
+    indexed lookup instead of a full document parse.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS events (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            created_at TEXT NOT NULL,
+            date TEXT NOT NULL,
+            month TEXT NOT NULL,
+            kind TEXT NOT NULL,
+            user_id INTEGER,
+            message_type TEXT,
+            tokens_used INTEGER NOT NULL DEFAULT 0,
+            prompt_tokens INTEGER NOT NULL DEFAULT 0,
+            completion_tokens INTEGER NOT NULL DEFAULT 0,
+            error_type TEXT,
+            error_message TEXT
+        );
+        CREATE INDEX IF NOT EXISTS idx_events_date ON events (date);
+        CREATE INDEX IF NOT EXISTS idx_events_user_month ON events (user_id, month);
+
+        CREATE TABLE IF NOT EXISTS user_monthly (
+            user_id INTEGER NOT NULL,
+            month TEXT NOT NULL,
+            total_dreams INTEGER NOT NULL DEFAULT 0,
+            voice_messages INTEGER NOT NULL DEFAULT 0,
+            text_messages INTEGER NOT NULL DEFAULT 0,
+            first_interaction TEXT,
+            last_interaction TEXT,
+            PRIMARY KEY (user_id, month)
+        );
+        CREATE INDEX IF NOT EXISTS idx_user_monthly_month ON user_monthly (month);
+
+        CREATE TABLE IF NOT EXISTS daily_stats (
+            date TEXT PRIMARY KEY,
+            total_dreams INTEGER NOT NULL DEFAULT 0,
+            voice_messages INTEGER NOT NULL DEFAULT 0,
+            text_messages INTEGER NOT NULL DEFAULT 0,
+            tokens_used INTEGER NOT NULL DEFAULT 0,
+            prompt_tokens INTEGER NOT NULL DEFAULT 0,
+            completion_tokens INTEGER NOT NULL DEFAULT 0,
+            errors INTEGER NOT NULL DEFAULT 0
+        );
+
+        CREATE TABLE IF NOT EXISTS theme_counts (
+            date TEXT NOT NULL,
+            theme TEXT NOT NULL,
+            count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (date, theme)
+        );
+
+        CREATE TABLE IF NOT EXISTS theme_backfills (
+            date TEXT PRIMARY KEY
+        );
+
+        CREATE TABLE IF NOT EXISTS imported_files (
+            name TEXT PRIMARY KEY,
+            imported_at TEXT NOT NULL
+        );
+    """
+
+    per_user_lookups = True
+
+    def __init__(self, db_path="analytics/dream_analytics.db"):
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(str(self.db_path), check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(self.SCHEMA)
+        self._migrate()
+        self._writes = 0
+
+    # Columns added after the first release: (table, column, definition)
+    MIGRATIONS = (
+        ('events', 'prompt_tokens', 'INTEGER NOT NULL DEFAULT 0'),
+        ('events', 'completion_tokens', 'INTEGER NOT NULL DEFAULT 0'),
+        ('daily_stats', 'prompt_tokens', 'INTEGER NOT NULL DEFAULT 0'),
+        ('daily_stats', 'completion_tokens', 'INTEGER NOT NULL DEFAULT 0'),
+    )
+
+    def _migrate(self):
+        """Add columns missing from databases created by older versions"""
+        with self.conn:
+            for table, column, definition in self.MIGRATIONS:
+                columns = {row['name'] for row in self.conn.execute(f"PRAGMA table_info({table})")}
+                if column not in columns:
+                    self.conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+                    logger.info(f"Added column {table}.{column}")
+
+    def ensure_month(self, month: str):
+        # Rows are created on first write, nothing to prepare
+        pass
+
+    def close(self):
+        with self._lock:
+            self.conn.close()
+
+    def get_user_usage(self, user_id: int, month: str):
+        with self._lock:
+            row = self.conn.execute(
+                "SELECT total_dreams, voice_messages, text_messages, first_interaction, last_interaction "
+                "FROM user_monthly WHERE user_id = ? AND month = ?",
+                (int(user_id), month)
+            ).fetchone()
+        return dict(row) if row else None
+
+    def iter_user_usage(self, month: str):
+        """Iterate over (user_id, usage) pairs for a month"""
+        # Read a page per lock hold, so single-user lookups are not stuck behind the whole month
+        rows = self._iter_pages(
+            "SELECT rowid, user_id, total_dreams, voice_messages, text_messages, first_interaction, "
+            "last_interaction FROM user_monthly WHERE month = ? AND rowid > ? ORDER BY rowid LIMIT ?",
+            (month,), (0,), lambda row: (row['rowid'],), page_size=5000
+        )
+        for row in rows:
+            user_data = dict(row)
+            del user_data['rowid']
+            yield user_data.pop('user_id'), user_data
+
+    def apply_batch(self, events: list):
+        """Apply queued events in one transaction, merging counter updates per row.
+
+        Returns each written month's new version (see ``write_versions``).
+        """
+        event_rows = []
+        users = {}  # Format: {(user_id, month): [total, voice, text, first_date, last_date]}
+        days = {}   # Format: {date: [total, voice, text, tokens, prompt_tokens, completion_tokens, errors]}
+        themes = {}  # Format: {(date, theme): count}
+        for event in events:
+            when = event['when']
+            today = when.strftime('%Y-%m-%d')
+            month = month_key(when)
+            day = days.setdefault(today, [0, 0, 0, 0, 0, 0, 0])
+            if event['kind'] == 'dream':
+                event_rows.append((when.isoformat(), today, month, 'dream', event['user_id'],
+                                   event['message_type'], event['tokens_used'], event.get('prompt_tokens', 0),
+                                   event.get('completion_tokens', 0), None, None))
+                voice = 1 if event['message_type'] == 'voice' else 0
+                user = users.setdefault((event['user_id'], month), [0, 0, 0, today, today])
+                user[0] += 1
+                user[1] += voice
+                user[2] += 1 - voice
+                user[3] = min(user[3], today)
+                user[4] = max(user[4], today)
+                day[0] += 1
+                day[1] += voice
+                day[2] += 1 - voice
+                day[3] += event['tokens_used']
+                day[4] += event.get('prompt_tokens', 0)
+                day[5] += event.get('completion_tokens', 0)
+                for theme in event.get('themes') or ():
+                    themes[(today, theme)] = themes.get((today, theme), 0) + 1
+            else:
+                event_rows.append((when.isoformat(), today, month, 'error', None, None, 0, 0, 0,
+                                   event['error_type'], event['error_message']))
+                day[6] += 1
+
+        with self._lock, self.conn:
+            self.conn.executemany(
+                "INSERT INTO events (created_at, date, month, kind, user_id, message_type, tokens_used, "
+                "prompt_tokens, completion_tokens, error_type, error_message) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                event_rows
+            )
+            self.conn.executemany(
+                "INSERT INTO user_monthly (user_id, month, total_dreams, voice_messages, text_messages, "
+                "first_interaction, last_interaction) VALUES (?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (user_id, month) DO UPDATE SET "
+                "total_dreams = total_dreams + excluded.total_dreams, "
+                "voice_messages = voice_messages + excluded.voice_messages, "
+                "text_messages = text_messages + excluded.text_messages, "
+                "last_interaction = MAX(last_interaction, excluded.last_interaction)",
+                [(user_id, month, *counts) for (user_id, month), counts in users.items()]
+            )
+            self.conn.executemany(
+                "INSERT INTO daily_stats (date, total_dreams, voice_messages, text_messages, tokens_used, "
+                "prompt_tokens, completion_tokens, errors) VALUES (?, ?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (date) DO UPDATE SET "
+                "total_dreams = total_dreams + excluded.total_dreams, "
+                "voice_messages = voice_messages + excluded.voice_messages, "
+                "text_messages = text_messages + excluded.text_messages, "
+                "tokens_used = tokens_used + excluded.tokens_used, "
+                "prompt_tokens = prompt_tokens + excluded.prompt_tokens, "
+                "completion_tokens = completion_tokens + excluded.completion_tokens, "
+                "errors = errors + excluded.errors",
+                [(date, *counts) for date, counts in days.items()]
+            )
+            self.conn.executemany(
+                "INSERT INTO theme_counts (date, theme, count) VALUES (?, ?, ?) "
+                "ON CONFLICT (date, theme) DO UPDATE SET count = count + excluded.count",
+                [(date, theme, count) for (date, theme), count in themes.items()]
+            )
+            self._writes += 1
+            version = self.conn.execute("SELECT MAX(id) FROM events").fetchone()[0] or 0
+        return {month_key(event['when']): version for event in events}
+
+    def record_dream(self, user_id: int, message_type: str, tokens_used: int, when: datetime):
+        self.apply_batch([dream_event(user_id, message_type, tokens_used, when)])
+
+    def record_error(self, error_type: str, error_message: str, when: datetime):
+        self.apply_batch([error_event(error_type, error_message, when)])
+
+    def get_monthly(self, month: str):
+        with self._lock:
+            totals = self.conn.execute(
+                "SELECT COALESCE(SUM(total_dreams), 0) AS total_dreams, "
+                "COALESCE(SUM(voice_messages), 0) AS voice_messages, "
+                "COALESCE(SUM(text_messages), 0) AS text_messages, "
+                "COALESCE(SUM(tokens_used), 0) AS tokens_used, "
+                "COALESCE(SUM(prompt_tokens), 0) AS prompt_tokens, "
+                "COALESCE(SUM(completion_tokens), 0) AS completion_tokens, "
+                "COALESCE(SUM(errors), 0) AS errors "
+                "FROM daily_stats WHERE date >= ? AND date < ?",
+                (f"{month}-01", f"{month}-32")
+            ).fetchone()
+            users = self.conn.execute(
+                "SELECT COUNT(*) FROM user_monthly WHERE month = ?", (month,)
+            ).fetchone()[0]
+
+        return {
+            'total_dreams': totals['total_dreams'],
+            'voice_messages': totals['voice_messages'],
+            'text_messages': totals['text_messages'],
+            'total_users': users,
+            'tokens_used': totals['tokens_used'],
+            'prompt_tokens': totals['prompt_tokens'],
+            'completion_tokens': totals['completion_tokens'],
+            'errors': totals['errors']
+        }
+
+    def get_daily(self, date: str):
+        with self._lock:
+            row = self.conn.execute(
+                "SELECT total_dreams, voice_messages, text_messages, tokens_used, prompt_tokens, completion_tokens, errors "
+                "FROM daily_stats WHERE date = ?",
+                (date,)
+            ).fetchone()
+        return dict(row) if row else None
+
+    def get_themes(self, month: str) -> dict:
+        """Get a month's theme counts: ``{theme: count}``"""
+        with self._lock:
+            rows = self.conn.execute(
+                "SELECT theme, SUM(count) FROM theme_counts WHERE date >= ? AND date < ? GROUP BY theme",
+                (f"{month}-01", f"{month}-32")
+            ).fetchall()
+        return {theme: count for theme, count in rows}
+
+    def has_partial_themes(self, month: str) -> bool:
+        """Whether any of a month's theme counts were backfilled from incomplete data"""
+        with self._lock:
+            row = self.conn.execute(
+                "SELECT 1 FROM theme_backfills WHERE date >= ? AND date < ? LIMIT 1",
+                (f"{month}-01", f"{month}-32")
+            ).fetchone()
+        return row is not None
+
+    def first_theme_date(self):
+        """Get the first date with theme counts, or None"""
+        with self._lock:
+            return self.conn.execute("SELECT MIN(date) FROM theme_counts").fetchone()[0]
+
+    def set_theme_counts(self, counts: dict, partial: bool = False):
+        """Replace theme counts of the given days: ``{date: {theme: count}}``.
+
+        ``partial`` marks the days as counted from incomplete data, e.g. a backfill.
+        """
+        with self._lock, self.conn:
+            self.conn.executemany("DELETE FROM theme_counts WHERE date = ?", [(date,) for date in counts])
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO theme_backfills (date) VALUES (?)" if partial
+                else "DELETE FROM theme_backfills WHERE date = ?",
+                [(date,) for date in counts]
+            )
+            self.conn.executemany(
+                "INSERT INTO theme_counts (date, theme, count) VALUES (?, ?, ?)",
+                [(date, theme, count) for date, themes in counts.items() for theme, count in themes.items()]
+            )
+            self._writes += 1
+
+    def _iter_pages(self, sql: str, params: tuple, first_key: tuple, key, page_size: int = 1000):
+        """Iterate over the rows of an ordered query a page at a time.
+
+        ``sql`` takes ``params``, then the key of the last row read (starting
+        from ``first_key``) and the page size, and must select rows after that
+        key in key order. Only one page is held in memory, and the lock is
+        released between pages so writes are not blocked by a long read.
+        """
+        last = first_key
+        while True:
+            with self._lock:
+                rows = self.conn.execute(sql, (*params, *last, page_size)).fetchall()
+            yield from rows
+            if len(rows) < page_size:
+                return
+            last = key(rows[-1])
+
+    def iter_daily(self, start_date: str, end_date: str):
+        """Iterate over (date, stats) in an inclusive date range, oldest first"""
+        rows = self._iter_pages(
+            "SELECT date, total_dreams, voice_messages, text_messages, tokens_used, "
+            "prompt_tokens, completion_tokens, errors "
+            "FROM daily_stats WHERE date >= ? AND date <= ? AND date > ? ORDER BY date LIMIT ?",
+            (start_date, end_date), ('',), lambda row: (row['date'],)
+        )
+        for row in rows:
+            day = dict(row)
+            yield day.pop('date'), day
+
+    def iter_user_monthly(self, start_month: str, end_month: str):
+        """Iterate over (month, user_id, usage) in an inclusive month range"""
+        for month in months_between(f"{start_month}-01", f"{end_month}-01"):
+            # Pages of one month follow the month index in rowid order, so every page is a seek
+            rows = self._iter_pages(
+                "SELECT rowid, user_id, total_dreams, voice_messages, text_messages, first_interaction, "
+                "last_interaction FROM user_monthly WHERE month = ? AND rowid > ? ORDER BY rowid LIMIT ?",
+                (month,), (0,), lambda row: (row['rowid'],)
+            )
+            for row in rows:
+                user_data = dict(row)
+                del user_data['rowid']
+                yield month, user_data.pop('user_id'), user_data
+
+    def iter_events(self, start_date: str, end_date: str):
+        """Iterate over stored dream and error events in an inclusive date range, oldest first"""
+        day, date = datetime.strptime(start_date, '%Y-%m-%d'), start_date
+        while date <= end_date:
+            # Pages of one day follow the date index in id order, so every page is a seek
+            rows = self._iter_pages(
+                "SELECT id, created_at, date, kind, user_id, message_type, tokens_used, prompt_tokens, "
+                "completion_tokens, error_type, error_message FROM events "
+                "WHERE date = ? AND id > ? ORDER BY id LIMIT ?",
+                (date,), (0,), lambda row: (row['id'],)
+            )
+            for row in rows:
+                yield dict(row)
+            day += timedelta(days=1)
+            date = day.strftime('%Y-%m-%d')
+
+    def compress_cold_months(self, current_month: str) -> int:
+        # Old months are only index lookups away in SQLite, nothing to compact
+        return 0
+
+    def get_daily_range(self, dates: list) -> dict:
+        """Get daily statistics for several dates in one query"""
+        if not dates:
+            return {}
+        with self._lock:
+            rows = self.conn.execute(
+                "SELECT date, total_dreams, voice_messages, text_messages, tokens_used, "
+                "prompt_tokens, completion_tokens, errors "
+                "FROM daily_stats WHERE date >= ? AND date <= ?",
+                (min(dates), max(dates))
+            ).fetchall()
+        wanted = set(dates)
+        result = {}
+        for row in rows:
+            day = dict(row)
+            date = day.pop('date')
+            if date in wanted:
+                result[date] = day
+        return result
+
+    def change_token(self, months: list):
+        """Get a value that changes whenever the database is written to"""
+        with self._lock:
+            # data_version changes on commits from other connections, _writes on our own; both restart
+            # with the connection, so the fingerprint keeps tokens of different processes apart
+            data_version = self.conn.execute("PRAGMA data_version").fetchone()[0]
+        return (self.fingerprint(None), data_version, self._writes)
+
+    def write_versions(self, months: list) -> dict:
+        """Get ``{month: version}``; every batch raises the version of all months to its last event id"""
+        with self._lock:
+            version = self.conn.execute("SELECT MAX(id) FROM events").fetchone()[0] or 0
+        return dict.fromkeys(months, version)
+
+    def fingerprint(self, month: str) -> str:
+        """Get a value that changes whenever the database is written to, comparable across processes"""
+        with self._lock:
+            # Events are only ever appended, and imports are the only other writes
+            last_event = self.conn.execute("SELECT MAX(id) FROM events").fetchone()[0]
+            imports = self.conn.execute("SELECT COUNT(*) FROM imported_files").fetchone()[0]
+        return f"{last_event}:{imports}"
+
+    def import_json_files(self, analytics_dir="analytics") -> int:
+        """Import existing ``dream_analytics_YYYY_MM.json`` files, skipping ones already imported"""
+        imported = 0
+        paths = list(Path(analytics_dir).glob("dream_analytics_*.json")) + \
+            list(Path(analytics_dir).glob("dream_analytics_*.json.gz"))
+        for path in sorted(paths):
+            # A compressed month is the same month as its .json file
+            name = path.name[:-len('.gz')] if path.suffix == '.gz' else path.name
+            with self._lock:
+                done = self.conn.execute(
+                    "SELECT 1 FROM imported_files WHERE name = ?", (name,)
+                ).fetchone()
+            if done:
+                logger.info(f"Skipping already imported {path.name}")
+                continue
+
+            with (gzip.open if path.suffix == '.gz' else open)(path, 'rt', encoding='utf-8') as f:
+                data = json.load(f)
+            month = name[len("dream_analytics_"):-len('.json')].replace('_', '-')
+
+            with self._lock, self.conn:
+                for user_id, user_data in data.get('user_interactions', {}).items():
+                    self.conn.execute(
+                        "INSERT INTO user_monthly (user_id, month, total_dreams, voice_messages, text_messages, "
+                        "first_interaction, last_interaction) VALUES (?, ?, ?, ?, ?, ?, ?) "
+                        "ON CONFLICT (user_id, month) DO UPDATE SET "
+                        "total_dreams = total_dreams + excluded.total_dreams, "
+                        "voice_messages = voice_messages + excluded.voice_messages, "
+                        "text_messages = text_messages + excluded.text_messages, "
+                        "first_interaction = MIN(first_interaction, excluded.first_interaction), "
+                        "last_interaction = MAX(last_interaction, excluded.last_interaction)",
+                        (int(user_id), month, user_data.get('total_dreams', 0),
+                         user_data.get('voice_messages', 0), user_data.get('text_messages', 0),
+                         user_data.get('first_interaction'), user_data.get('last_interaction'))
+                    )
+                for date, day in data.get('daily_stats', {}).items():
+                    self.conn.execute(
+                        "INSERT INTO daily_stats (date, total_dreams, voice_messages, text_messages, tokens_used, "
+                        "prompt_tokens, completion_tokens, errors) VALUES (?, ?, ?, ?, ?, ?, ?, ?) "
+                        "ON CONFLICT (date) DO UPDATE SET "
+                        "total_dreams = total_dreams + excluded.total_dreams, "
+                        "voice_messages = voice_messages + excluded.voice_messages, "
+                        "text_messages = text_messages + excluded.text_messages, "
+                        "tokens_used = tokens_used + excluded.tokens_used, "
+                        "prompt_tokens = prompt_tokens + excluded.prompt_tokens, "
+                        "completion_tokens = completion_tokens + excluded.completion_tokens, "
+                        "errors = errors + excluded.errors",
+                        (date, day.get('total_dreams', 0), day.get('voice_messages', 0),
+                         day.get('text_messages', 0), day.get('tokens_used', 0), day.get('prompt_tokens', 0),
+                         day.get('completion_tokens', 0), day.get('errors', 0))
+                    )
+                    for theme, count in day.get('themes', {}).items():
+                        self.conn.execute(
+                            "INSERT INTO theme_counts (date, theme, count) VALUES (?, ?, ?) "
+                            "ON CONFLICT (date, theme) DO UPDATE SET count = count + excluded.count",
+                            (date, theme, count)
+                        )
+                    if day.get('themes_partial'):
+                        self.conn.execute("INSERT OR IGNORE INTO theme_backfills (date) VALUES (?)", (date,))
+                self.conn.execute(
+                    "INSERT INTO imported_files (name, imported_at) VALUES (?, ?)",
+                    (name, datetime.now().isoformat())
+                )
+                self._writes += 1
+            imported += 1
+            logger.info(f"Imported {path.name}")
+        return imported
+
+
+def create_storage():
+    """Create the storage backend selected by the ANALYTICS_BACKEND setting"""
+    backend = os.getenv('ANALYTICS_BACKEND', 'json').lower()
+    if backend == 'sqlite':
+        return SQLiteStorage(os.getenv('ANALYTICS_DB', 'analytics/dream_analytics.db'))
+    if backend != 'json':
+        logger.warning(f"Unknown analytics backend '{backend}', falling back to JSON")
+    return JSONStorage(os.getenv('ANALYTICS_DIR', 'analytics'))
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description="Import monthly JSON analytics into SQLite")
+    parser.add_argument('--analytics-dir', default='analytics')
+    parser.add_argument('--db', default=os.getenv('ANALYTICS_DB', 'analytics/dream_analytics.db'))
+    args = parser.parse_args()
+
+    storage = SQLiteStorage(args.db)
+    count = storage.import_json_files(args.analytics_dir)
+    logger.info(f"Imported {count} file(s) into {args.db}")
@@ -0,0 +1,64 @@
+import os
+import time
+import logging
+from telegram.error import BadRequest, RetryAfter
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Telegram rejects messages longer than this
+MAX_MESSAGE_LENGTH = 4096
+
+
+class MessageStreamer:
+    """Progressively edits a Telegram message with streamed text.
+
+    Edits are coalesced: a new edit is sent only when enough time has passed
+    since the previous one and enough new text has arrived, which keeps the
+    bot well under Telegram's edit rate limits. With an ``outbox`` the edits
+    also spend its tokens, and one is skipped when none is free; the final
+    text is left to the caller, who sends it through the outbox queue.
+    """
+
+    def __init__(self, message, header: str = "", min_interval: float = None, min_chars: int = None,
+                 outbox=None):
+        self.message = message
+        self.outbox = outbox
+        self.header = header
+        self.min_interval = min_interval or float(os.getenv('STREAM_EDIT_INTERVAL', '1.0'))
+        self.min_chars = min_chars or int(os.getenv('STREAM_EDIT_MIN_CHARS', '40'))
+        self.text = ""
+        self.edits = 0
+        self._sent_length = 0
+        self._last_edit = 0.0
+        self._blocked_until = 0.0
+
+    async def push(self, delta: str):
+        """Add streamed text, editing the message if the throttle allows it"""
+        self.text += delta
+        now = time.monotonic()
+        if now < self._blocked_until:
+            return
+        if len(self.text) - self._sent_length < self.min_chars:
+            return
+        if now - self._last_edit < self.min_interval:
+            return
+        await self._edit(self.header + self.text + " ▌")
+
+    async def _edit(self, text: str):
+        if self.outbox is not None and not self.outbox.try_acquire(self.message.chat_id):
+            # The chat or the bot is at its rate limit; a later push sends the text gathered so far
+            return
+        self._last_edit = time.monotonic()
+        self._sent_length = len(self.text)
+        try:
+            with metrics.span('stream_edit'):
+                await self.message.edit_text(text[:MAX_MESSAGE_LENGTH])
+            self.edits += 1
+        except RetryAfter as e:
+            # Skip intermediate edits until Telegram lets us edit again
+            self._blocked_until = time.monotonic() + e.retry_after
+            logger.warning(f"Streaming edits paused for {e.retry_after}s by Telegram")
+        except BadRequest as e:
+            if "not modified" not in str(e).lower():
+                logger.warning(f"Streaming edit failed: {e}")
@@ -0,0 +1,217 @@
+import os
+import re
+import zlib
+import sqlite3
+import logging
+import argparse
+import functools
+import threading
+from datetime import datetime
+import numpy as np
+
+try:
+    import pymorphy3 as pymorphy
+except ImportError:  # Lemmatization is optional, a suffix stemmer is used without it
+    try:
+        import pymorphy2 as pymorphy
+    except ImportError:
+        pymorphy = None
+
+logger = logging.getLogger(__name__)
+
+WORD_RE = re.compile(r'[а-яё]+')
+
+STOP_WORDS = frozenset("""
+    и в во не что он на я с со как а то все она так его но да ты к у же вы за бы по только ее мне было
+    вот от меня еще нет о из ему теперь когда даже ну вдруг ли если уже или ни быть был него до вас
+    нибудь опять уж вам ведь там потом себя ничего ей может они тут где есть надо ней для мы тебя их
+    чем была сам чтоб без будто чего раз тоже себе под будет ж тогда кто этот того потому этого какой
+    совсем ним здесь этом один почти мой тем чтобы нее сейчас были куда зачем всех никогда можно при
+    наконец два об другой хоть после над больше тот через эти нас про всего них какая много разве три
+    эту моя впрочем хорошо свою этой перед иногда лучше чуть том нельзя такой им более всегда конечно
+    всю между это снилось снился снилась приснилось приснился сон сне сна снах снов мне меня очень
+""".split())
+
+# Theme lexicon: each theme is recognised by the normalized forms of its words
+THEME_LEXICON = {
+    'вода': ['вода', 'море', 'река', 'океан', 'озеро', 'дождь', 'волна', 'плавать', 'тонуть', 'берег', 'пляж'],
+    'полёт': ['летать', 'полёт', 'лететь', 'небо', 'крылья', 'парить', 'облако', 'высота'],
+    'преследование': ['гнаться', 'погоня', 'убегать', 'бежать', 'преследовать', 'догонять', 'прятаться'],
+    'падение': ['падать', 'упасть', 'пропасть', 'обрыв', 'провалиться', 'лестница'],
+    'смерть': ['смерть', 'умереть', 'похороны', 'гроб', 'кладбище', 'покойный', 'мёртвый'],
+    'дом': ['дом', 'квартира', 'комната', 'дверь', 'окно', 'коридор', 'подвал', 'чердак'],
+    'семья': ['мама', 'папа', 'мать', 'отец', 'бабушка', 'дедушка', 'брат', 'сестра', 'родители', 'семья'],
+    'отношения': ['парень', 'девушка', 'муж', 'жена', 'любовь', 'свадьба', 'поцелуй', 'бывший', 'измена'],
+    'дети': ['ребёнок', 'дети', 'малыш', 'беременность', 'беременная', 'младенец', 'роды'],
+    'животные': ['собака', 'кошка', 'змея', 'волк', 'медведь', 'паук', 'лошадь', 'птица', 'рыба', 'крыса'],
+    'зубы': ['зуб', 'зубы', 'выпадать', 'стоматолог'],
+    'учёба и экзамены': ['экзамен', 'школа', 'урок', 'учитель', 'университет', 'контрольная', 'опоздать'],
+    'работа': ['работа', 'начальник', 'офис', 'коллега', 'увольнение', 'зарплата'],
+    'дорога и транспорт': ['машина', 'поезд', 'самолёт', 'автобус', 'дорога', 'ехать', 'авария', 'вокзал'],
+    'деньги': ['деньги', 'кошелёк', 'золото', 'богатство', 'монета', 'найти'],
+    'огонь': ['огонь', 'пожар', 'гореть', 'пламя', 'взрыв'],
+    'тревога': ['страх', 'бояться', 'ужас', 'кричать', 'плакать', 'потеряться', 'опаздывать', 'темнота'],
+}
+
+
+@functools.lru_cache(maxsize=None)
+def _morph():
+    return pymorphy.MorphAnalyzer() if pymorphy is not None else None
+
+
+# Endings stripped by the fallback stemmer, longest first
+_REFLEXIVE = ('ся', 'сь')
+_ENDINGS = sorted("""
+    иями ями ами иях ях ах ией ием иям ого его ому ему ими ыми ешь ишь ете ите ать ять еть ить уть
+    ала яла ила ела ыла али яли или ели ыли ало яло ило ело ыло ают яют уют ет ит ут ют ат ят
+    ал ял ил ел ыл ла ли ло аю яю ая яя ое ее ие ые ой ей ий ый ом ем ам ям ую юю ов ев ию ья ье
+    ьи ью ть л а я о е ы и у ю ь й
+""".split(), key=len, reverse=True)
+
+
+@functools.lru_cache(maxsize=100000)
+def normalize_word(word: str) -> str:
+    """Lemmatize a word with pymorphy if available, otherwise strip common endings"""
+    word = word.replace('ё', 'е')
+    morph = _morph()
+    if morph is not None:
+        return morph.parse(word)[0].normal_form.replace('ё', 'е')
+    if word.endswith(_REFLEXIVE) and len(word) > 5:
+        word = word[:-2]
+    for ending in _ENDINGS:
+        if word.endswith(ending) and len(word) - len(ending) >= 3:
+            return word[:-len(ending)]
+    return word
+
+
+def tokenize(text: str) -> list:
+    """Split Russian text into normalized content words"""
+    return [
+        normalize_word(word) for word in WORD_RE.findall(text.lower())
+        if len(word) > 2 and word not in STOP_WORDS
+    ]
+
+
+def _bucket(token: str, dim: int) -> int:
+    return zlib.crc32(token.encode('utf-8')) % dim
+
+
+class ThemeExtractor:
+    """Assigns lexicon themes to dream texts in batches.
+
+    Texts are hashed into sparse term counts (a hashing vectorizer, so there
+    is no vocabulary to maintain), weighted by TF-IDF with document
+    frequencies accumulated across batches, and scored against every theme
+    in one vectorized pass over the lexicon hits. A text gets up to ``max_themes`` themes scoring
+    at least ``threshold``.
+    """
+
+    def __init__(self, dim: int = 2 ** 20, threshold: float = None, max_themes: int = 3,
+                 lexicon: dict = None):
+        self.dim = dim
+        self.threshold = threshold if threshold is not None else float(os.getenv('THEME_THRESHOLD', '0.15'))
+        self.max_themes = max_themes
+        lexicon = lexicon or THEME_LEXICON
+        self.themes = list(lexicon)
+
+        # Only buckets of lexicon words can score, so the theme matrix is kept
+        # compact: bucket -> row of (lexicon buckets x themes)
+        buckets = {}
+        for theme, words in enumerate(lexicon.values()):
+            for word in words:
+                buckets.setdefault(_bucket(normalize_word(word), dim), set()).add(theme)
+        self.bucket_rows = np.full(dim, -1, dtype=np.int32)
+        self.theme_matrix = np.zeros((len(buckets), len(self.themes)), dtype=np.float32)
+        for row, (bucket, themes) in enumerate(buckets.items()):
+            self.bucket_rows[bucket] = row
+            self.theme_matrix[row, list(themes)] = 1.0
+
+        self.doc_freq = np.zeros(dim, dtype=np.float32)
+        self.documents = 0
+        self._lock = threading.Lock()
+
+    def vectorize(self, texts: list):
+        """Hash texts into sparse term counts: parallel (rows, buckets, counts) arrays"""
+        keys = []
+        for row, text in enumerate(texts):
+            keys.extend(row * self.dim + _bucket(token, self.dim) for token in tokenize(text or ''))
+        keys, counts = np.unique(np.array(keys, dtype=np.int64), return_counts=True)
+        return keys // self.dim, keys % self.dim, counts
+
+    def extract_batch(self, texts: list) -> list:
+        """Get a list of themes for each text"""
+        if not texts:
+            return []
+        rows, buckets, counts = self.vectorize(texts)
+
+        # Document frequencies keep growing, so common words fade over time
+        with self._lock:
+            self.doc_freq += np.bincount(buckets, minlength=self.dim).astype(np.float32)
+            self.documents += len(texts)
+            idf = np.log((1 + self.documents) / (1 + self.doc_freq[buckets])) + 1.0
+
+        weights = np.log1p(counts) * idf
+        norms = np.sqrt(np.bincount(rows, weights=weights ** 2, minlength=len(texts)))
+        weights /= norms[rows]
+
+        scores = np.zeros((len(texts), len(self.themes)), dtype=np.float32)
+        lexicon_rows = self.bucket_rows[buckets]
+        hit = lexicon_rows >= 0
+        np.add.at(scores, rows[hit], weights[hit, None] * self.theme_matrix[lexicon_rows[hit]])
+
+        result = []
+        for row in scores:
+            best = np.argsort(row)[::-1][:self.max_themes]
+            result.append([self.themes[index] for index in best if row[index] >= self.threshold])
+        return result
+
+
+def count_themes(extractor: ThemeExtractor, dreams: list, batch_size: int = 1000) -> dict:
+    """Count themes per day for ``[(date, text), ...]``: ``{date: {theme: count}}``"""
+    counts = {}
+    for start in range(0, len(dreams), batch_size):
+        batch = dreams[start:start + batch_size]
+        for (date, _), themes in zip(batch, extractor.extract_batch([text for _, text in batch])):
+            day = counts.setdefault(date, {})
+            for theme in themes:
+                day[theme] = day.get(theme, 0) + 1
+    return counts
+
+
+def backfill(storage, history_db: str, batch_size: int = 1000) -> int:
+    """Fill theme counts for days before live theme tracking from stored dream history.
+
+    The history keeps only each user's last DREAM_HISTORY_DEPTH dreams, and
+    analytics never stored dream texts, so older dreams cannot be counted:
+    backfilled days are undercounted and are marked as partial. Counts for
+    those days are replaced rather than added, so running the backfill again
+    gives the same result. Returns the number of dreams read.
+    """
+    first_tracked = storage.first_theme_date()
+    conn = sqlite3.connect(history_db)
+    try:
+        rows = conn.execute("SELECT created_at, dream FROM dreams ORDER BY created_at").fetchall()
+    finally:
+        conn.close()
+
+    dreams = []
+    for created_at, text in rows:
+        date = datetime.fromisoformat(created_at).strftime('%Y-%m-%d')
+        if first_tracked is None or date < first_tracked:
+            dreams.append((date, text))
+    counts = count_themes(ThemeExtractor(), dreams, batch_size)
+    storage.set_theme_counts(counts, partial=True)
+    logger.info(f"Backfilled themes from {len(dreams)} dream(s) over {len(counts)} day(s)")
+    return len(dreams)
+
+
+if __name__ == '__main__':
+    from storage import create_storage
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description="Backfill dream theme statistics from the dream history")
+    parser.add_argument('--history-db', default=os.getenv('DREAM_HISTORY_DB', 'data/dream_history.db'))
+    parser.add_argument('--batch-size', type=int, default=1000)
+    args = parser.parse_args()
+
+    backfill(create_storage(), args.history_db, args.batch_size)
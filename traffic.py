@@ -0,0 +1,215 @@
+import os
+import re
+import gzip
+import json
+import time
+import asyncio
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from cache import normalize_text
+from similarity import WORD_COUNT_RE, asks_about_dream
+
+logger = logging.getLogger(__name__)
+
+# Buttons that point at a stored dream; the id is recorded relative to the user's latest dream
+DREAM_BUTTON_RE = re.compile(r'(show_dream_|ask_followup_|similar_)(\d+)')
+# Any other callback data the bot sends is a fixed name, optionally with a page number
+BUTTON_RE = re.compile(r'[a-z_]+\d*')
+COMMAND_RE = re.compile(r'/([A-Za-z_]+)')
+
+
+def default_record_path():
+    """The recording file, or None unless TRAFFIC_RECORD_PATH is set"""
+    path = os.getenv('TRAFFIC_RECORD_PATH', '')
+    return Path(path) if path else None
+
+
+class TrafficRecorder:
+    """Opt-in log of incoming updates, anonymized, for replaying real traffic in benchmarks.
+
+    Every update is reduced to its arrival time, a pseudonymous user number
+    and its shape: text length and word count with the markers the
+    follow-up detection looks at, voice duration and size, the command name
+    or the button pressed. Texts themselves are never written; repeated
+    texts share a number, so cache hits can be replayed. Events are gzipped
+    NDJSON, appended in batches by a background task. Each process starts a
+    new session in the log, and user numbers are only meaningful within it:
+    they are a hash of the user id keyed with a secret of the session, so no
+    table of users is kept. A dream button is recorded relative to the
+    user's latest dream only when that user's history is already in memory,
+    and with ``a`` set to null otherwise; recording never reads the history
+    database.
+    """
+
+    def __init__(self, path: str = None, flush_interval: float = None, latest_dream_id=None,
+                 max_texts: int = 100000):
+        self.path = Path(path) if path else default_record_path()
+        self.flush_interval = flush_interval or float(os.getenv('TRAFFIC_RECORD_FLUSH_INTERVAL', '5'))
+        self.latest_dream_id = latest_dream_id  # latest_dream_id(user_id) -> int or None, must not block
+        self.max_texts = max_texts
+        self.session = os.urandom(4).hex()
+        self._user_key = os.urandom(16)  # Keys the user pseudonyms; never written
+        self._texts = OrderedDict()  # Format: {digest of normalized text: number}, least recently seen first
+        self._text_count = 0
+        self._pending = []           # Encoded events waiting to be written
+        self._started = False        # Whether the session line was written
+        self._write_lock = threading.Lock()
+        self.recorded = 0
+        self._task = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.path is not None
+
+    def _user(self, user_id: int) -> int:
+        digest = hashlib.blake2b(str(user_id).encode('ascii'), key=self._user_key, digest_size=6).digest()
+        return int.from_bytes(digest, 'big')
+
+    def _text_number(self, text: str) -> int:
+        digest = hashlib.blake2b(normalize_text(text).encode('utf-8'), digest_size=8).digest()
+        number = self._texts.get(digest)
+        if number is None:
+            self._text_count += 1
+            number = self._texts[digest] = self._text_count
+            if len(self._texts) > self.max_texts:
+                self._texts.popitem(last=False)
+        else:
+            self._texts.move_to_end(digest)
+        return number
+
+    def _describe_text(self, event: dict, text: str):
+        lowered = text.lower()
+        event['n'] = len(text)
+        event['w'] = len(WORD_COUNT_RE.findall(lowered))
+        event['f'] = int(asks_about_dream(text))
+        event['q'] = int(lowered.rstrip().endswith('?'))
+        event['d'] = self._text_number(text)
+
+    def _describe_button(self, event: dict, user_id: int, data: str):
+        match = DREAM_BUTTON_RE.fullmatch(data)
+        if match:
+            latest = self.latest_dream_id(user_id) if self.latest_dream_id else None
+            event['c'] = match.group(1)
+            event['a'] = latest - int(match.group(2)) if latest is not None else None
+        else:
+            event['c'] = data if BUTTON_RE.fullmatch(data) else 'other'
+
+    def describe(self, update) -> dict:
+        """Reduce an update to its anonymized event"""
+        user = getattr(update, 'effective_user', None)
+        event = {'t': round(time.time(), 3), 'u': self._user(user.id) if user else 0, 'k': 'other'}
+        query = getattr(update, 'callback_query', None)
+        message = getattr(update, 'message', None)
+        if query is not None:
+            event['k'] = 'callback'
+            self._describe_button(event, user.id, query.data or '')
+        elif message is not None and message.voice is not None:
+            event['k'] = 'voice'
+            event['s'] = message.voice.duration
+            event['b'] = message.voice.file_size or 0
+        elif message is not None and message.text:
+            if message.text.startswith('/'):
+                command = COMMAND_RE.match(message.text)
+                event['k'] = 'command'
+                event['c'] = command.group(1).lower() if command else 'other'
+            else:
+                event['k'] = 'text'
+                self._describe_text(event, message.text)
+        return event
+
+    def record(self, update):
+        """Queue an arriving update; never raises"""
+        if not self.enabled:
+            return
+        try:
+            event = self.describe(update)
+        except Exception as e:
+            logger.error(f"Error recording an update: {e}")
+            return
+        self._pending.append(json.dumps(event, separators=(',', ':')))
+        self.recorded += 1
+
+    def _take(self) -> list:
+        lines, self._pending = self._pending, []
+        if lines and not self._started:
+            self._started = True
+            session = {'k': 'session', 's': self.session, 't': round(time.time(), 3)}
+            lines.insert(0, json.dumps(session, separators=(',', ':')))
+        return lines
+
+    def _write(self, lines: list):
+        """Append a batch as one gzip member; a crash loses at most the batch being written"""
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            # A batch cancelled on shutdown can still be writing while the last one is
+            with self._write_lock, gzip.open(self.path, 'at', encoding='utf-8') as f:
+                f.write('\n'.join(lines) + '\n')
+        except Exception as e:
+            logger.error(f"Error writing recorded traffic to {self.path}: {e}")
+
+    def flush(self):
+        """Write queued events now"""
+        lines = self._take()
+        if lines:
+            self._write(lines)
+
+    async def _writer(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            lines = self._take()
+            if lines:
+                await asyncio.to_thread(self._write, lines)
+
+    def start(self):
+        """Start the background writer task"""
+        if self.enabled and self._task is None:
+            self._task = asyncio.create_task(self._writer())
+            logger.info(f"Recording anonymized traffic to {self.path}")
+
+    async def stop(self):
+        """Stop the background writer and write what is left"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        lines = self._take()
+        if lines:
+            await asyncio.to_thread(self._write, lines)
+
+
+def read_recording(paths: list) -> list:
+    """Read recorded events from one or more logs, oldest first.
+
+    Each event gets a ``user`` number that is unique across files and sessions,
+    since user numbers are only assigned within one process's session.
+    """
+    events, users = [], {}
+    for index, path in enumerate(paths):
+        session = None
+        try:
+            with gzip.open(path, 'rt', encoding='utf-8') as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    try:
+                        event = json.loads(line)
+                    except ValueError:
+                        logger.warning(f"Skipping a malformed line in {path}")
+                        continue
+                    if event['k'] == 'session':
+                        session = event['s']
+                        continue
+                    key = (index, session, event['u'])
+                    event['user'] = users.setdefault(key, len(users) + 1)
+                    events.append(event)
+        except EOFError:
+            # The last batch of a process that crashed while writing is cut short
+            logger.warning(f"{path} ends with an incomplete batch, replaying the events before it")
+    events.sort(key=lambda event: event['t'])
+    return events
@@ -0,0 +1,149 @@
+import io
+import os
+import asyncio
+import logging
+
+try:
+    from pydub import AudioSegment
+    from pydub.silence import detect_leading_silence
+except ImportError:  # Audio normalization is optional and needs ffmpeg
+    AudioSegment = None
+
+logger = logging.getLogger(__name__)
+
+
+class Transcriber:
+    """Interface for speech-to-text backends used by VoicePipeline."""
+
+    async def transcribe(self, audio: bytes, filename: str) -> str:
+        raise NotImplementedError
+
+
+class OpenAITranscriber(Transcriber):
+    """Transcribes audio with Whisper through the shared LLMPool."""
+
+    def __init__(self, llm, model: str = "whisper-1"):
+        self.llm = llm
+        self.model = model
+
+    async def transcribe(self, audio: bytes, filename: str) -> str:
+        transcript = await self.llm.transcribe((filename, audio), model=self.model)
+        return transcript.text
+
+
+class StaticTranscriber(Transcriber):
+    """Local stand-in that returns a fixed text (or calls a function) instead of Whisper."""
+
+    def __init__(self, text="", delay: float = 0.0):
+        self.text = text
+        self.delay = delay
+        self.calls = []
+
+    async def transcribe(self, audio: bytes, filename: str) -> str:
+        self.calls.append((filename, len(audio)))
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        return self.text(audio) if callable(self.text) else self.text
+
+
+class VoicePipeline:
+    """Downloads voice notes into memory, optionally normalizes them and transcribes them.
+
+    With pydub available, audio is down-mixed to mono 16 kHz, leading and
+    trailing silence is trimmed, and long recordings are split into chunks
+    that are transcribed concurrently and joined back in order. Without
+    pydub the original file is sent as is.
+    """
+
+    def __init__(self, transcriber: Transcriber, trim_silence: bool = None, downmix: bool = None,
+                 chunk_seconds: int = None, input_format: str = "ogg"):
+        self.transcriber = transcriber
+        self.trim_silence = trim_silence if trim_silence is not None else os.getenv('VOICE_TRIM_SILENCE', '1') == '1'
+        self.downmix = downmix if downmix is not None else os.getenv('VOICE_DOWNMIX', '1') == '1'
+        self.chunk_seconds = chunk_seconds or int(os.getenv('VOICE_CHUNK_SECONDS', '60'))
+        self.input_format = input_format
+        if AudioSegment is None and (self.trim_silence or self.downmix):
+            logger.info("pydub is not installed, voice messages will be sent without normalization")
+
+    async def download(self, voice_file) -> bytes:
+        """Download a Telegram file into memory"""
+        buffer = io.BytesIO()
+        await voice_file.download_to_memory(buffer)
+        return buffer.getvalue()
+
+    async def transcribe(self, voice_file, duration: int = None) -> str:
+        """Download and transcribe a Telegram voice file"""
+        audio = await self.download(voice_file)
+        return await self.transcribe_bytes(audio, duration)
+
+    async def transcribe_bytes(self, audio: bytes, duration: int = None) -> str:
+        """Transcribe audio bytes, chunking long recordings"""
+        if self._needs_processing(duration):
+            try:
+                chunks = await asyncio.to_thread(self.prepare, audio)
+            except Exception as e:
+                logger.warning(f"Audio normalization failed, sending original file: {e}")
+                chunks = [(audio, f"voice.{self.input_format}")]
+        else:
+            chunks = [(audio, f"voice.{self.input_format}")]
+
+        if len(chunks) == 1:
+            return (await self.transcriber.transcribe(*chunks[0])).strip()
+
+        logger.info(f"Transcribing voice message in {len(chunks)} chunks")
+        texts = await asyncio.gather(*(self.transcriber.transcribe(data, name) for data, name in chunks))
+        return " ".join(text.strip() for text in texts if text and text.strip())
+
+    def _needs_processing(self, duration: int = None) -> bool:
+        if AudioSegment is None:
+            return False
+        if self.trim_silence or self.downmix:
+            return True
+        return duration is None or duration > self.chunk_seconds
+
+    def prepare(self, audio: bytes) -> list:
+        """Normalize audio and split it into (bytes, filename) chunks. Runs in a worker thread."""
+        segment = AudioSegment.from_file(io.BytesIO(audio), format=self.input_format)
+        if self.downmix:
+            segment = segment.set_channels(1).set_frame_rate(16000)
+        if self.trim_silence:
+            segment = self._trim(segment)
+        if len(segment) == 0:
+            return [(audio, f"voice.{self.input_format}")]
+
+        chunks = []
+        for index, part in enumerate(self._split(segment)):
+            buffer = io.BytesIO()
+            part.export(buffer, format="ogg", codec="libopus", bitrate="24k")
+            chunks.append((buffer.getvalue(), f"voice_{index}.ogg"))
+        return chunks
+
+    def _trim(self, segment):
+        """Cut leading and trailing silence"""
+        start = detect_leading_silence(segment)
+        end = detect_leading_silence(segment.reverse())
+        if start + end >= len(segment):
+            return segment
+        return segment[start:len(segment) - end]
+
+    def _split(self, segment) -> list:
+        """Split audio into chunks, cutting at the quietest moment near each boundary"""
+        chunk_ms = self.chunk_seconds * 1000
+        if len(segment) <= chunk_ms:
+            return [segment]
+
+        parts = []
+        start = 0
+        while len(segment) - start > chunk_ms:
+            boundary = start + chunk_ms
+            # Look for the quietest 100 ms window in the last 3 seconds before the boundary
+            window_start = max(start + 1000, boundary - 3000)
+            cut = min(
+                range(window_start, boundary - 100, 100),
+                key=lambda position: segment[position:position + 100].dBFS,
+                default=boundary
+            )
+            parts.append(segment[start:cut])
+            start = cut
+        parts.append(segment[start:])
+        return parts
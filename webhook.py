@@ -0,0 +1,218 @@
+import os
+import hmac
+import queue
+import asyncio
+import logging
+import contextlib
+import multiprocessing
+from fastapi import FastAPI, Request, HTTPException
+from fastapi.responses import PlainTextResponse
+from telegram import Bot, Update
+
+logger = logging.getLogger(__name__)
+
+# Update fields that carry the user who sent them
+USER_FIELDS = (
+    'message', 'edited_message', 'callback_query', 'inline_query', 'chosen_inline_result',
+    'shipping_query', 'pre_checkout_query', 'poll_answer', 'my_chat_member', 'chat_member',
+    'chat_join_request'
+)
+
+
+def update_user_id(data: dict) -> int:
+    """Get the sender's user id from raw Update JSON, or 0 if there is none"""
+    for field in USER_FIELDS:
+        payload = data.get(field)
+        if payload:
+            sender = payload.get('from') or payload.get('user') or {}
+            if 'id' in sender:
+                return int(sender['id'])
+    return 0
+
+
+def shard_for(data: dict, workers: int) -> int:
+    """Pick the worker for an update. All updates of one user go to the same worker."""
+    return update_user_id(data) % workers
+
+
+async def run_application(application, next_update):
+    """Run an Application without an Updater, feeding it updates from ``next_update()``.
+
+    ``next_update`` returns raw Update JSON, or None to stop.
+    """
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    await application.start()
+    try:
+        while True:
+            data = await next_update()
+            if data is None:
+                break
+            await application.update_queue.put(Update.de_json(data, application.bot))
+    finally:
+        await application.stop()
+        if application.post_stop:
+            await application.post_stop(application)
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+
+
+def create_application(build_application, request_factory=None):
+    """Build the Application, with its Telegram HTTP backend from ``request_factory()`` if given"""
+    if request_factory is None:
+        return build_application()
+    return build_application(request=request_factory())
+
+
+def worker_main(index: int, updates, build_application, request_factory=None):
+    """Entry point of a sharded worker process.
+
+    ``build_application`` and ``request_factory`` are pickled to the worker,
+    so they must be module-level callables. The bot's state is created by
+    ``build_application`` here, after the per-worker settings below.
+    """
+    if os.getenv('METRICS_PORT'):
+        # Every worker serves its own metrics on the next ports
+        os.environ['METRICS_PORT'] = str(int(os.getenv('METRICS_PORT')) + 1 + index)
+    snapshot_path = os.getenv('WARM_SNAPSHOT_PATH', 'data/warm_state.snap')
+    if snapshot_path:
+        # Workers hold different users, so each keeps its own snapshot
+        os.environ['WARM_SNAPSHOT_PATH'] = f"{snapshot_path}.{index}"
+    if os.getenv('TRAFFIC_RECORD_PATH'):
+        # Appends from several processes to one gzip file would interleave
+        os.environ['TRAFFIC_RECORD_PATH'] = f"{os.getenv('TRAFFIC_RECORD_PATH')}.{index}"
+    logger.info(f"Webhook worker {index} started (pid {os.getpid()})")
+
+    async def next_update():
+        while True:
+            try:
+                # Poll with a timeout so the worker notices shutdown signals
+                return await asyncio.to_thread(updates.get, True, 1.0)
+            except queue.Empty:
+                continue
+
+    try:
+        asyncio.run(run_application(create_application(build_application, request_factory), next_update))
+    except KeyboardInterrupt:
+        pass
+    logger.info(f"Webhook worker {index} stopped")
+
+
+def create_app(dispatch, secret_token: str = None, path: str = "/telegram", lifespan=None) -> FastAPI:
+    """Create the ASGI app that receives Telegram updates and passes them to ``dispatch``"""
+    app = FastAPI(title="Dream Bot Webhook", lifespan=lifespan)
+
+    @app.post(path)
+    async def receive_update(request: Request):
+        if secret_token:
+            received = request.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+            if not hmac.compare_digest(received, secret_token):
+                raise HTTPException(status_code=403, detail="Invalid secret token")
+        data = await request.json()
+        await dispatch(data)
+        return {"ok": True}
+
+    @app.get("/healthz")
+    async def healthz():
+        return {"ok": True}
+
+    @app.get("/metrics", response_class=PlainTextResponse)
+    async def metrics_endpoint():
+        import metrics
+        return PlainTextResponse(metrics.REGISTRY.render(), media_type="text/plain; version=0.0.4")
+
+    return app
+
+
+def build_server_app(build_application, workers: int = None, secret_token: str = None,
+                     webhook_url: str = None, path: str = None, request_factory=None) -> FastAPI:
+    """Create the webhook app, either serving updates in-process or sharding them over workers.
+
+    The bot is built only where updates are handled: in this process with
+    one worker, otherwise in each worker. ``request_factory()`` creates the
+    HTTP backend for talking to Telegram, e.g. a local fake in tests.
+    """
+    workers = workers or int(os.getenv('WEBHOOK_WORKERS', '1'))
+    secret_token = secret_token if secret_token is not None else os.getenv('WEBHOOK_SECRET', '')
+    webhook_url = webhook_url if webhook_url is not None else os.getenv('WEBHOOK_URL', '')
+    path = path or os.getenv('WEBHOOK_PATH', '/telegram')
+
+    if workers > 1 and os.getenv('ANALYTICS_BACKEND', 'json').lower() != 'sqlite':
+        # Each worker would rewrite whole month files from its own copy and drop the others' counts
+        raise ValueError("WEBHOOK_WORKERS > 1 needs ANALYTICS_BACKEND=sqlite; the JSON files cannot be shared")
+
+    state = {}
+
+    async def register_webhook(bot):
+        await bot.set_webhook(
+            url=webhook_url.rstrip('/') + path,
+            secret_token=secret_token or None,
+            allowed_updates=Update.ALL_TYPES
+        )
+        logger.info(f"Webhook set to {webhook_url.rstrip('/') + path}")
+
+    if not webhook_url:
+        logger.info("WEBHOOK_URL is not set, expecting updates to be posted directly")
+
+    if workers == 1:
+        local_queue = asyncio.Queue()
+
+        async def dispatch(data):
+            await local_queue.put(data)
+
+        @contextlib.asynccontextmanager
+        async def lifespan(app):
+            application = create_application(build_application, request_factory)
+            state['task'] = asyncio.create_task(run_application(application, local_queue.get))
+            # Wait until the Application is running before accepting updates
+            while not application.running and not state['task'].done():
+                await asyncio.sleep(0.01)
+            if state['task'].done():
+                # Startup failed, surface the error
+                await state['task']
+            if webhook_url:
+                await register_webhook(application.bot)
+            yield
+            await local_queue.put(None)
+            await state['task']
+    else:
+        context = multiprocessing.get_context('spawn')
+        queues = [context.Queue() for _ in range(workers)]
+
+        async def dispatch(data):
+            queues[shard_for(data, workers)].put(data)
+
+        @contextlib.asynccontextmanager
+        async def lifespan(app):
+            processes = [
+                context.Process(target=worker_main, args=(index, queues[index], build_application, request_factory),
+                                daemon=True)
+                for index in range(workers)
+            ]
+            for process in processes:
+                process.start()
+            if webhook_url:
+                request = request_factory() if request_factory is not None else None
+                async with Bot(os.getenv('TELEGRAM_BOT_TOKEN'), request=request) as bot:
+                    await register_webhook(bot)
+            yield
+            for worker_queue in queues:
+                worker_queue.put(None)
+            for process in processes:
+                await asyncio.to_thread(process.join, 30)
+
+    return create_app(dispatch, secret_token, path, lifespan=lifespan)
+
+
+def serve(build_application):
+    """Serve the bot in webhook mode with uvicorn"""
+    import uvicorn
+
+    app = build_server_app(build_application)
+    uvicorn.run(
+        app,
+        host=os.getenv('WEBHOOK_HOST', '0.0.0.0'),
+        port=int(os.getenv('WEBHOOK_PORT', '8443'))
+    )